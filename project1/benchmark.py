@@ -0,0 +1,337 @@
+'''
+Benchmarks for the project 1 ingestion pipeline, run offline against fake_solr by default.
+Usage: python3 benchmark.py bulk --calls 20 --docs_per_call 500
+       python3 benchmark.py pipeline --pois 8 --keywords 8
+       python3 benchmark.py ratelimit --pois 60 --keywords 30 --replies 300
+       python3 benchmark.py resume --crash_after 3
+       python3 benchmark.py preprocess --tweets 20000
+'''
+
+import argparse
+import random
+import tempfile
+import time
+import pandas as pd
+import demoji
+import pysolr
+import tweet_preprocessor
+from fake_solr import FakeSolr
+from fake_twitter import FakeTwitter, MockAPI, SimulatedClock, synthetic_tweet
+from indexer import CORE_NAME, Indexer
+from scraper import CollectionPipeline, save_file, write_config
+from tweet_preprocessor import TWPreprocessor
+from twitter import PAGE_SIZES, RATE_LIMITS, RepliesJob, SearchJob, TimelineJob, Twitter
+
+
+def _synthetic_tweets(n, rng, start_id=0):
+    words = ['covid', 'vaccine', 'mask', 'lockdown', 'cases', 'health', 'people', 'today', 'new', 'world']
+    return [{"id": str(start_id + k), "poi_name": f"poi_{rng.randrange(20)}", "tweet_lang": "en",
+             "country": rng.choice(["USA", "India", "Mexico"]),
+             "tweet_text": ' '.join(rng.choices(words, k=rng.randint(5, 30))),
+             "hashtags": rng.sample(words, rng.randint(0, 3)),
+             "tweet_date": "2022-10-12T10:00:00Z"} for k in range(n)]
+
+
+def bench_bulk(argv):
+    '''
+    Indexes `calls` lists of `docs_per_call` tweets, as scraper.main does once per POI or keyword, with a hard
+    commit per call (always_commit=True) vs batches & a single final commit vs batches & commitWithin.
+    '''
+    rng = random.Random(argv.seed)
+    calls = [_synthetic_tweets(argv.docs_per_call, rng, call * argv.docs_per_call) for call in range(argv.calls)]
+    n_docs = argv.calls * argv.docs_per_call
+    print(f"{argv.calls} calls of {argv.docs_per_call} docs")
+    print(f"{'mode':<24}{'seconds':>9}{'docs/sec':>10}{'requests':>10}{'commits':>9}{'retries':>9}")
+    for mode in ('commit per call', 'batched + final commit', 'batched + commitWithin'):
+        server = None
+        if argv.solr_url is None:
+            server = FakeSolr(request_latency=argv.request_latency, doc_latency=argv.doc_latency,
+                              commit_latency=argv.commit_latency, fail_every=argv.fail_every).start()
+        solr_url = server.url if server else argv.solr_url
+        retries = 0
+        start = time.perf_counter()
+        if mode == 'commit per call':
+            connection = pysolr.Solr(solr_url + CORE_NAME, always_commit=True)
+            try:
+                for docs in calls:
+                    connection.add(docs)
+            except pysolr.SolrError as error:
+                print(f"{mode:<24}failed, without retries: {error}")
+                if server:
+                    server.stop()
+                continue
+        else:
+            indexer = Indexer(solr_url=solr_url, batch_size=argv.batch_size, retry_backoff=0.01,
+                              commit_within=argv.commit_within if mode == 'batched + commitWithin' else None)
+            for docs in calls:
+                retries += indexer.bulk_index(docs, commit=False)["retries"]
+            if indexer.commit_within is None:
+                indexer.commit()
+        elapsed = time.perf_counter() - start
+        stats = server.stats if server else {"requests": float('nan'), "commits": float('nan')}
+        print(f"{mode:<24}{elapsed:>9.2f}{n_docs / elapsed:>10.0f}{stats['requests']:>10}{stats['commits']:>9}"
+              f"{retries:>9}")
+        if server:
+            server.stop()
+
+
+def _config(argv):
+    return {"pois": [{"id": k, "screen_name": f"poi_{k}", "country": "USA", "count": argv.count, "finished": 0,
+                      "reply_finished": 0} for k in range(argv.pois)],
+            "keywords": [{"id": k, "name": f"keyword {k}", "count": argv.count, "lang": "en", "country": "USA",
+                          "finished": 0} for k in range(argv.keywords)]}
+
+
+def _collect_sequentially(twitter, indexer, config, config_path, data_dir):
+    # The loop of scraper.main before the pipeline: one POI or keyword at a time, through every stage.
+    stats = {"finished": 0, "failed": 0, "tweets": 0}
+    for type, items in (("poi", config["pois"]), ("keywords", config["keywords"])):
+        for item in items:
+            if type == "poi":
+                raw_tweets = twitter.get_tweets_by_poi_screen_name(item["screen_name"], item["count"])
+            else:
+                raw_tweets = twitter.get_tweets_by_lang_and_keyword(item["name"], item["lang"], item["count"])
+            processed_tweets = [TWPreprocessor.preprocess(tw) for tw in raw_tweets]
+            indexer.bulk_index(processed_tweets, commit=False)
+            item["finished"], item["collected"] = 1, len(processed_tweets)
+            write_config(config, config_path)
+            save_file(processed_tweets, f"{type}_{item['id']}.pkl", data_dir)
+            stats["finished"] += 1
+            stats["tweets"] += len(processed_tweets)
+    return stats
+
+
+def bench_pipeline(argv):
+    '''
+    Collects the tweets of the POIs & keywords of a synthetic config from fake_twitter, & indexes them in
+    fake_solr, one POI or keyword at a time vs with the CollectionPipeline of scraper. Checks that the pipeline
+    fetches from both endpoints at once.
+    '''
+    n_jobs = argv.pois + argv.keywords
+    print(f"{argv.pois} POIs & {argv.keywords} keywords of {argv.count} tweets, "
+          f"{argv.page_latency * 1000:.0f} ms per page of tweets")
+    print(f"{'mode':<12}{'seconds':>9}{'tweets/sec':>12}{'finished':>10}{'peak timeline':>15}{'peak search':>13}")
+    for mode in ('sequential', 'pipeline'):
+        server = FakeSolr(request_latency=argv.request_latency, doc_latency=argv.doc_latency).start()
+        twitter = FakeTwitter(page_latency=argv.page_latency, seed=argv.seed)
+        indexer = Indexer(solr_url=server.url, commit_within=10000)
+        config = _config(argv)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            config_path, data_dir = f"{tmp_dir}/config.json", f"{tmp_dir}/"
+            start = time.perf_counter()
+            if mode == 'sequential':
+                stats = _collect_sequentially(twitter, indexer, config, config_path, data_dir)
+            else:
+                budgets = {"user_timeline": argv.timeline_budget, "search": argv.search_budget}
+                pipeline = CollectionPipeline(twitter, indexer, config, budgets=budgets,
+                                              fetch_workers=argv.fetch_workers, config_path=config_path,
+                                              data_dir=data_dir, checkpoint_path=f"{tmp_dir}/checkpoints.json")
+                stats = pipeline.run()
+            elapsed = time.perf_counter() - start
+        server.stop()
+        print(f"{mode:<12}{elapsed:>9.2f}{stats['tweets'] / elapsed:>12.0f}{stats['finished']:>7}/{n_jobs:<2}"
+              f"{twitter.peak_active['user_timeline']:>15}{twitter.peak_active['search']:>13}")
+        if mode == 'pipeline' and argv.pois and argv.keywords and argv.count and argv.page_latency:
+            assert twitter.overlaps['user_timeline'] and twitter.overlaps['search'], \
+                "the pipeline did not fetch timelines & searches at once"
+
+
+def bench_ratelimit(argv):
+    '''
+    Collects POI timelines, keyword searches & replies from a MockAPI enforcing the rate limits on a simulated clock,
+    one job at a time, as with tweepy's wait_on_rate_limit, vs interleaved by Twitter.collect. Checks that no
+    request is rate limited, & that interleaved, the timelines keep being collected while the search quota, which
+    the replies share, is used up.
+    '''
+    print(f"{argv.pois} POIs of {argv.poi_count}, {argv.keywords} keywords of {argv.keyword_count} & "
+          f"{argv.replies} tweets with {argv.reply_count} replies")
+    print(f"{'mode':<14}{'minutes':>9}{'429s':>6}" + ''.join(f"{endpoint + ' tweets/window':>28}"
+                                                           for endpoint in ('user_timeline', 'search', 'replies')))
+    for mode in ('one at a time', 'interleaved'):
+        clock = SimulatedClock()
+        api = MockAPI(clock, seed=argv.seed)
+        twitter = Twitter(api=api, clock=clock)
+        jobs = [TimelineJob(f"poi_{k}", argv.poi_count) for k in range(argv.pois)] + \
+            [SearchJob(f"keyword {k}", "en", argv.keyword_count) for k in range(argv.keywords)] + \
+            [RepliesJob(f"poi_{k % max(argv.pois, 1)}", 10 ** 12 + 10 ** 6 * k, argv.reply_count)
+             for k in range(argv.replies)]
+        if mode == 'one at a time':
+            for job in jobs:
+                twitter.collect([job])
+        else:
+            twitter.collect(jobs)
+        stats = twitter.rate_stats()
+        print(f"{mode:<14}{clock.time() / 60:>9.0f}{sum(api.rate_limited.values()):>6}" +
+              ''.join(f"{stats.get(endpoint, {}).get('tweets_per_window', 0.0):>28.0f}"
+                      for endpoint in ('user_timeline', 'search', 'replies')))
+        assert not api.rate_limited, f"rate limited requests: {dict(api.rate_limited)}"
+        # With a search or reply job per search request of a window, the first round of requests uses the search
+        # quota up, & the timelines need more rounds
+        if mode == 'interleaved' and argv.pois and argv.poi_count > PAGE_SIZES["user_timeline"] and \
+                argv.keywords + argv.replies >= RATE_LIMITS["search"][0]:
+            assert api.overlaps["user_timeline", "search"], "no timeline request while the search quota was used up"
+
+
+def bench_resume(argv):
+    '''
+    Runs the CollectionPipeline of scraper on a synthetic config, crashing the fetches of every POI & keyword after
+    crash_after pages, & runs it again, with & without checkpoints. Counts the requests made by both runs, & checks
+    the tweets saved against those of a run without crashes.
+    '''
+    print(f"{argv.pois} POIs & {argv.keywords} keywords of {argv.count} tweets, crashing after {argv.crash_after} "
+          f"pages")
+    print(f"{'mode':<16}{'1st run requests':>18}{'2nd run requests':>18}{'finished':>10}{'same tweets':>13}")
+    server = FakeSolr().start()
+    expected = None
+    for mode in ('no crash', 'no checkpoints', 'checkpoints'):
+        config = _config(argv)
+        queries = [poi["screen_name"] for poi in config["pois"]] + [keyword["name"] for keyword in config["keywords"]]
+        requests = []
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            checkpoint_path = f"{tmp_dir}/checkpoints.json" if mode == 'checkpoints' else None
+            for fail in (queries, ()) if mode != 'no crash' else ((),):
+                twitter = FakeTwitter(fail=fail, fail_after=argv.crash_after, seed=argv.seed)
+                CollectionPipeline(twitter, Indexer(solr_url=server.url, commit_within=10000), config,
+                                   config_path=f"{tmp_dir}/config.json",
+                                   data_dir=f"{tmp_dir}/", checkpoint_path=checkpoint_path).run()
+                requests.append(sum(twitter.requests.values()))
+            finished = [item for item in config["pois"] + config["keywords"] if item["finished"]]
+            tweets = {(type, item["id"]): list(pd.read_pickle(f"{tmp_dir}/{type}_{item['id']}.pkl")["id"])
+                      for type, items in (("poi", config["pois"]), ("keywords", config["keywords"]))
+                      for item in items if item["finished"]}
+        if expected is None:
+            expected = tweets
+        print(f"{mode:<16}{requests[0]:>18}{requests[1] if len(requests) > 1 else '':>18}"
+              f"{len(finished):>7}/{len(queries):<2}{str(tweets == expected):>13}")
+    server.stop()
+
+
+def _legacy_text_cleaner(text):
+    # _text_cleaner before preprocess_many: demoji scans the text twice, & the emoticons are looked for one by one
+    emojis = list(demoji.findall(text).keys())
+    clean_text = demoji.replace(text, '')
+    for emo in tweet_preprocessor.EMOTICONS_HAPPY + tweet_preprocessor.EMOTICONS_SAD:
+        if emo in clean_text:
+            clean_text = clean_text.replace(emo, '')
+            emojis.append(emo)
+    return tweet_preprocessor.preprocessor.clean(text), emojis
+
+
+def _legacy_preprocess(tweet):
+    tweet_date = tweet_preprocessor._get_tweet_date(tweet["created_at"]).strftime(tweet_preprocessor.SOLR_DATE_FORMAT)
+    return tweet_preprocessor._document(tweet, *_legacy_text_cleaner(tweet_preprocessor._get_text(tweet)), tweet_date)
+
+
+def _synthetic_raw_tweets(n, rng):
+    emojis = ['\U0001F600', '\U0001F389', '\U0001F44D\U0001F3FD', '\u2764\ufe0f', '\U0001F1FA\U0001F1F8', '\U0001F637']
+    emoticons = tweet_preprocessor.EMOTICONS_HAPPY + tweet_preprocessor.EMOTICONS_SAD
+    tweets = []
+    for k in range(n):
+        lang = rng.choice(['en', 'en', 'hi', 'es'])
+        tweet = synthetic_tweet(10 ** 12 - k, rng, lang=lang)
+        extra = rng.sample(emojis, rng.randint(0, 2)) + rng.sample(emoticons, rng.randint(0, 1))
+        if lang == 'hi':
+            extra.append('\u0915\u094b\u0935\u093f\u0921 \u091f\u0940\u0915\u093e')
+        mention, url = f"user_{rng.randrange(100)}", f"https://t.co/{rng.randrange(10 ** 6)}"
+        tweet["full_text"] += ' ' + ' '.join(extra) + f" @{mention} {url}"
+        tweet["entities"]["user_mentions"].append({"screen_name": mention})
+        tweet["entities"]["urls"].append({"url": url})
+        if rng.random() < 0.2:
+            tweet["in_reply_to_status_id"] = tweet["in_reply_to_status_id_str"] = str(10 ** 11 + k)
+            tweet["in_reply_to_user_id_str"] = str(rng.randrange(10 ** 6))
+        tweets.append(tweet)
+    return tweets
+
+
+def bench_preprocess(argv):
+    '''
+    Preprocesses synthetic raw tweets, with emojis, emoticons, mentions & urls, one at a time with the cleaner &
+    dates as written, with TWPreprocessor.preprocess, & with TWPreprocessor.preprocess_many over a list & a
+    DataFrame. The documents are compared to those of preprocess.
+    '''
+    tweets = _synthetic_raw_tweets(argv.tweets, random.Random(argv.seed))
+    frame = pd.DataFrame(tweets)
+    tweet_preprocessor._emoji_pattern()
+    print(f"{argv.tweets} tweets")
+    print(f"{'mode':<32}{'seconds':>9}{'tweets/sec':>12}{'same documents':>16}")
+    expected = None
+    for mode in ('preprocess', 'per tweet, as written', 'preprocess_many(list)', 'preprocess_many(DataFrame)'):
+        start = time.perf_counter()
+        if mode == 'preprocess':
+            docs = [TWPreprocessor.preprocess(tweet) for tweet in tweets]
+        elif mode == 'per tweet, as written':
+            docs = [_legacy_preprocess(tweet) for tweet in tweets]
+        elif mode == 'preprocess_many(list)':
+            docs = TWPreprocessor.preprocess_many(tweets)
+        else:
+            docs = TWPreprocessor.preprocess_many(frame)
+        elapsed = time.perf_counter() - start
+        if mode == 'preprocess':
+            expected = docs
+        same = sum(doc == other for doc, other in zip(docs, expected)) if expected is not None else ''
+        print(f"{mode:<32}{elapsed:>9.2f}{len(tweets) / elapsed:>12.0f}{same:>16}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    bulk_parser = subparsers.add_parser("bulk", help="Per-call hard commits vs batched, non-committing indexing.")
+    bulk_parser.add_argument("--solr_url", type=str, default=None,
+                             help="Base url of a real Solr, e.g. http://localhost:8983/solr/. Defaults to a local "
+                                  "fake_solr server.")
+    bulk_parser.add_argument("--calls", type=int, default=20, help="Number of create_documents calls (POIs).")
+    bulk_parser.add_argument("--docs_per_call", type=int, default=500)
+    bulk_parser.add_argument("--batch_size", type=int, default=500)
+    bulk_parser.add_argument("--commit_within", type=int, default=10000, help="commitWithin, in milliseconds.")
+    bulk_parser.add_argument("--request_latency", type=float, default=0.002, help="Fake Solr: seconds per request.")
+    bulk_parser.add_argument("--doc_latency", type=float, default=0.00002, help="Fake Solr: seconds per document.")
+    bulk_parser.add_argument("--commit_latency", type=float, default=0.2, help="Fake Solr: seconds per hard commit.")
+    bulk_parser.add_argument("--fail_every", type=int, default=0,
+                             help="Fake Solr: fail every N-th update request, to exercise the retries.")
+    bulk_parser.add_argument("--seed", type=int, default=0)
+    bulk_parser.set_defaults(run=bench_bulk)
+
+    pipeline_parser = subparsers.add_parser("pipeline", help="Sequential vs pipelined collection & indexing.")
+    pipeline_parser.add_argument("--pois", type=int, default=8)
+    pipeline_parser.add_argument("--keywords", type=int, default=8)
+    pipeline_parser.add_argument("--count", type=int, default=500, help="Tweets per POI or keyword.")
+    pipeline_parser.add_argument("--page_latency", type=float, default=0.05,
+                                 help="Fake Twitter: seconds per page of tweets.")
+    pipeline_parser.add_argument("--fetch_workers", type=int, default=4)
+    pipeline_parser.add_argument("--timeline_budget", type=int, default=2,
+                                 help="Concurrent fetches from user_timeline.")
+    pipeline_parser.add_argument("--search_budget", type=int, default=2, help="Concurrent fetches from search.")
+    pipeline_parser.add_argument("--request_latency", type=float, default=0.002, help="Fake Solr: seconds per request.")
+    pipeline_parser.add_argument("--doc_latency", type=float, default=0.00002, help="Fake Solr: seconds per document.")
+    pipeline_parser.add_argument("--seed", type=int, default=0)
+    pipeline_parser.set_defaults(run=bench_pipeline)
+
+    ratelimit_parser = subparsers.add_parser("ratelimit", help="One collection job at a time vs interleaved, "
+                                                               "under the rate limits, on a simulated clock.")
+    ratelimit_parser.add_argument("--pois", type=int, default=60,
+                                  help="POIs, whose timelines need more than a window of requests by default.")
+    ratelimit_parser.add_argument("--poi_count", type=int, default=3200)
+    ratelimit_parser.add_argument("--keywords", type=int, default=30)
+    ratelimit_parser.add_argument("--keyword_count", type=int, default=2000)
+    ratelimit_parser.add_argument("--replies", type=int, default=300, help="Tweets to collect the replies of.")
+    ratelimit_parser.add_argument("--reply_count", type=int, default=50)
+    ratelimit_parser.add_argument("--seed", type=int, default=0)
+    ratelimit_parser.set_defaults(run=bench_ratelimit)
+
+    resume_parser = subparsers.add_parser("resume", help="Requests made to finish collection after a crash, with & "
+                                                         "without checkpoints.")
+    resume_parser.add_argument("--pois", type=int, default=4)
+    resume_parser.add_argument("--keywords", type=int, default=4)
+    resume_parser.add_argument("--count", type=int, default=1000, help="Tweets per POI or keyword.")
+    resume_parser.add_argument("--crash_after", type=int, default=3, help="Pages fetched before the crash.")
+    resume_parser.add_argument("--seed", type=int, default=0)
+    resume_parser.set_defaults(run=bench_resume)
+
+    preprocess_parser = subparsers.add_parser("preprocess", help="Per tweet vs batch preprocessing throughput.")
+    preprocess_parser.add_argument("--tweets", type=int, default=20000)
+    preprocess_parser.add_argument("--seed", type=int, default=0)
+    preprocess_parser.set_defaults(run=bench_preprocess)
+
+    argv = parser.parse_args()
+    argv.run(argv)
@@ -0,0 +1,100 @@
+'''
+Local stand-in for the update & select handlers of a Solr core, to test & benchmark indexing offline.
+'''
+
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+XML_DOC_PATTERN = re.compile(rb'<doc[\s>]')
+
+
+class FakeSolr(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port=0, request_latency=0.0, doc_latency=0.0, commit_latency=0.0, fail_every=0):
+        '''
+        Counts the documents & commits it receives, & simulates the cost of Solr: request_latency seconds per
+        request, doc_latency seconds per document & commit_latency seconds per hard commit.
+        :param port: 0 picks a free port
+        :param fail_every: answer every fail_every-th update request with a 503, 0 never fails
+        '''
+        super().__init__(('127.0.0.1', port), _FakeSolrHandler)
+        self.request_latency, self.doc_latency, self.commit_latency = request_latency, doc_latency, commit_latency
+        self.fail_every = fail_every
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "failures": 0, "docs": 0, "commits": 0, "commit_within": 0}
+        self.pending_docs, self.committed_docs = 0, 0
+        self.thread = None
+
+    @property
+    def url(self):
+        '''
+        :return: base url, to pass as Indexer(solr_url=...)
+        '''
+        return f'http://127.0.0.1:{self.server_address[1]}/solr/'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _FakeSolrHandler(BaseHTTPRequestHandler):
+    # Keep-alive, as Solr does, so that pooled connections are re-used. Responses are sent in one write, without
+    # Nagle's algorithm, or delayed ACKs would add ~40 ms per request.
+    protocol_version = 'HTTP/1.1'
+    wbufsize, disable_nagle_algorithm = -1, True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        server, url = self.server, urlparse(self.path)
+        params = parse_qs(url.query)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with server.lock:
+            server.stats["requests"] += 1
+            fail = server.fail_every and server.stats["requests"] % server.fail_every == 0
+            if fail:
+                server.stats["failures"] += 1
+        if fail:
+            return self._respond(503, {"error": {"msg": "simulated failure", "code": 503}})
+
+        if body.lstrip().startswith(b'['):
+            n_docs = len(json.loads(body))
+        else:
+            n_docs = len(XML_DOC_PATTERN.findall(body))
+        commit = params.get('commit') == ['true'] or b'<commit' in body
+        time.sleep(server.request_latency + n_docs * server.doc_latency + (server.commit_latency if commit else 0))
+        with server.lock:
+            server.stats["docs"] += n_docs
+            server.pending_docs += n_docs
+            if 'commitWithin' in params:
+                server.stats["commit_within"] += 1
+            if commit or 'commitWithin' in params:
+                server.stats["commits"] += commit
+                server.committed_docs += server.pending_docs
+                server.pending_docs = 0
+        self._respond(200, {"responseHeader": {"status": 0, "QTime": 0}})
+
+    def do_GET(self):
+        with self.server.lock:
+            num_found = self.server.committed_docs
+        self._respond(200, {"responseHeader": {"status": 0, "QTime": 0},
+                            "response": {"numFound": num_found, "start": 0, "docs": []}})
+
+    def _respond(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
@@ -0,0 +1,155 @@
+'''
+Local stand-ins for the Twitter client & for tweepy.API, returning synthetic tweets, to test & benchmark the
+collection pipeline & the rate limit scheduling offline.
+'''
+
+import random
+import threading
+import time
+from collections import Counter
+from twitter import PAGE_SIZES, RATE_LIMITS, SHARED_QUOTAS, RateLimitExceeded
+
+WORDS = ['covid', 'vaccine', 'mask', 'lockdown', 'cases', 'health', 'people', 'today', 'new', 'world', 'hospital',
+         'doctors', 'stay', 'home', 'safe', 'pandemic']
+
+
+def synthetic_tweet(tweet_id, rng, screen_name=None, lang="en", in_reply_to_status_id=None):
+    '''
+    A raw tweet, with the fields of the v1.1 API used by the preprocessing.
+    '''
+    hashtags = rng.sample(WORDS, rng.randint(0, 3))
+    text = ' '.join(rng.choices(WORDS, k=rng.randint(5, 30)) + ['#' + tag for tag in hashtags])
+    return {"id": tweet_id, "id_str": str(tweet_id), "full_text": text, "lang": lang,
+            "created_at": time.strftime('%a %b %d %H:%M:%S +0000 %Y', time.gmtime(1.6e9 + tweet_id % 3e7)),
+            "in_reply_to_status_id": in_reply_to_status_id,
+            "user": {"screen_name": screen_name or f"user_{rng.randrange(1000)}", "verified": False},
+            "entities": {"hashtags": [{"text": tag} for tag in hashtags], "user_mentions": [], "urls": []}}
+
+
+class FakeTwitter:
+    def __init__(self, page_latency=0.0, fail=(), fail_after=0, seed=0):
+        '''
+        Serves get_tweets_by_poi_screen_name, get_tweets_by_lang_and_keyword & get_replies, sleeping page_latency
+        seconds per page of tweets, & records the requests & the peak number of concurrent calls to each endpoint.
+        overlaps counts the pages of each endpoint fetched while a call to another endpoint was in progress.
+        :param fail: screen names & keywords for which the call raises a RuntimeError
+        :param fail_after: number of pages returned by those calls before failing
+        '''
+        self.page_latency, self.fail, self.fail_after, self.seed = page_latency, set(fail), fail_after, seed
+        self.lock = threading.Lock()
+        self.requests, self.active, self.peak_active, self.overlaps = Counter(), Counter(), Counter(), Counter()
+
+    def get_tweets_by_poi_screen_name(self, screen_name, count, max_id=None, on_page=None):
+        return self._get_tweets("user_timeline", screen_name, count, max_id, on_page, screen_name=screen_name)
+
+    def get_tweets_by_lang_and_keyword(self, keyword, lang, count, max_id=None, on_page=None):
+        return self._get_tweets("search", keyword, count, max_id, on_page, lang=lang)
+
+    def get_replies(self, screen_name, tweet_id, count, max_id=None, on_page=None):
+        # Replies to each of the tweets in turn
+        tweet_ids = [tweet_id] if isinstance(tweet_id, (int, str)) else sorted(tweet_id)
+        return self._get_tweets("replies", f"to:{screen_name}", count, max_id, on_page,
+                                replied_to=[int(tweet_id) for tweet_id in tweet_ids])
+
+    def _get_tweets(self, endpoint, query, count, max_id, on_page, screen_name=None, lang="en", replied_to=()):
+        with self.lock:
+            self.active[endpoint] += 1
+            self.peak_active[endpoint] = max(self.peak_active[endpoint], self.active[endpoint])
+        try:
+            tweet_id = random.Random(f"{self.seed}:{endpoint}:{query}").randrange(10 ** 12)
+            if max_id is not None:
+                tweet_id = min(tweet_id, max_id)
+            tweets = []
+            while len(tweets) < count:
+                if query in self.fail and len(tweets) >= self.fail_after * PAGE_SIZES[endpoint]:
+                    raise RuntimeError(f"simulated failure of {endpoint} for {query}")
+                time.sleep(self.page_latency)
+                with self.lock:
+                    self.requests[endpoint] += 1
+                    if any(active for other, active in self.active.items() if other != endpoint):
+                        self.overlaps[endpoint] += 1
+                page = [synthetic_tweet(tweet_id - k, random.Random(tweet_id - k), screen_name, lang,
+                                        replied_to[(len(tweets) + k) % len(replied_to)] if replied_to else None)
+                        for k in range(min(PAGE_SIZES[endpoint], count - len(tweets)))]
+                tweet_id -= len(page)
+                tweets += page
+                if on_page is not None:
+                    on_page(page, {"max_id": tweet_id})
+            return tweets
+        finally:
+            with self.lock:
+                self.active[endpoint] -= 1
+
+
+class SimulatedClock:
+    '''
+    Clock for twitter.Twitter on which sleeping returns at once, moving the time forward.
+    '''
+
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += max(seconds, 0)
+
+
+class MockAPI:
+    def __init__(self, clock, rate_limits=RATE_LIMITS, timeline_size=3200, search_size=5000, replies_size=200, seed=0):
+        '''
+        Stand-in for tweepy.API: user_timeline & search_tweets over deterministic sets of synthetic tweets, newest
+        first, honouring count, max_id & since_id. Searches of "to:<screen name>" are the reply lookups: every other
+        result replies to the since_id tweet.
+        Each endpoint enforces its rate limit in fixed windows of the clock starting with their first request, &
+        raises RateLimitExceeded over it. The reply lookups are charged to the search quota, as the real API does.
+        overlaps counts the (endpoint, exhausted endpoint) requests made while the quota of another endpoint was
+        used up for its window.
+        :param timeline_size: tweets of each POI, 3200 at most with the v1.1 API
+        :param search_size: tweets matching each keyword
+        :param replies_size: tweets to a POI newer than the tweet replied to
+        '''
+        self.clock, self.rate_limits, self.seed = clock, rate_limits, seed
+        self.sizes = {"user_timeline": timeline_size, "search": search_size, "replies": replies_size}
+        self.windows = {}
+        self.requests, self.rate_limited, self.overlaps = Counter(), Counter(), Counter()
+
+    def _charge(self, endpoint):
+        endpoint = SHARED_QUOTAS.get(endpoint, endpoint)
+        limit, window = self.rate_limits[endpoint]
+        now = self.clock.time()
+        window_start, used = self.windows.get(endpoint, (None, 0))
+        if window_start is None or now >= window_start + window:
+            window_start, used = now, 0
+        if used >= limit:
+            self.rate_limited[endpoint] += 1
+            raise RateLimitExceeded(f"rate limit of {endpoint} exceeded")
+        self.windows[endpoint] = (window_start, used + 1)
+        self.requests[endpoint] += 1
+        for other, (other_start, other_used) in self.windows.items():
+            if other != endpoint and now < other_start + self.rate_limits[other][1] and \
+                    other_used >= self.rate_limits[other][0]:
+                self.overlaps[endpoint, other] += 1
+
+    def _page(self, endpoint, query, count, max_id, since_id, lang="en", screen_name=None):
+        self._charge(endpoint)
+        rng = random.Random(f"{self.seed}:{endpoint}:{query}")
+        newest = rng.randrange(10 ** 12, 2 * 10 ** 12)
+        if endpoint == "replies":
+            newest = since_id + self.sizes[endpoint]
+        first = 0 if max_id is None else max(newest - max_id, 0)
+        last = self.sizes[endpoint] if since_id is None else min(newest - since_id, self.sizes[endpoint])
+        page = []
+        for k in range(first, min(first + min(count, PAGE_SIZES[endpoint]), last)):
+            tweet_id = newest - k
+            replied_to = since_id if endpoint == "replies" and k % 2 == 0 else None
+            page.append(synthetic_tweet(tweet_id, random.Random(tweet_id), screen_name, lang, replied_to))
+        return page
+
+    def user_timeline(self, screen_name, count=20, max_id=None, since_id=None, **params):
+        return self._page("user_timeline", screen_name, count, max_id, since_id, screen_name=screen_name)
+
+    def search_tweets(self, q, count=15, lang="en", max_id=None, since_id=None, **params):
+        endpoint = "replies" if q.startswith("to:") else "search"
+        return self._page(endpoint, q, count, max_id, since_id, lang)
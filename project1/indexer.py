@@ -4,6 +4,9 @@ Institute: University at Buffalo
 '''
 
 import os
+import re
+import time
+from itertools import islice
 import pysolr
 import requests
 
@@ -12,6 +15,9 @@ import requests
 
 CORE_NAME = "IRF21P1"
 AWS_IP = "localhost"
+BATCH_SIZE = 500
+# Status of the responses pysolr turns into a SolrError
+HTTP_STATUS = re.compile(r'\(HTTP (\d{3})\)')
 
 
 # [CAUTION] :: Run this script once, i.e. during core creation
@@ -28,16 +34,69 @@ def create_core(core=CORE_NAME):
 
 
 class Indexer:
-    def __init__(self):
-        self.solr_url = f'http://{AWS_IP}:8983/solr/'
-        self.connection = pysolr.Solr(self.solr_url + CORE_NAME, always_commit=True, timeout=5000000)
+    def __init__(self, solr_url=None, core=CORE_NAME, batch_size=BATCH_SIZE, commit_within=None, max_retries=3,
+                 retry_backoff=0.5):
+        '''
+        Documents are sent to Solr in batches of batch_size, over one pooled HTTP session, without committing each
+        batch. They are made visible either by Solr within commit_within milliseconds of being added, or, if
+        commit_within is None, by a single commit once all of them are sent.
+        A batch that fails on the connection, a timeout or a 5xx response is retried up to max_retries times, waiting
+        retry_backoff seconds, doubled every time. Other errors, e.g. a 4xx for a document the schema rejects, would
+        fail the same way again, & are raised at once.
+        :param solr_url: base url of Solr, defaults to the one on AWS_IP
+        '''
+        self.solr_url = f'http://{AWS_IP}:8983/solr/' if solr_url is None else solr_url
+        self.batch_size, self.commit_within = batch_size, commit_within
+        self.max_retries, self.retry_backoff = max_retries, retry_backoff
+        self.session = requests.Session()
+        self.session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self.connection = pysolr.Solr(self.solr_url + core, always_commit=False, timeout=5000000,
+                                      session=self.session)
 
     def do_initial_setup(self):
         delete_core()
         create_core()
 
     def create_documents(self, docs):
-        print(self.connection.add(docs))
+        print(self.bulk_index(docs))
+
+    def bulk_index(self, docs, commit=True):
+        '''
+        Streams the documents (any iterable of dicts) to Solr in batches, without loading them all in memory.
+        :param commit: commit once at the end, unless commit_within is set
+        :return: dict of the number of documents, batches & retries, and the throughput
+        '''
+        start = time.perf_counter()
+        docs = iter(docs)
+        stats = {"docs": 0, "batches": 0, "retries": 0}
+        batch = list(islice(docs, self.batch_size))
+        while batch:
+            stats["retries"] += self._add_batch(batch)
+            stats["docs"] += len(batch)
+            stats["batches"] += 1
+            batch = list(islice(docs, self.batch_size))
+        if commit and self.commit_within is None and stats["docs"]:
+            self.commit()
+        stats["seconds"] = time.perf_counter() - start
+        stats["docs_per_sec"] = stats["docs"] / stats["seconds"] if stats["seconds"] else 0.0
+        return stats
+
+    def _add_batch(self, batch):
+        '''
+        Adds a batch of documents, retrying with exponential backoff if Solr or the connection fails transiently.
+        :return: number of retries
+        '''
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.connection.add(batch, commit=False, commitWithin=self.commit_within)
+                return attempt
+            except (pysolr.SolrError, requests.exceptions.RequestException) as error:
+                if attempt == self.max_retries or not _is_transient(error):
+                    raise
+                time.sleep(self.retry_backoff * 2 ** attempt)
+
+    def commit(self):
+        self.connection.commit()
 
     def add_fields(self):
         '''
@@ -47,6 +106,21 @@ class Indexer:
         raise NotImplementedError
 
 
+def _is_transient(error):
+    '''
+    :return: whether a failed request may succeed if retried: connection errors, timeouts & 5xx responses
+    '''
+    # pysolr raises a SolrError from within its handler of the requests exception, or with the status in its message
+    cause = error if isinstance(error, requests.exceptions.RequestException) else error.__context__
+    if isinstance(cause, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    response = getattr(cause, 'response', None)
+    if response is not None:
+        return response.status_code >= 500
+    status = HTTP_STATUS.search(str(error))
+    return status is not None and int(status.group(1)) >= 500
+
+
 if __name__ == "__main__":
     i = Indexer()
     i.do_initial_setup()
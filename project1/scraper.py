@@ -4,93 +4,315 @@ Institute: University at Buffalo
 '''
 
 import json
-import datetime
+import os
+import queue
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import pandas as pd
-from twitter import Twitter
+from twitter import SHARED_QUOTAS, RepliesJob, SearchJob, TimelineJob, Twitter
 from tweet_preprocessor import TWPreprocessor
 from indexer import Indexer
 
 reply_collection_knob = False
+# Replies collected per POI, to any of its collected tweets
+replies_per_poi = 500
+# Milliseconds within which Solr commits the indexed tweets, instead of a hard commit per POI or keyword
+commit_within = 10000
+# Number of POIs or keywords fetched at once from each endpoint of the Twitter API, & in total
+endpoint_budgets = {"user_timeline": 2, "search": 2}
+fetch_workers = 4
+# Number of fetched or preprocessed POIs or keywords waiting for the next stage, before the previous one blocks
+queue_size = 4
 
+_DONE = object()
 
-def read_config():
-    with open("config.json") as json_file:
+
+def read_config(path="config.json"):
+    with open(path) as json_file:
         data = json.load(json_file)
 
     return data
 
 
-def write_config(data):
-    with open("config.json", 'w') as json_file:
-        json.dump(data, json_file)
+def write_config(data, path="config.json"):
+    # Written to a temporary file which then replaces the config, so that it is never left half written.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as json_file:
+            json.dump(data, json_file)
+            json_file.flush()
+            os.fsync(json_file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
 
 
-def save_file(data, filename):
+def save_file(data, filename, data_dir="data/"):
     df = pd.DataFrame(data)
-    df.to_pickle("data/" + filename)
-
+    df.to_pickle(data_dir + filename)
+
+
+def read_file(type, id, data_dir="data/"):
+    return pd.read_pickle(f"{data_dir}{type}_{id}.pkl")
+
+
+class Checkpoints:
+    def __init__(self, path="checkpoints.json", data_dir="data/"):
+        '''
+        Cursors of the collection jobs in progress, for a restart to resume each one where it stopped instead of
+        fetching its tweets again. After each request of a job, its tweets are appended to
+        <data_dir><key>.partial.jsonl, & then the cursor of its next request, the number of tweets it collected & the
+        size of that file are saved in the checkpoint file, rewritten atomically.
+        '''
+        self.path, self.data_dir = path, data_dir
+        self.lock = threading.Lock()
+        self.checkpoints = read_config(path) if os.path.exists(path) else {}
+
+    def _partial_path(self, key):
+        return f"{self.data_dir}{key}.partial.jsonl"
+
+    def resume(self, key):
+        '''
+        :return: the cursor to resume the job from, empty to start it over, & the tweets it collected so far
+        '''
+        with self.lock:
+            checkpoint = self.checkpoints.get(key)
+        if checkpoint is None:
+            return {}, []
+        try:
+            # Tweets appended after the last checkpoint are dropped, as they will be fetched again
+            os.truncate(self._partial_path(key), checkpoint["offset"])
+            with open(self._partial_path(key)) as partial_file:
+                return checkpoint["cursor"], [json.loads(line) for line in partial_file]
+        except FileNotFoundError:
+            return {}, []
+
+    def record(self, key, tweets, cursor):
+        '''
+        Saves the tweets of a request of the job, & the cursor of its next one.
+        '''
+        with self.lock:
+            checkpoint = self.checkpoints.get(key, {"collected": 0, "offset": 0})
+            with open(self._partial_path(key), 'a' if checkpoint["offset"] else 'w') as partial_file:
+                partial_file.writelines(json.dumps(tweet) + '\n' for tweet in tweets)
+                partial_file.flush()
+                os.fsync(partial_file.fileno())
+                offset = partial_file.tell()
+            self.checkpoints[key] = {"cursor": cursor, "collected": checkpoint["collected"] + len(tweets),
+                                     "offset": offset}
+            write_config(self.checkpoints, self.path)
+
+    def finish(self, key):
+        with self.lock:
+            if self.checkpoints.pop(key, None) is not None:
+                write_config(self.checkpoints, self.path)
+        if os.path.exists(self._partial_path(key)):
+            os.remove(self._partial_path(key))
+
+
+class CollectionPipeline:
+    def __init__(self, twitter, indexer, config, preprocess=TWPreprocessor.preprocess_many, budgets=None,
+                 fetch_workers=fetch_workers, queue_size=queue_size, config_path="config.json", data_dir="data/",
+                 checkpoint_path="checkpoints.json", replies=False):
+        '''
+        Collects the tweets of the unfinished POIs & keywords of the config in 3 stages connected by bounded queues:
+        fetching from Twitter, a thread preprocessing the tweets, & a thread indexing & saving them, which marks each
+        POI or keyword as finished in the config file as soon as it is done.
+        A client with a collect method, as twitter.Twitter, fetches all the jobs in a single Twitter.collect, which
+        interleaves their requests within the rate limits. Otherwise, a pool of budgets[endpoint] threads per
+        endpoint fetches them, at most fetch_workers at once in total. Each endpoint has its own pool, so that the
+        jobs of one never wait in a queue behind those of the other.
+        A POI or keyword failing at any stage is reported & left unfinished, for the next run, which resumes its
+        collection from the Checkpoints saved after each request.
+        :param twitter: client with the methods of twitter.Twitter, e.g. fake_twitter.FakeTwitter
+        :param preprocess: function from a list of raw tweets to the documents to index
+        :param checkpoint_path: file of the Checkpoints, None not to checkpoint
+        :param replies: collect the replies to the saved tweets of the finished POIs, up to replies_per_poi each,
+        instead, & mark them reply_finished
+        '''
+        self.twitter, self.indexer, self.config, self.preprocess = twitter, indexer, config, preprocess
+        budgets = endpoint_budgets if budgets is None else budgets
+        self.budgets, self.fetch_workers, self.queue_size = dict(budgets), fetch_workers, queue_size
+        self.fetch_slots = threading.BoundedSemaphore(fetch_workers)
+        self.config_path, self.data_dir = config_path, data_dir
+        self.checkpoints = Checkpoints(checkpoint_path, data_dir) if checkpoint_path is not None else None
+        self.replies = replies
+        self.errors = []
+
+    def jobs(self):
+        '''
+        :return: list of (type, endpoint, config item) of the unfinished POIs & keywords, or reply collections
+        '''
+        if self.replies:
+            return [("replies", "replies", poi) for poi in self.config["pois"]
+                    if poi["finished"] == 1 and poi.get("reply_finished", 0) == 0]
+        return [("poi", "user_timeline", poi) for poi in self.config["pois"] if poi["finished"] == 0] + \
+            [("keywords", "search", keyword) for keyword in self.config["keywords"] if keyword["finished"] == 0]
+
+    def run(self):
+        '''
+        :return: dict of the number of finished & failed POIs & keywords, tweets indexed & seconds taken
+        '''
+        start = time.perf_counter()
+        jobs = self.jobs()
+        fetched, processed = queue.Queue(self.queue_size), queue.Queue(self.queue_size)
+        stats = {"finished": 0, "failed": 0, "tweets": 0}
+        stages = [threading.Thread(target=self._preprocess_stage, args=(fetched, processed), daemon=True),
+                  threading.Thread(target=self._index_stage, args=(processed, stats), daemon=True)]
+        for stage in stages:
+            stage.start()
+        if hasattr(self.twitter, 'collect'):
+            self._collect(jobs, fetched)
+        else:
+            executors = {endpoint: ThreadPoolExecutor(max_workers=budget, thread_name_prefix=f"fetch-{endpoint}")
+                         for endpoint, budget in self.budgets.items()}
+            try:
+                for job in jobs:
+                    executors[SHARED_QUOTAS.get(job[1], job[1])].submit(self._fetch, job, fetched)
+            finally:
+                for executor in executors.values():
+                    executor.shutdown()
+        fetched.put(_DONE)
+        for stage in stages:
+            stage.join()
+        if stats["tweets"] and self.indexer.commit_within is None:
+            self.indexer.commit()
+        stats["failed"] = len(jobs) - stats["finished"]
+        stats["seconds"] = time.perf_counter() - start
+        return stats
+
+    def _resume(self, job):
+        '''
+        :return: the checkpoint key of the job, the cursor to resume it from, the tweets collected so far & the
+        number of tweets left to collect
+        '''
+        type, _, item = job
+        key = f"{type}_{item['id']}"
+        cursor, raw_tweets = self.checkpoints.resume(key) if self.checkpoints is not None else ({}, [])
+        resumed = f", resumed after {len(raw_tweets)} tweets" if cursor else ""
+        count = replies_per_poi if type == "replies" else item["count"]
+        if count > len(raw_tweets):
+            name = item["name"] if type == "keywords" else item["screen_name"]
+            print(f"---------- collecting {'replies' if type == 'replies' else 'tweets'} for {type}: {name}{resumed}")
+        return key, cursor, raw_tweets, count - len(raw_tweets)
+
+    def _replied_tweet_ids(self, item):
+        return [int(tweet_id) for tweet_id in read_file("poi", item["id"], self.data_dir)["id"]]
+
+    def _collect(self, jobs, fetched):
+        # Runs all the jobs in a Twitter.collect, as CollectionJobs
+        pending = {}
+        for job in jobs:
+            type, _, item = job
+            try:
+                key, cursor, raw_tweets, count = self._resume(job)
+                if count <= 0:
+                    fetched.put((job, raw_tweets))
+                    continue
+                if type == "poi":
+                    collection_job = TimelineJob(item["screen_name"], count, cursor.get("max_id"))
+                elif type == "keywords":
+                    collection_job = SearchJob(item["name"], item["lang"], count, cursor.get("max_id"))
+                else:
+                    collection_job = RepliesJob(item["screen_name"], self._replied_tweet_ids(item), count,
+                                                cursor.get("max_id"))
+            except Exception as error:
+                self._fail(job, "fetch", error)
+                continue
+            pending[collection_job] = (job, key, raw_tweets)
+
+        def on_page(collection_job, tweets):
+            if self.checkpoints is not None:
+                self.checkpoints.record(pending[collection_job][1], tweets, collection_job.cursor())
+
+        def on_done(collection_job):
+            job, _, raw_tweets = pending.pop(collection_job)
+            if collection_job.error is not None:
+                self._fail(job, "fetch", collection_job.error)
+            else:
+                fetched.put((job, raw_tweets + collection_job.tweets))
+
+        self.twitter.collect(list(pending), on_done=on_done, on_page=on_page)
+
+    def _fetch(self, job, fetched):
+        type, endpoint, item = job
+        try:
+            key, cursor, raw_tweets, count = self._resume(job)
+            on_page = partial(self.checkpoints.record, key) if self.checkpoints is not None else None
+            if count > 0:
+                with self.fetch_slots:
+                    if type == "poi":
+                        raw_tweets += self.twitter.get_tweets_by_poi_screen_name(
+                            item["screen_name"], count, cursor.get("max_id"), on_page)
+                    elif type == "keywords":
+                        raw_tweets += self.twitter.get_tweets_by_lang_and_keyword(
+                            item["name"], item["lang"], count, cursor.get("max_id"), on_page)
+                    else:
+                        raw_tweets += self.twitter.get_replies(
+                            item["screen_name"], self._replied_tweet_ids(item), count, cursor.get("max_id"), on_page)
+        except Exception as error:
+            self._fail(job, "fetch", error)
+            return
+        fetched.put((job, raw_tweets))
+
+    def _preprocess_stage(self, fetched, processed):
+        while True:
+            entry = fetched.get()
+            if entry is _DONE:
+                processed.put(_DONE)
+                return
+            job, raw_tweets = entry
+            try:
+                processed_tweets = self.preprocess(raw_tweets)
+            except Exception as error:
+                self._fail(job, "preprocess", error)
+                continue
+            processed.put((job, processed_tweets))
+
+    def _index_stage(self, processed, stats):
+        # The only thread updating the config, so that its writes are never interleaved.
+        while True:
+            entry = processed.get()
+            if entry is _DONE:
+                return
+            (type, _, item), processed_tweets = entry
+            try:
+                self.indexer.bulk_index(processed_tweets, commit=False)
+                save_file(processed_tweets, f"{type}_{item['id']}.pkl", self.data_dir)
+            except Exception as error:
+                self._fail(entry[0], "index", error)
+                continue
+            if type == "replies":
+                item["reply_finished"], item["replies_collected"] = 1, len(processed_tweets)
+            else:
+                item["finished"], item["collected"] = 1, len(processed_tweets)
+            write_config(self.config, self.config_path)
+            if self.checkpoints is not None:
+                self.checkpoints.finish(f"{type}_{item['id']}")
+            stats["finished"] += 1
+            stats["tweets"] += len(processed_tweets)
+            print("------------ process complete -----------------------------------")
 
-def read_file(type, id):
-    return pd.read_pickle(f"data/{type}_{id}.pkl")
+    def _fail(self, job, stage, error):
+        type, _, item = job
+        self.errors.append((type, item["id"], stage, error))
+        print(f"---------- {stage} failed for {type} {item['id']}: {error!r}")
 
 
 def main():
     config = read_config()
-    indexer = Indexer()
+    indexer = Indexer(commit_within=commit_within)
     twitter = Twitter()
 
-    pois = config["pois"]
-    keywords = config["keywords"]
-
-    for i in range(len(pois)):
-        if pois[i]["finished"] == 0:
-            print(f"---------- collecting tweets for poi: {pois[i]['screen_name']}")
-
-            raw_tweets = twitter.get_tweets_by_poi_screen_name()  # pass args as needed
-
-            processed_tweets = []
-            for tw in raw_tweets:
-                processed_tweets.append(TWPreprocessor.preprocess(tw))
-
-            indexer.create_documents(processed_tweets)
-
-            pois[i]["finished"] = 1
-            pois[i]["collected"] = len(processed_tweets)
-
-            write_config({
-                "pois": pois, "keywords": keywords
-            })
-
-            save_file(processed_tweets, f"poi_{pois[i]['id']}.pkl")
-            print("------------ process complete -----------------------------------")
-
-    for i in range(len(keywords)):
-        if keywords[i]["finished"] == 0:
-            print(f"---------- collecting tweets for keyword: {keywords[i]['name']}")
-
-            raw_tweets = twitter.get_tweets_by_lang_and_keyword()  # pass args as needed
-
-            processed_tweets = []
-            for tw in raw_tweets:
-                processed_tweets.append(TWPreprocessor.preprocess(tw))
-
-            indexer.create_documents(processed_tweets)
-
-            keywords[i]["finished"] = 1
-            keywords[i]["collected"] = len(processed_tweets)
-
-            write_config({
-                "pois": pois, "keywords": keywords
-            })
-
-            save_file(processed_tweets, f"keywords_{keywords[i]['id']}.pkl")
-
-            print("------------ process complete -----------------------------------")
+    print(CollectionPipeline(twitter, indexer, config).run())
 
     if reply_collection_knob:
-        # Write a driver logic for reply collection, use the tweets from the data files for which the replies are to collected.
-
-        raise NotImplementedError
+        # Replies to the tweets saved in the data files of the POIs finished by now
+        print(CollectionPipeline(twitter, indexer, config, replies=True).run())
 
 
 if __name__ == "__main__":
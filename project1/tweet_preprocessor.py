@@ -4,22 +4,90 @@ Institute: University at Buffalo
 '''
 
 import demoji, re, datetime
+from functools import lru_cache
+import pandas as pd
 import preprocessor
 
 
 # demoji.download_codes()
 
+EMOTICONS_HAPPY = [
+    ':-)', ':)', ';)', ':o)', ':]', ':3', ':c)', ':>', '=]', '8)', '=)', ':}',
+    ':^)', ':-D', ':D', '8-D', '8D', 'x-D', 'xD', 'X-D', 'XD', '=-D', '=D',
+    '=-3', '=3', ':-))', ":'-)", ":')", ':*', ':^*', '>:P', ':-P', ':P', 'X-P',
+    'x-p', 'xp', 'XP', ':-p', ':p', '=p', ':-b', ':b', '>:)', '>;)', '>:-)',
+    '<3'
+]
+EMOTICONS_SAD = [
+    ':L', ':-/', '>:/', ':S', '>:[', ':@', ':-(', ':[', ':-||', '=L', ':<',
+    ':-[', ':-<', '=\\', '=/', '>:(', ':(', '>.<', ":'-(", ":'(", ':\\', ':-c',
+    ':c', ':{', '>:\\', ';('
+]
+TWEET_DATE_FORMAT = '%a %b %d %H:%M:%S +0000 %Y'
+SOLR_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+# Languages with a text_<lang> field
+TEXT_LANGS = ('en', 'hi', 'es')
+
 
 class TWPreprocessor:
     @classmethod
     def preprocess(cls, tweet):
         '''
         Do tweet pre-processing before indexing, make sure all the field data types are in the format as asked in the project doc.
-        :param tweet:
+        :param tweet: raw tweet, as a dict
         :return: dict
         '''
+        tweet_date = _get_tweet_date(tweet["created_at"]).strftime(SOLR_DATE_FORMAT)
+        return _document(tweet, *_text_cleaner(_get_text(tweet)), tweet_date)
 
-        raise NotImplementedError
+    @classmethod
+    def preprocess_many(cls, tweets):
+        '''
+        Same as preprocess for a batch of tweets, parsing & rounding all of their dates at once with pandas.
+        :param tweets: list of raw tweets, or DataFrame with a raw tweet per row
+        :return: list of dict
+        '''
+        if isinstance(tweets, pd.DataFrame):
+            tweets = tweets.to_dict('records')
+        if not len(tweets):
+            return []
+        dates = pd.to_datetime(pd.Series([tweet["created_at"] for tweet in tweets]), format=TWEET_DATE_FORMAT)
+        # Rounded as _hour_rounder does, half an hour up, whatever the seconds
+        dates = dates.dt.floor('h') + pd.to_timedelta((dates.dt.minute >= 30).astype(int), unit='h')
+        return [_document(tweet, *_text_cleaner(_get_text(tweet)), tweet_date)
+                for tweet, tweet_date in zip(tweets, dates.dt.strftime(SOLR_DATE_FORMAT))]
+
+
+def _document(tweet, clean_text, emojis, tweet_date):
+    lang = tweet["lang"]
+    doc = {"id": tweet["id_str"], "verified": bool(tweet["user"]["verified"]), "tweet_text": _get_text(tweet),
+           "tweet_lang": lang, "hashtags": _get_entities(tweet, 'hashtags'),
+           "mentions": _get_entities(tweet, 'mentions'), "tweet_urls": _get_entities(tweet, 'urls'),
+           "tweet_emoticons": emojis, "tweet_date": tweet_date}
+    if lang in TEXT_LANGS:
+        doc[f"text_{lang}"] = clean_text
+    replied_to_tweet_id = _get_id_str(tweet, 'in_reply_to_status_id')
+    if replied_to_tweet_id is not None:
+        doc["replied_to_tweet_id"] = replied_to_tweet_id
+        doc["replied_to_user_id"] = _get_id_str(tweet, 'in_reply_to_user_id')
+    return doc
+
+
+def _get_text(tweet):
+    # full_text with tweet_mode='extended'
+    text = tweet.get("full_text")
+    return text if isinstance(text, str) else tweet["text"]
+
+
+def _get_id_str(tweet, field):
+    # The *_str fields are exact, where ids in DataFrame columns with missing values become floats
+    value = tweet.get(field + '_str')
+    if not isinstance(value, str):
+        value = tweet.get(field)
+        if value is None or value != value:
+            return None
+        value = str(int(value))
+    return value
 
 
 def _get_entities(tweet, type=None):
@@ -43,38 +111,90 @@ def _get_entities(tweet, type=None):
     return result
 
 
+def _trie_pattern(strings):
+    # Regex of the strings as a trie, which matches the longest one, like an alternation sorted longest first, but
+    # only tries the branches of the next character instead of every string.
+    trie = {}
+    for string in strings:
+        node = trie
+        for char in string:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        pattern = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        return f'(?:{pattern})?' if '' in node else pattern
+
+    return build(trie)
+
+
+def _first_char_class(strings, gap=256):
+    # Character class of the first characters of the strings, to skip the other positions at once. The non ASCII
+    # ones are merged into ranges when less than gap apart: the class is checked range by range above U+FFFF.
+    ascii_chars = sorted({string[0] for string in strings if string[0].isascii()})
+    ranges = []
+    for point in sorted({ord(string[0]) for string in strings if not string[0].isascii()}):
+        if ranges and point - ranges[-1][1] <= gap:
+            ranges[-1][1] = point
+        else:
+            ranges.append([point, point])
+    return '[' + ''.join(map(re.escape, ascii_chars)) + ''.join(
+        re.escape(chr(first)) + ('-' + re.escape(chr(last)) if last > first else '') for first, last in ranges) + ']'
+
+
+def _alternation(strings):
+    return f'(?={_first_char_class(strings)})({_trie_pattern(strings)})'
+
+
+@lru_cache(maxsize=None)
+def _emoji_pattern():
+    '''
+    :return: compiled regex matching the emojis in group 1 & the emoticons in group 2, in a single scan of a text, or
+    None if demoji does not expose its emoji codes
+    '''
+    # demoji keeps its emoji codes private, loaded by set_emoji_pattern in the versions before 2.0: another version
+    # may not have them, & is then used through findall_list & replace.
+    if hasattr(demoji, 'set_emoji_pattern'):
+        demoji.set_emoji_pattern()
+    codes = getattr(demoji, '_CODE_TO_DESC', None)
+    if not codes:
+        return None
+    return re.compile(f'{_alternation(list(codes))}|{_alternation(EMOTICONS_HAPPY + EMOTICONS_SAD)}')
+
+
+@lru_cache(maxsize=None)
+def _emoticon_pattern():
+    return re.compile(_alternation(EMOTICONS_HAPPY + EMOTICONS_SAD))
+
+
 def _text_cleaner(text):
-    emoticons_happy = list([
-        ':-)', ':)', ';)', ':o)', ':]', ':3', ':c)', ':>', '=]', '8)', '=)', ':}',
-        ':^)', ':-D', ':D', '8-D', '8D', 'x-D', 'xD', 'X-D', 'XD', '=-D', '=D',
-        '=-3', '=3', ':-))', ":'-)", ":')", ':*', ':^*', '>:P', ':-P', ':P', 'X-P',
-        'x-p', 'xp', 'XP', ':-p', ':p', '=p', ':-b', ':b', '>:)', '>;)', '>:-)',
-        '<3'
-    ])
-    emoticons_sad = list([
-        ':L', ':-/', '>:/', ':S', '>:[', ':@', ':-(', ':[', ':-||', '=L', ':<',
-        ':-[', ':-<', '=\\', '=/', '>:(', ':(', '>.<', ":'-(", ":'(", ':\\', ':-c',
-        ':c', ':{', '>:\\', ';('
-    ])
-    all_emoticons = emoticons_happy + emoticons_sad
-
-    emojis = list(demoji.findall(text).keys())
-    clean_text = demoji.replace(text, '')
-
-    for emo in all_emoticons:
-        if (emo in clean_text):
-            clean_text = clean_text.replace(emo, '')
-            emojis.append(emo)
+    # Emojis, then emoticons, each once, in order of appearance. Emoticons are matched longest first, & not inside
+    # emojis.
+    emojis, emoticons = {}, {}
+    pattern = _emoji_pattern()
+    if pattern is None:
+        found = demoji.findall_list(text, desc=False) if hasattr(demoji, 'findall_list') else demoji.findall(text)
+        emojis = dict.fromkeys(found)
+        emoticons = dict.fromkeys(_emoticon_pattern().findall(demoji.replace(text, ' ')))
+    else:
+        for emoji, emoticon in pattern.findall(text):
+            if emoji:
+                emojis[emoji] = None
+            else:
+                emoticons[emoticon] = None
 
     clean_text = preprocessor.clean(text)
     # preprocessor.set_options(preprocessor.OPT.EMOJI, preprocessor.OPT.SMILEY)
     # emojis= preprocessor.parse(text)
 
-    return clean_text, emojis
+    return clean_text, list(emojis) + list(emoticons)
 
 
 def _get_tweet_date(tweet_date):
-    return _hour_rounder(datetime.datetime.strptime(tweet_date, '%a %b %d %H:%M:%S +0000 %Y'))
+    return _hour_rounder(datetime.datetime.strptime(tweet_date, TWEET_DATE_FORMAT))
 
 
 def _hour_rounder(t):
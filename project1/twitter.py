@@ -3,14 +3,202 @@
 Institute: University at Buffalo
 '''
 
+import threading
+import time
+from collections import Counter, defaultdict, deque
 import tweepy
 
+# Requests allowed per window (in seconds) on each endpoint, with user authentication
+RATE_LIMITS = {"user_timeline": (900, 900), "search": (180, 900)}
+# Endpoints of jobs charged to the quota of another one: replies are looked up with the search API
+SHARED_QUOTAS = {"replies": "search"}
+# Most tweets returned per request
+PAGE_SIZES = {"user_timeline": 200, "search": 100, "replies": 100}
+
+
+class RateLimitExceeded(Exception):
+    '''
+    Raised by stand-ins of tweepy.API when a request is over the rate limit, as tweepy's own errors are.
+    '''
+
+
+RATE_LIMIT_ERRORS = tuple(error for error in (getattr(tweepy, 'TooManyRequests', None),
+                                              getattr(tweepy, 'RateLimitError', None)) if error is not None) + \
+    (RateLimitExceeded,)
+
+
+class Clock:
+    def time(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class TokenBucket:
+    def __init__(self, capacity, window, clock):
+        '''
+        Quota of requests of an endpoint: capacity tokens, refilled all at once window seconds after the first one
+        of the window is taken, as Twitter resets its limits. Refilling continuously would let a burst followed by
+        the trickle of new tokens go over the limit of a window.
+        '''
+        self.capacity, self.window, self.clock = capacity, window, clock
+        self.tokens, self.reset_at = capacity, None
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        if self.reset_at is not None and now >= self.reset_at:
+            self.tokens, self.reset_at = self.capacity, None
+
+    def try_acquire(self):
+        '''
+        :return: whether a token was taken, without waiting
+        '''
+        with self.lock:
+            now = self.clock.time()
+            self._refill(now)
+            if not self.tokens:
+                return False
+            if self.reset_at is None:
+                self.reset_at = now + self.window
+            self.tokens -= 1
+            return True
+
+    def available_at(self):
+        '''
+        :return: clock time from which a token can be taken
+        '''
+        with self.lock:
+            now = self.clock.time()
+            self._refill(now)
+            return now if self.tokens else self.reset_at
+
+    def exhaust(self, reset_at=None):
+        '''
+        Takes the tokens left, when the API says the quota is used up, until reset_at or the end of a window.
+        '''
+        with self.lock:
+            now = self.clock.time()
+            self._refill(now)
+            self.tokens = 0
+            self.reset_at = max(self.reset_at or now, now + self.window if reset_at is None else reset_at)
+
+
+class CollectionJob:
+    endpoint = None
+
+    def __init__(self, count, max_id=None, since_id=None):
+        '''
+        Paginated collection of count tweets, newest first: each request asks for the tweets older than max_id, &
+        newer than since_id if set.
+        '''
+        self.count, self.max_id, self.since_id = count, max_id, since_id
+        self.tweets, self.requests = [], 0
+        self.done, self.error = False, None
+
+    def request(self, twitter, page_size):
+        raise NotImplementedError
+
+    def keep(self, tweet):
+        return True
+
+    def cursor(self):
+        '''
+        :return: dict of the max_id & since_id of the next request, those set
+        '''
+        return {key: value for key, value in (("max_id", self.max_id), ("since_id", self.since_id))
+                if value is not None}
+
+    def fetch_page(self, twitter):
+        '''
+        Makes the next request of the job.
+        :return: number of tweets collected
+        '''
+        page_size = min(PAGE_SIZES[self.endpoint], self.count - len(self.tweets))
+        statuses = [getattr(status, '_json', status) for status in self.request(twitter, page_size)]
+        self.requests += 1
+        if statuses:
+            self.max_id = min(status["id"] for status in statuses) - 1
+        kept = [status for status in statuses if self.keep(status)][:self.count - len(self.tweets)]
+        self.tweets += kept
+        self.done = not statuses or len(self.tweets) >= self.count
+        return len(kept)
+
+
+class TimelineJob(CollectionJob):
+    endpoint = "user_timeline"
+
+    def __init__(self, screen_name, count, max_id=None, since_id=None):
+        super().__init__(count, max_id, since_id)
+        self.screen_name = screen_name
+
+    def request(self, twitter, page_size):
+        return twitter.api.user_timeline(screen_name=self.screen_name, count=page_size, tweet_mode='extended',
+                                         **self.cursor())
+
+
+class SearchJob(CollectionJob):
+    endpoint = "search"
+
+    def __init__(self, keyword, lang, count, max_id=None, since_id=None):
+        super().__init__(count, max_id, since_id)
+        self.keyword, self.lang = keyword, lang
+
+    def request(self, twitter, page_size):
+        return twitter.search(q=self.keyword, lang=self.lang, count=page_size, result_type='recent',
+                              tweet_mode='extended', **self.cursor())
+
+
+class RepliesJob(CollectionJob):
+    endpoint = "replies"
+
+    def __init__(self, screen_name, tweet_id, count, max_id=None):
+        '''
+        :param tweet_id: id of the tweet of the POI, or ids of several of its tweets, to collect the replies to any of
+        them in a single search
+        '''
+        self.tweet_ids = {int(tweet_id)} if isinstance(tweet_id, (int, str)) else set(map(int, tweet_id))
+        # Replies are newer than the tweets
+        super().__init__(count, max_id, since_id=min(self.tweet_ids))
+        self.screen_name = screen_name
+
+    def request(self, twitter, page_size):
+        # Searches the tweets to the POI, of which only the replies to the tweet are kept
+        return twitter.search(q=f'to:{self.screen_name}', count=PAGE_SIZES[self.endpoint], result_type='recent',
+                              tweet_mode='extended', **self.cursor())
+
+    def keep(self, tweet):
+        return tweet.get("in_reply_to_status_id") in self.tweet_ids
+
 
 class Twitter:
-    def __init__(self):
-        self.auth = tweepy.OAuthHandler("", "")
-        self.auth.set_access_token("", "")
-        self.api = tweepy.API(self.auth, wait_on_rate_limit=True, wait_on_rate_limit_notify=True)
+    def __init__(self, api=None, clock=None, buckets=None):
+        '''
+        Requests are scheduled against a TokenBucket per endpoint instead of tweepy's wait_on_rate_limit, which
+        sleeps the whole process as soon as any endpoint runs out of quota.
+        :param api: tweepy.API, or a stand-in with the same methods, e.g. fake_twitter.MockAPI
+        :param clock: object with time() & sleep(seconds), e.g. fake_twitter.SimulatedClock
+        :param buckets: dict of endpoint to TokenBucket, defaults to one per RATE_LIMITS, which the endpoints of
+        SHARED_QUOTAS share
+        '''
+        if api is None:
+            self.auth = tweepy.OAuthHandler("", "")
+            self.auth.set_access_token("", "")
+            api = tweepy.API(self.auth)
+        self.api = api
+        self.clock = Clock() if clock is None else clock
+        if buckets is None:
+            buckets = {endpoint: TokenBucket(limit, window, self.clock) for endpoint, (limit, window) in
+                       RATE_LIMITS.items()}
+            buckets.update((endpoint, buckets[quota]) for endpoint, quota in SHARED_QUOTAS.items())
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.stats, self.started = defaultdict(Counter), None
+
+    def search(self, **params):
+        # search_tweets since tweepy 4
+        search = getattr(self.api, 'search_tweets', None) or self.api.search
+        return search(**params)
 
     def _meet_basic_tweet_requirements(self):
         '''
@@ -19,24 +207,114 @@ class Twitter:
         '''
         raise NotImplementedError
 
-    def get_tweets_by_poi_screen_name(self):
+    def get_tweets_by_poi_screen_name(self, screen_name, count, max_id=None, on_page=None):
         '''
         Use user_timeline api to fetch POI related tweets, some postprocessing may be required.
+        :param screen_name: screen name of the POI
+        :param count: number of tweets to collect
+        :param max_id: resume from this cursor
+        :param on_page: called after each request with the tweets collected & the cursor of the next request
         :return: List
         '''
-        raise NotImplementedError
+        return self._collect_one(TimelineJob(screen_name, count, max_id), on_page)
 
-    def get_tweets_by_lang_and_keyword(self):
+    def get_tweets_by_lang_and_keyword(self, keyword, lang, count, max_id=None, on_page=None):
         '''
         Use search api to fetch keywords and language related tweets, use tweepy Cursor.
+        :param keyword: search query
+        :param lang: language of the tweets
+        :param count: number of tweets to collect
+        :param max_id: resume from this cursor
+        :param on_page: called after each request with the tweets collected & the cursor of the next request
         :return: List
         '''
-        raise NotImplementedError
+        return self._collect_one(SearchJob(keyword, lang, count, max_id), on_page)
 
-    def get_replies(self):
+    def get_replies(self, screen_name, tweet_id, count, max_id=None, on_page=None):
         '''
         Get replies for a particular tweet_id, use max_id and since_id.
         For more info: https://developer.twitter.com/en/docs/twitter-api/v1/tweets/timelines/guides/working-with-timelines
+        :param screen_name: screen name of the author of the tweet
+        :param tweet_id: id of the tweet, or ids of several tweets of the author, see RepliesJob
+        :param count: number of replies to collect
+        :param max_id: resume from this cursor
+        :param on_page: called after each request with the replies collected & the cursor of the next request
         :return: List
         '''
-        raise NotImplementedError
+        return self._collect_one(RepliesJob(screen_name, tweet_id, count, max_id), on_page)
+
+    def _collect_one(self, job, on_page=None):
+        self.collect([job], on_page=None if on_page is None else lambda job, tweets: on_page(tweets, job.cursor()))
+        if job.error is not None:
+            raise job.error
+        return job.tweets
+
+    def collect(self, jobs, on_done=None, on_page=None):
+        '''
+        Runs collection jobs, interleaving their requests: each round makes the next request of every job whose
+        endpoint has quota left, so that jobs on the other endpoints go on while one is exhausted, & sleeps only
+        when the endpoints of all the jobs left are. A job which fails is done, with its error.
+        Requests are made one at a time: the rate limits, not the latency, bound the throughput of a client.
+        :param on_done: called with each job as soon as it is done
+        :param on_page: called with the job & the tweets collected after each of its requests, e.g. to checkpoint
+        its cursor
+        :return: the jobs
+        '''
+        pending = deque(jobs)
+        while pending:
+            progressed = False
+            for _ in range(len(pending)):
+                job = pending.popleft()
+                bucket = self.buckets[job.endpoint]
+                if not bucket.try_acquire():
+                    pending.append(job)
+                    continue
+                progressed = True
+                if self.started is None:
+                    self.started = self.clock.time()
+                try:
+                    n_tweets = job.fetch_page(self)
+                except RATE_LIMIT_ERRORS as error:
+                    bucket.exhaust(self._reset_at(error))
+                    self._record(job.endpoint, rate_limited=1)
+                    pending.append(job)
+                    continue
+                except Exception as error:
+                    job.error, job.done = error, True
+                    self._record(job.endpoint, requests=1, errors=1)
+                else:
+                    self._record(job.endpoint, requests=1, tweets=n_tweets)
+                    if on_page is not None:
+                        on_page(job, job.tweets[len(job.tweets) - n_tweets:])
+                if not job.done:
+                    pending.append(job)
+                elif on_done is not None:
+                    on_done(job)
+            if not progressed:
+                wake_at = min(self.buckets[job.endpoint].available_at() for job in pending)
+                self.clock.sleep(max(wake_at - self.clock.time(), 0))
+        return jobs
+
+    def _reset_at(self, error):
+        # tweepy 4 errors carry the response, with the epoch time at which the quota is reset
+        try:
+            return self.clock.time() + int(error.response.headers['x-rate-limit-reset']) - time.time()
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return None
+
+    def _record(self, endpoint, **counts):
+        with self.lock:
+            self.stats[endpoint].update(counts)
+
+    def rate_stats(self):
+        '''
+        :return: dict of endpoint to its requests, tweets & rate limited requests so far, & the tweets collected
+        per window of its rate limit
+        '''
+        elapsed = self.clock.time() - self.started if self.started is not None else 0.0
+        with self.lock:
+            stats = {endpoint: dict(counts) for endpoint, counts in self.stats.items()}
+        for endpoint, counts in stats.items():
+            # A window started counts as a whole one
+            counts["tweets_per_window"] = counts.get("tweets", 0) / max(elapsed / self.buckets[endpoint].window, 1)
+        return stats
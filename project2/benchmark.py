@@ -0,0 +1,700 @@
+'''
+Benchmarks for the project 2 index and postings lists.
+Usage: python3 benchmark.py {postings,indexing,merge,ranking,compression,phrase,boolean,load,skips} --corpus ./data/input_corpus.txt
+'''
+
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+from bisect import bisect_left
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from itertools import accumulate
+from preprocessor import Preprocessor
+from indexer import Indexer
+from linkedlist import Node, NodeLinkedList
+from run_project import ProjectRunner
+from query_cache import QueryCache
+from compressed_postings import CompressedDocIds
+from query_planner import parse_query
+from skip_policy import AdaptiveSkipPolicy
+
+
+def _build_index(corpus):
+    preprocessor, indexer = Preprocessor(), Indexer()
+    with open(corpus, 'r') as fp:
+        for line in fp:
+            doc_id, document = preprocessor.get_doc_id(line)
+            indexer.generate_inverted_index(doc_id, preprocessor.tokenizer(document))
+    indexer.sort_terms()
+    indexer.add_skip_connections()
+    return indexer.get_index()
+
+
+def _build_node_list(doc_ids):
+    """ Links Node objects for already sorted doc ids, without the quadratic insert_at_end."""
+    llist = NodeLinkedList()
+    previous = None
+    for doc_id in doc_ids:
+        node = Node(doc_id)
+        if previous is None:
+            llist.start_node = node
+        else:
+            previous.next = node
+        previous = node
+    llist.end_node = previous
+    llist.length = len(doc_ids)
+    return llist
+
+
+def _intersect_nodes(p1, p2):
+    result, n1, n2 = [], p1.start_node, p2.start_node
+    if n1 is None or n2 is None:
+        return result
+    v1, v2 = n1.value, n2.value
+    while True:
+        if v1 == v2:
+            result.append(v1)
+            n1, n2 = n1.next, n2.next
+            if n1 is None or n2 is None:
+                return result
+            v1, v2 = n1.value, n2.value
+        elif v1 < v2:
+            n1 = n1.next
+            if n1 is None:
+                return result
+            v1 = n1.value
+        else:
+            n2 = n2.next
+            if n2 is None:
+                return result
+            v2 = n2.value
+
+
+def _intersect_arrays(p1, p2):
+    result, it1, it2 = [], iter(p1.doc_ids), iter(p2.doc_ids)
+    try:
+        v1, v2 = next(it1), next(it2)
+        while True:
+            if v1 == v2:
+                result.append(v1)
+                v1, v2 = next(it1), next(it2)
+            elif v1 < v2:
+                v1 = next(it1)
+            else:
+                v2 = next(it2)
+    except StopIteration:
+        return result
+
+
+def _intersect_arrays_bisect(p1, p2):
+    """ Walks the shorter list, and binary searches the longer one from the last match position."""
+    short, long = (p1.doc_ids, p2.doc_ids) if p1.length <= p2.length else (p2.doc_ids, p1.doc_ids)
+    result, position, n_long = [], 0, len(long)
+    for value in short:
+        position = bisect_left(long, value, position)
+        if position == n_long:
+            break
+        if long[position] == value:
+            result.append(value)
+    return result
+
+
+def _measure(build):
+    tracemalloc.start()
+    built = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return built, size
+
+
+def _copy_array_list(llist):
+    copy = type(llist)()
+    copy.doc_ids.extend(llist.doc_ids)
+    copy.tfs.extend(llist.tfs)
+    copy.tfidfs.extend(llist.tfidfs)
+    copy.add_skip_connections()
+    return copy
+
+
+def _time_pairs(pairs, intersect, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for p1, p2 in pairs:
+            intersect(p1, p2)
+    return time.perf_counter() - start
+
+
+def bench_postings(argv):
+    """ Compares the memory footprint & merge speed of the array-backed LinkedList against the Node based one."""
+    index = _build_index(argv.corpus)
+    sorted_ids = {term: llist.to_list() for term, llist in index.items()}
+    n_postings = sum(len(ids) for ids in sorted_ids.values())
+
+    array_index, array_bytes = _measure(lambda: {t: _copy_array_list(index[t]) for t in sorted_ids})
+    node_index, node_bytes = _measure(lambda: {t: _build_node_list(ids) for t, ids in sorted_ids.items()})
+    long_terms = [t for t, ids in sorted_ids.items() if len(ids) >= argv.long_list]
+    n_long_postings = sum(len(sorted_ids[t]) for t in long_terms)
+    _, long_array_bytes = _measure(lambda: [_copy_array_list(index[t]) for t in long_terms])
+    _, long_node_bytes = _measure(lambda: [_build_node_list(sorted_ids[t]) for t in long_terms])
+
+    rng = random.Random(argv.seed)
+    frequent = sorted(sorted_ids, key=lambda t: -len(sorted_ids[t]))[:argv.top_terms]
+    term_pairs = [tuple(rng.sample(frequent, 2)) for _ in range(argv.pairs)]
+    for t1, t2 in term_pairs:
+        expected = _intersect_nodes(node_index[t1], node_index[t2])
+        assert _intersect_arrays(array_index[t1], array_index[t2]) == expected
+        assert _intersect_arrays_bisect(array_index[t1], array_index[t2]) == expected
+
+    array_pairs = [(array_index[t1], array_index[t2]) for t1, t2 in term_pairs]
+    array_time = _time_pairs(array_pairs, _intersect_arrays, argv.repeat)
+    bisect_time = _time_pairs(array_pairs, _intersect_arrays_bisect, argv.repeat)
+    node_time = _time_pairs([(node_index[t1], node_index[t2]) for t1, t2 in term_pairs], _intersect_nodes,
+                            argv.repeat)
+
+    print(f"terms: {len(sorted_ids)}, postings: {n_postings}, "
+          f"lists with >= {argv.long_list} postings: {len(long_terms)} ({n_long_postings} postings)")
+    print(f"{'':<14}{'memory (KiB)':>14}{'bytes/posting':>15}{'long lists':>12}{'merge (ms)':>12}")
+    for name, size, long_size, elapsed in (('Node based', node_bytes, long_node_bytes, node_time),
+                                           ('array backed', array_bytes, long_array_bytes, array_time)):
+        print(f"{name:<14}{size / 1024:>14.1f}{size / n_postings:>15.1f}"
+              f"{long_size / n_long_postings:>12.1f}{elapsed * 1000:>12.1f}")
+    print(f"{'array bisect':<14}{'':>41}{bisect_time * 1000:>12.1f}")
+    print(f"memory: {node_bytes / array_bytes:.1f}x smaller overall, "
+          f"{long_node_bytes / long_array_bytes:.1f}x smaller on long lists")
+    print(f"merge speedup vs Node based: linear {node_time / array_time:.2f}x, bisect {node_time / bisect_time:.2f}x")
+
+def _read_tokenized(corpus):
+    preprocessor = Preprocessor()
+    with open(corpus, 'r') as fp:
+        return [(doc_id, preprocessor.tokenizer(document))
+                for doc_id, document in (preprocessor.get_doc_id(line) for line in fp)]
+
+
+def _time_indexing(documents, copies, append_only):
+    """ Indexes the documents replicated `copies` times, giving each copy its own doc id range."""
+    stride = max(doc_id for doc_id, _ in documents) + 1
+    indexer = Indexer(append_only=append_only)
+    start = time.perf_counter()
+    for copy in range(copies):
+        offset = copy * stride
+        for doc_id, tokenized_document in documents:
+            indexer.generate_inverted_index(doc_id + offset, tokenized_document)
+    if append_only:
+        indexer.sort_postings()
+    return time.perf_counter() - start, sum(llist.length for llist in indexer.get_index().values())
+
+
+def bench_indexing(argv):
+    """ Indexing time of the append_only mode vs the sorted insert_at_end, as the corpus is replicated."""
+    documents = _read_tokenized(argv.corpus)
+    print(f"{'copies':>8}{'postings':>12}{'mode':>8}{'time (s)':>10}{'us/posting':>12}")
+    for copies in argv.copies:
+        modes = [('append', True)] + ([('insert', False)] if copies <= argv.max_insert_copies else [])
+        for mode, append_only in modes:
+            elapsed, n_postings = _time_indexing(documents, copies, append_only)
+            print(f"{copies:>8}{n_postings:>12}{mode:>8}{elapsed:>10.2f}{elapsed / n_postings * 1e6:>12.2f}")
+
+
+def _long_tail_queries(index, n_queries, rng):
+    """ Synthetic queries made of one rare term & two of the most frequent terms."""
+    by_length = sorted(index, key=lambda term: index[term].length)
+    rare = [term for term in by_length if 2 <= index[term].length <= 10]
+    frequent = by_length[-50:]
+    return [[rng.choice(rare)] + rng.sample(frequent, 2) for _ in range(n_queries)]
+
+
+def bench_merge(argv):
+    """ DAAT AND with the naive linear merge vs skip pointers vs galloping search."""
+    runner = ProjectRunner(cache=QueryCache(max_queries=0, max_pairs=0))
+    runner.indexer.inverted_index = _build_index(argv.corpus)
+    with open(argv.queries, 'r') as fp:
+        sample_queries = [runner.preprocessor.tokenizer(query) for query in fp if query.strip()]
+    workloads = (('sample', sample_queries),
+                 ('long-tail', _long_tail_queries(runner.indexer.get_index(), argv.n_queries, random.Random(argv.seed))))
+    modes = (('linear', {}), ('skips', {'use_skips': True}), ('galloping', {'galloping': True}))
+
+    print(f"{'workload':<11}{'mode':<11}{'us/query':>10}{'comparisons/query':>19}")
+    for workload, queries in workloads:
+        expected = [runner._daat_and(terms)[0].to_list() for terms in queries]
+        for mode, options in modes:
+            comparisons = 0
+            start = time.perf_counter()
+            for _ in range(argv.repeat):
+                for terms, result in zip(queries, expected):
+                    postings, query_comparisons = runner._daat_and(terms, **options)
+                    comparisons += query_comparisons
+            elapsed = time.perf_counter() - start
+            assert all(runner._daat_and(terms, **options)[0].to_list() == result
+                       for terms, result in zip(queries, expected))
+            n_runs = argv.repeat * len(queries)
+            print(f"{workload:<11}{mode:<11}{elapsed / n_runs * 1e6:>10.1f}{comparisons / n_runs:>19.1f}")
+
+
+def bench_ranking(argv):
+    """ Full tf-idf sort vs the heap-based top-k (_top_k_by_tf_idf, as run_queries does with top_k) of the DAAT AND
+        results, on broad queries made of frequent terms."""
+    runner = ProjectRunner(cache=QueryCache(max_queries=0, max_pairs=0))
+    runner.run_indexer(argv.corpus)
+    index, rng = runner.indexer.get_index(), random.Random(argv.seed)
+    frequent = sorted(index, key=lambda term: -index[term].length)[:argv.top_terms]
+    queries = [rng.sample(frequent, rng.randint(2, 3)) for _ in range(argv.n_queries)]
+    results = [runner._daat_and(terms)[0] for terms in queries]
+
+    start = time.perf_counter()
+    expected = [runner._sort_by_tf_idf(postings)[:argv.top_k] for postings in results]
+    full_time = time.perf_counter() - start
+    start = time.perf_counter()
+    top_docs = [runner._top_k_by_tf_idf(postings, argv.top_k) for postings in results]
+    top_k_time = time.perf_counter() - start
+    assert top_docs == expected
+
+    n_results = sum(postings.length for postings in results)
+    print(f"{len(queries)} queries, {n_results / len(queries):.0f} results/query, top_k={argv.top_k}")
+    print(f"{'':<10}{'us/query':>10}")
+    for name, elapsed in (('full sort', full_time), ('top-k', top_k_time)):
+        print(f"{name:<10}{elapsed / len(queries) * 1e6:>10.1f}")
+
+
+def _time_queries(runner, queries, repeat, **options):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for terms in queries:
+            runner._daat_and(terms, **options)
+    return (time.perf_counter() - start) / (repeat * len(queries))
+
+
+def bench_compression(argv):
+    """ Size & decode throughput of the compressed doc ids, & DAAT AND latency over them."""
+    runner = ProjectRunner(cache=QueryCache(max_queries=0, max_pairs=0))
+    runner.run_indexer(argv.corpus)
+    index = runner.indexer.get_index()
+    raw = [llist.doc_ids for llist in index.values()]
+    compressed = [CompressedDocIds(doc_ids) for doc_ids in raw]
+    n_postings = sum(len(doc_ids) for doc_ids in raw)
+    raw_bytes, compressed_bytes = 4 * n_postings, sum(doc_ids.nbytes() for doc_ids in compressed)
+    print(f"{n_postings} postings: {raw_bytes / n_postings:.2f} bytes/doc id raw, "
+          f"{compressed_bytes / n_postings:.2f} compressed, ratio {raw_bytes / compressed_bytes:.2f}x")
+    long_lists = [doc_ids for doc_ids in compressed if len(doc_ids) >= argv.long_list]
+    long_postings = sum(len(doc_ids) for doc_ids in long_lists)
+    print(f"lists >= {argv.long_list} postings: ratio "
+          f"{4 * long_postings / sum(doc_ids.nbytes() for doc_ids in long_lists):.2f}x")
+
+    for name, lists in (('all lists', compressed), (f'lists >= {argv.long_list}', long_lists)):
+        n_decoded, n_bytes = sum(len(doc_ids) for doc_ids in lists), sum(doc_ids.nbytes() for doc_ids in lists)
+        start = time.perf_counter()
+        for _ in range(argv.repeat):
+            for doc_ids in lists:
+                for block in range(doc_ids.n_blocks):
+                    doc_ids.decode_block(block)
+        elapsed = time.perf_counter() - start
+        print(f"decode, {name}: {argv.repeat * n_decoded / elapsed / 1e6:.1f} M doc ids/s, "
+              f"{argv.repeat * n_bytes / elapsed / 1e6:.1f} MB/s of compressed input")
+
+    with tempfile.TemporaryDirectory() as directory:
+        sizes = []
+        for compress in (False, True):
+            path = os.path.join(directory, 'index.bin')
+            runner.indexer.compressed = compress
+            runner.indexer.save_index(path)
+            sizes.append(os.path.getsize(path))
+        runner.indexer.compressed = False
+    print(f"index file: {sizes[0]} bytes raw, {sizes[1]} bytes compressed")
+
+    with open(argv.queries, 'r') as fp:
+        sample_queries = [runner.preprocessor.tokenizer(query) for query in fp if query.strip()]
+    workloads = (('sample', sample_queries),
+                 ('long-tail', _long_tail_queries(index, argv.n_queries, random.Random(argv.seed))))
+    modes = (('linear', {}), ('skips', {'use_skips': True}), ('galloping', {'galloping': True}))
+    timings = {(workload, mode): [_time_queries(runner, queries, argv.repeat, **options)]
+               for workload, queries in workloads for mode, options in modes}
+    expected = {workload: [runner._daat_and(terms)[0].to_list() for terms in queries]
+                for workload, queries in workloads}
+    runner.indexer.compress_postings()
+    for workload, queries in workloads:
+        assert [runner._daat_and(terms)[0].to_list() for terms in queries] == expected[workload]
+        for mode, options in modes:
+            timings[workload, mode].append(_time_queries(runner, queries, argv.repeat, **options))
+
+    print(f"{'workload':<11}{'mode':<11}{'raw us/query':>14}{'compressed us/query':>21}")
+    for (workload, mode), (raw_time, compressed_time) in timings.items():
+        print(f"{workload:<11}{mode:<11}{raw_time * 1e6:>14.1f}{compressed_time * 1e6:>21.1f}")
+
+
+
+def _postings_bytes(llist):
+    return llist.length * (llist.doc_ids.itemsize + llist.tfs.itemsize + llist.tfidfs.itemsize) + \
+        llist.n_skips * (llist.skip_sources.itemsize + llist.skip_targets.itemsize)
+
+
+def _phrase_queries(corpus, preprocessor, n_queries, rng):
+    """ Phrases of 2 to 4 consecutive tokens, cut out of random documents of the corpus."""
+    with open(corpus, 'r') as fp:
+        documents = [preprocessor.tokenizer(preprocessor.get_doc_id(line)[1]) for line in fp]
+    documents = [tokens for tokens in documents if len(tokens) >= 4]
+    queries = []
+    for _ in range(n_queries):
+        tokens, length = rng.choice(documents), rng.randint(2, 4)
+        start = rng.randrange(len(tokens) - length + 1)
+        queries.append(tokens[start:start + length])
+    return queries
+
+
+def bench_phrase(argv):
+    """ Memory overhead of the positional index, & phrase query latency vs the DAAT AND it runs first."""
+    build_times, runners = [], []
+    for positional in (False, True):
+        runner = ProjectRunner(cache=QueryCache(max_queries=0, max_pairs=0), positional=positional)
+        start = time.perf_counter()
+        runner.run_indexer(argv.corpus)
+        build_times.append(time.perf_counter() - start)
+        runners.append(runner)
+    index = runners[1].indexer.get_index()
+    postings_bytes = sum(_postings_bytes(llist) for llist in index.values())
+    position_bytes = sum(len(llist.position_data) +
+                         llist.position_checkpoints.itemsize * len(llist.position_checkpoints)
+                         for llist in index.values())
+    n_positions = sum(llist.length for llist in index.values()) and \
+        sum(len(llist.get_positions(position)) for llist in index.values() for position in range(llist.length))
+    print(f"postings arrays: {postings_bytes} bytes, positions: {position_bytes} bytes "
+          f"(+{position_bytes / postings_bytes:.0%}), {position_bytes / n_positions:.2f} bytes/position")
+    print(f"indexing: {build_times[0] * 1e3:.0f} ms, positional {build_times[1] * 1e3:.0f} ms")
+
+    runner = runners[1]
+    queries = _phrase_queries(argv.corpus, runner.preprocessor, argv.n_queries, random.Random(argv.seed))
+    start = time.perf_counter()
+    for _ in range(argv.repeat):
+        for terms in queries:
+            runner._daat_and(terms, use_skips=True)
+    and_time = (time.perf_counter() - start) / (argv.repeat * len(queries))
+    print(f"{len(queries)} phrases of 2-4 tokens")
+    print(f"{'':<12}{'us/query':>10}{'candidates':>12}{'matches':>9}{'position comparisons':>22}")
+    print(f"{'AND':<12}{and_time * 1e6:>10.1f}")
+    for slop in (0, argv.slop):
+        n_candidates = n_matches = position_comparisons = 0
+        start = time.perf_counter()
+        for _ in range(argv.repeat):
+            for terms in queries:
+                matches, candidates, _, comparisons = runner._phrase_query(terms, slop)
+                n_candidates, n_matches = n_candidates + candidates, n_matches + len(matches)
+                position_comparisons += comparisons
+        n_runs = argv.repeat * len(queries)
+        elapsed = (time.perf_counter() - start) / n_runs
+        print(f"{f'slop={slop}':<12}{elapsed * 1e6:>10.1f}{n_candidates / n_runs:>12.1f}{n_matches / n_runs:>9.1f}"
+              f"{position_comparisons / n_runs:>22.1f}")
+
+
+def _boolean_queries(index, n_queries, rng):
+    """ Boolean queries written in a costly order: frequent terms & negations first, the rare term last."""
+    by_length = sorted(index, key=lambda term: index[term].length)
+    rare = [term for term in by_length if 2 <= index[term].length <= 20]
+    medium = by_length[len(by_length) * 9 // 10:-50]
+    frequent = by_length[-50:]
+    templates = ("{f1} AND NOT {f2} AND {r1}",
+                 "({f1} OR {f2}) AND {m1} AND {r1}",
+                 "{f1} AND {f2} AND NOT ({m1} OR {m2}) AND ({r1} OR {r2})",
+                 "NOT {f1} AND {m1} AND {r1}")
+    return [rng.choice(templates).format(f1=f1, f2=f2, m1=m1, m2=m2, r1=r1, r2=r2)
+            for f1, f2, m1, m2, r1, r2 in (rng.sample(frequent, 2) + rng.sample(medium, 2) + rng.sample(rare, 2)
+                                           for _ in range(n_queries))]
+
+
+def bench_boolean(argv):
+    """ Boolean queries run as written vs through the cost-based plan, by operator."""
+    runner = ProjectRunner(cache=QueryCache(max_queries=0, max_pairs=0))
+    runner.run_indexer(argv.corpus)
+    queries = _boolean_queries(runner.indexer.get_index(), argv.n_queries, random.Random(argv.seed))
+    plans = {'as written': [parse_query(query, runner.preprocessor.tokenizer) for query in queries],
+             'planned': [runner._plan_boolean_query(query)[0] for query in queries]}
+    expected = None
+    print(f"{len(queries)} queries")
+    print(f"{'':<12}{'us/query':>10}{'AND':>10}{'OR':>10}{'NOT':>10}{'comparisons/query':>19}")
+    for name, query_plans in plans.items():
+        comparisons = dict.fromkeys(('AND', 'OR', 'NOT'), 0)
+        start = time.perf_counter()
+        for _ in range(argv.repeat):
+            results = [runner._execute_plan(plan, comparisons).to_list() for plan in query_plans]
+        elapsed = time.perf_counter() - start
+        expected = results if expected is None else expected
+        assert results == expected
+        n_runs = argv.repeat * len(queries)
+        print(f"{name:<12}{elapsed / n_runs * 1e6:>10.1f}" +
+              ''.join(f"{comparisons[operator] / n_runs:>10.1f}" for operator in ('AND', 'OR', 'NOT')) +
+              f"{sum(comparisons.values()) / n_runs:>19.1f}")
+
+
+def _zipf_vocabulary(corpus, preprocessor):
+    """ Terms of the corpus, by decreasing document frequency."""
+    document_frequencies = Counter()
+    with open(corpus, 'r') as fp:
+        documents = (preprocessor.get_doc_id(line)[1] for line in fp if line.strip())
+        for tokens in preprocessor.tokenize_many(documents):
+            document_frequencies.update(set(tokens))
+    return [term for term, _ in document_frequencies.most_common()]
+
+
+def _zipf_workload(vocabulary, n_queries, n_distinct, exponent, max_terms, rng):
+    """ Zipfian query workload: a pool of n_distinct queries of 1 to max_terms terms, each drawn with a probability
+        proportional to 1 / rank^exponent of its document frequency rank, & n_queries drawn from the pool with the
+        same law over the pool, so that a few queries repeat often, as in a real query log."""
+    term_weights = list(accumulate(1 / rank ** exponent for rank in range(1, len(vocabulary) + 1)))
+    pool = [' '.join(dict.fromkeys(rng.choices(vocabulary, cum_weights=term_weights, k=rng.randint(1, max_terms))))
+            for _ in range(n_distinct)]
+    query_weights = list(accumulate(1 / rank ** exponent for rank in range(1, n_distinct + 1)))
+    return rng.choices(pool, cum_weights=query_weights, k=n_queries)
+
+
+def _percentile(sorted_values, percent):
+    """ Nearest-rank percentile of sorted values."""
+    rank = max(int(-(-percent * len(sorted_values) // 100)), 1)
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def _post_json(url, body, timeout):
+    data = json.dumps(body).encode('utf-8')
+    request = urllib.request.Request(url, data=data, headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_load(argv):
+    """ Load generator: runs a Zipfian query workload in batches of batch_size queries, either against a running
+        /execute_query endpoint (--url, with concurrency requests in flight), or through ProjectRunner.run_queries in
+        this process. Reports the latency percentiles of a batch, the throughput in queries/s, the comparisons per
+        query of each DAAT AND section, & the peak RSS (of this process: the index when run in process, the client
+        only against an endpoint). The report is also written as JSON to --output, to compare builds over time."""
+    rng = random.Random(argv.seed)
+    preprocessor = Preprocessor(remove_stopwords=argv.remove_stopwords, stem=argv.stem)
+    vocabulary = _zipf_vocabulary(argv.corpus, Preprocessor(remove_stopwords=argv.remove_stopwords))
+    queries = _zipf_workload(vocabulary, argv.n_queries, argv.n_distinct, argv.zipf_exponent, argv.max_terms, rng)
+    batches = [queries[start:start + argv.batch_size] for start in range(0, len(queries), argv.batch_size)]
+
+    if argv.url:
+        def run_batch(batch):
+            start = time.perf_counter()
+            response = _post_json(argv.url, {'queries': batch, 'random_command': argv.random_command},
+                                  argv.timeout)
+            return time.perf_counter() - start, response['Response']
+        concurrency = argv.concurrency
+    else:
+        runner = ProjectRunner(cache=QueryCache(max_queries=argv.query_cache_size, max_pairs=argv.pair_cache_size),
+                               preprocessor=preprocessor)
+        if argv.index_file and os.path.exists(argv.index_file):
+            runner.load_index(argv.index_file)
+        else:
+            runner.run_indexer(argv.corpus)
+
+        def run_batch(batch):
+            start = time.perf_counter()
+            output_dict = runner.run_queries(batch, argv.random_command)
+            return time.perf_counter() - start, output_dict
+        concurrency = 1
+
+    for batch in batches[:argv.warmup]:
+        run_batch(batch)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        timed_outputs = list(pool.map(run_batch, batches))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, _ in timed_outputs)
+    sections = ('daatAnd', 'daatAndSkip', 'daatAndTfIdf', 'daatAndSkipTfIdf')
+    comparisons = dict.fromkeys(sections, 0)
+    for _, output_dict in timed_outputs:
+        for section in sections:
+            comparisons[section] += sum(result['num_comparisons'] for result in output_dict[section].values())
+    n_distinct_run = sum(len(output_dict['daatAnd']) for _, output_dict in timed_outputs)
+    report = {
+        'mode': 'endpoint' if argv.url else 'in-process',
+        'git_commit': _git_commit(),
+        'python': platform.python_version(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'config': {key: value for key, value in vars(argv).items() if key != 'run'},
+        'n_queries': len(queries),
+        'n_batches': len(batches),
+        'latency_ms': {f'p{percent}': _percentile(latencies, percent) * 1e3 for percent in (50, 95, 99)},
+        'throughput_qps': len(queries) / elapsed,
+        # Comparisons per distinct query of a batch, as the output of a batch is keyed by query.
+        'comparisons_per_query': {section: total / max(n_distinct_run, 1) for section, total in comparisons.items()},
+        # ru_maxrss is in KiB on Linux.
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    report['latency_ms']['mean'] = sum(latencies) / len(latencies) * 1e3
+
+    print(f"{report['mode']}: {len(queries)} queries in {len(batches)} batches of {argv.batch_size}, "
+          f"{argv.n_distinct} distinct, zipf s={argv.zipf_exponent}")
+    print("latency/batch (ms): " + ', '.join(f"{name} {value:.2f}" for name, value in report['latency_ms'].items()))
+    print(f"throughput: {report['throughput_qps']:.1f} queries/s, peak RSS: {report['peak_rss_mb']:.1f} MB")
+    print("comparisons/query: " + ', '.join(f"{section} {value:.1f}"
+                                           for section, value in report['comparisons_per_query'].items()))
+    if argv.output:
+        with open(argv.output, 'w') as fp:
+            json.dump(report, fp, indent=2)
+        print(f"report written to {argv.output}")
+
+
+def _skip_run(runner, queries, repeat):
+    """ Skip-aware DAAT AND of the queries: results, & per query num_comparisons, skip checks, skips taken & time."""
+    results, comparisons, skip_counts = [], 0, [0, 0, 0, 0]
+    for terms in queries:
+        postings = sorted((runner._get_postings(term) for term in dict.fromkeys(terms)), key=lambda llist: llist.length)
+        result = postings[0] if postings else None
+        for other in postings[1:]:
+            if result.length == 0:
+                break
+            result, merge_comparisons = runner._merge(result, other, use_skips=True, skip_counts=skip_counts)
+            comparisons += merge_comparisons
+        results.append(result.to_list() if result is not None else [])
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for terms in queries:
+            runner._daat_and(terms, use_skips=True)
+    elapsed = (time.perf_counter() - start) / (repeat * len(queries))
+    checks, taken = skip_counts[0] + skip_counts[2], skip_counts[1] + skip_counts[3]
+    return results, comparisons / len(queries), checks / len(queries), taken / max(checks, 1), elapsed
+
+
+def bench_skips(argv):
+    """ num_comparisons of the skip-aware DAAT AND with the default sqrt(n) skips vs skips re-placed by the adaptive
+        policy, from the merges of a logged Zipfian workload. Measured on other queries of the same distribution."""
+    runner = ProjectRunner(cache=QueryCache(max_queries=0, max_pairs=0))
+    runner.run_indexer(argv.corpus)
+    rng = random.Random(argv.seed)
+    vocabulary = _zipf_vocabulary(argv.corpus, runner.preprocessor)
+    log, test = (runner.preprocessor.tokenize_many(_zipf_workload(vocabulary, argv.n_queries, argv.n_distinct,
+                                                                  argv.zipf_exponent, argv.max_terms, rng))
+                 for _ in range(2))
+    log, test = [terms for terms in log if len(terms) > 1], [terms for terms in test if len(terms) > 1]
+
+    linear_comparisons = sum(runner._daat_and(terms)[1] for terms in test) / len(test)
+    before = _skip_run(runner, test, argv.repeat)
+    skip_policy = AdaptiveSkipPolicy(min_merges=argv.min_merges, skip_check_cost=argv.skip_check_cost)
+    n_changed = runner.adapt_skips(skip_policy, queries=log)
+    after = _skip_run(runner, test, argv.repeat)
+    assert after[0] == before[0]
+
+    print(f"{len(log)} logged queries, {len(test)} test queries of 2+ terms; {len(skip_policy.hot_terms())} hot "
+          f"lists, {n_changed} re-placed")
+    print(f"{'':<10}{'num_comparisons':>17}{'skip checks':>13}{'hit rate':>10}{'us/query':>10}")
+    print(f"{'no skips':<10}{linear_comparisons:>17.1f}")
+    for name, (_, comparisons, checks, hit_rate, elapsed) in (('sqrt(n)', before), ('adaptive', after)):
+        print(f"{name:<10}{comparisons:>17.1f}{checks:>13.1f}{hit_rate:>10.2f}{elapsed * 1e6:>10.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    postings_parser = subparsers.add_parser("postings", help="Node based vs array-backed postings lists.")
+    postings_parser.add_argument("--corpus", type=str, default="./data/input_corpus.txt")
+    postings_parser.add_argument("--top_terms", type=int, default=200, help="Merge pairs among the N longest lists.")
+    postings_parser.add_argument("--long_list", type=int, default=64,
+                                 help="Also report bytes/posting for lists at least this long.")
+    postings_parser.add_argument("--pairs", type=int, default=500)
+    postings_parser.add_argument("--repeat", type=int, default=5)
+    postings_parser.add_argument("--seed", type=int, default=0)
+    postings_parser.set_defaults(run=bench_postings)
+
+    indexing_parser = subparsers.add_parser("indexing", help="Indexing time on the corpus replicated N times.")
+    indexing_parser.add_argument("--corpus", type=str, default="./data/input_corpus.txt")
+    indexing_parser.add_argument("--copies", type=int, nargs="+", default=[1, 10, 25, 50, 100])
+    indexing_parser.add_argument("--max_insert_copies", type=int, default=25,
+                                 help="Only time the (quadratic) insert_at_end mode up to this many copies.")
+    indexing_parser.set_defaults(run=bench_indexing)
+
+    merge_parser = subparsers.add_parser("merge", help="DAAT AND with linear merge vs skips vs galloping.")
+    merge_parser.add_argument("--corpus", type=str, default="./data/input_corpus.txt")
+    merge_parser.add_argument("--queries", type=str, default="./data/queries.txt")
+    merge_parser.add_argument("--n_queries", type=int, default=200, help="Number of synthetic long-tail queries.")
+    merge_parser.add_argument("--repeat", type=int, default=20)
+    merge_parser.add_argument("--seed", type=int, default=0)
+    merge_parser.set_defaults(run=bench_merge)
+
+    ranking_parser = subparsers.add_parser("ranking", help="Full tf-idf sort vs heap-based top-k ranking.")
+    ranking_parser.add_argument("--corpus", type=str, default="./data/input_corpus.txt")
+    ranking_parser.add_argument("--top_terms", type=int, default=30, help="Queries sample the N longest lists.")
+    ranking_parser.add_argument("--n_queries", type=int, default=200)
+    ranking_parser.add_argument("--top_k", type=int, default=10)
+    ranking_parser.add_argument("--seed", type=int, default=0)
+    ranking_parser.set_defaults(run=bench_ranking)
+
+    compression_parser = subparsers.add_parser("compression", help="Gap encoded & packed doc ids.")
+    compression_parser.add_argument("--corpus", type=str, default="./data/input_corpus.txt")
+    compression_parser.add_argument("--queries", type=str, default="./data/queries.txt")
+    compression_parser.add_argument("--long_list", type=int, default=64,
+                                    help="Also report the ratio for lists at least this long.")
+    compression_parser.add_argument("--n_queries", type=int, default=200, help="Number of synthetic long-tail queries.")
+    compression_parser.add_argument("--repeat", type=int, default=10)
+    compression_parser.add_argument("--seed", type=int, default=0)
+    compression_parser.set_defaults(run=bench_compression)
+
+    phrase_parser = subparsers.add_parser("phrase", help="Positional index size & phrase query latency.")
+    phrase_parser.add_argument("--corpus", type=str, default="./data/input_corpus.txt")
+    phrase_parser.add_argument("--n_queries", type=int, default=200)
+    phrase_parser.add_argument("--slop", type=int, default=2, help="Also time proximity queries with this slop.")
+    phrase_parser.add_argument("--repeat", type=int, default=5)
+    phrase_parser.add_argument("--seed", type=int, default=0)
+    phrase_parser.set_defaults(run=bench_phrase)
+
+    boolean_parser = subparsers.add_parser("boolean", help="Boolean queries as written vs cost-based plans.")
+    boolean_parser.add_argument("--corpus", type=str, default="./data/input_corpus.txt")
+    boolean_parser.add_argument("--n_queries", type=int, default=200)
+    boolean_parser.add_argument("--repeat", type=int, default=5)
+    boolean_parser.add_argument("--seed", type=int, default=0)
+    boolean_parser.set_defaults(run=bench_boolean)
+
+    load_parser = subparsers.add_parser("load", help="Zipfian query workload against the endpoint or run_queries.")
+    load_parser.add_argument("--corpus", type=str, default="./data/input_corpus.txt",
+                             help="Corpus the query vocabulary is drawn from (& indexed, when run in process).")
+    load_parser.add_argument("--url", type=str, default=None,
+                             help="/execute_query URL of a running server, e.g. http://localhost:9999/execute_query. "
+                                  "Without it, the queries are run in process.")
+    load_parser.add_argument("--index_file", type=str, default=None, help="Index file to load, when run in process.")
+    load_parser.add_argument("--n_queries", type=int, default=2000)
+    load_parser.add_argument("--n_distinct", type=int, default=500, help="Number of distinct queries in the pool.")
+    load_parser.add_argument("--zipf_exponent", type=float, default=1.0)
+    load_parser.add_argument("--max_terms", type=int, default=4)
+    load_parser.add_argument("--batch_size", type=int, default=10, help="Queries per run_queries call / request.")
+    load_parser.add_argument("--concurrency", type=int, default=4, help="Requests in flight against the endpoint.")
+    load_parser.add_argument("--warmup", type=int, default=5, help="Batches run before measuring.")
+    load_parser.add_argument("--random_command", type=str, default="")
+    load_parser.add_argument("--query_cache_size", type=int, default=0, help="In process only.")
+    load_parser.add_argument("--pair_cache_size", type=int, default=0, help="In process only.")
+    load_parser.add_argument("--remove_stopwords", action="store_true")
+    load_parser.add_argument("--stem", action="store_true")
+    load_parser.add_argument("--timeout", type=float, default=60.0)
+    load_parser.add_argument("--output", type=str, default=None, help="JSON report file.")
+    load_parser.add_argument("--seed", type=int, default=0)
+    load_parser.set_defaults(run=bench_load)
+
+    skips_parser = subparsers.add_parser("skips", help="Default sqrt(n) skips vs adaptive skip placement.")
+    skips_parser.add_argument("--corpus", type=str, default="./data/input_corpus.txt")
+    skips_parser.add_argument("--n_queries", type=int, default=2000, help="Queries logged, & queries measured.")
+    skips_parser.add_argument("--n_distinct", type=int, default=1000)
+    skips_parser.add_argument("--zipf_exponent", type=float, default=1.0)
+    skips_parser.add_argument("--max_terms", type=int, default=4)
+    skips_parser.add_argument("--min_merges", type=int, default=3)
+    skips_parser.add_argument("--skip_check_cost", type=float, default=1.0,
+                              help="Cost of a skip check, in linear merge steps, for the adaptive policy.")
+    skips_parser.add_argument("--repeat", type=int, default=3)
+    skips_parser.add_argument("--seed", type=int, default=0)
+    skips_parser.set_defaults(run=bench_skips)
+
+    argv = parser.parse_args()
+    argv.run(argv)
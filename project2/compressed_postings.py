@@ -0,0 +1,139 @@
+'''
+Gap encoded doc ids, packed in blocks of fixed width gaps & decoded lazily one block at a time.
+'''
+
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from operator import sub
+
+BLOCK_SIZE = 128
+# Typecode of the array holding the gaps of a block, for each width in bytes. 3 byte gaps are stored on 4 bytes.
+_TYPECODES = {1: 'B', 2: 'H', 4: 'I'}
+
+
+def encode_varint(value, out):
+    """ VByte encodes a non-negative int onto the out bytearray: 7 bits per byte, low bits first, with the high bit
+        set on every byte but the last."""
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varint(buffer, position):
+    """ Decodes the VByte encoded int at position of buffer. Returns it, & the position after it."""
+    result = shift = 0
+    while True:
+        byte = buffer[position]
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, position
+        shift += 7
+
+
+def _width(max_gap):
+    return 1 if max_gap < 1 << 8 else 2 if max_gap < 1 << 16 else 4
+
+
+class CompressedDocIds:
+    """ Read-only sequence of sorted doc ids, in blocks of block_size doc ids. The first doc id of each block is
+        kept whole, as the skip entry of the block, & the gaps between the others are packed in an array of the
+        smallest width (1, 2 or 4 bytes) that fits the largest gap of the block, in the style of PFor without
+        exceptions. Decoding a block is an array.frombytes & a prefix sum, both running in C.
+        Any block can be decoded on its own, & a doc id can be searched for without decoding the blocks before it.
+        Indexing decodes the block of the position, & keeps the last decoded block, so a merge walking the list in
+        order decodes each block it reaches once, & never the blocks it skips over."""
+
+    def __init__(self, doc_ids=(), block_size=BLOCK_SIZE):
+        self.block_size = block_size
+        # block_offsets[b - 1] is the offset of block b in data; block 0 starts at 0.
+        self.block_firsts, self.block_offsets, self.data = array('I'), array('I'), bytearray()
+        doc_ids = list(doc_ids)
+        self.n = len(doc_ids)
+        for start in range(0, self.n, block_size):
+            block = doc_ids[start:start + block_size]
+            if start:
+                self.block_offsets.append(len(self.data))
+            self.block_firsts.append(block[0])
+            if len(block) > 1:
+                gaps = list(map(sub, block[1:], block[:-1]))
+                width = _width(max(gaps))
+                self.data.append(width)
+                self.data += array(_TYPECODES[width], gaps).tobytes()
+        self._cache = (-1, [])
+
+    @classmethod
+    def from_bytes(cls, buffer, n, block_size=BLOCK_SIZE):
+        """ Reads doc ids serialized by to_bytes (e.g. from a memoryview slice of an index file). Only the skip
+            entries are copied; the packed gaps are read from the buffer."""
+        doc_ids = cls(block_size=block_size)
+        n_blocks = -(-n // block_size)
+        header_size = 4 * (2 * n_blocks - 1) if n_blocks else 0
+        doc_ids.block_firsts.frombytes(buffer[:4 * n_blocks])
+        doc_ids.block_offsets.frombytes(buffer[4 * n_blocks:header_size])
+        doc_ids.data, doc_ids.n = buffer[header_size:], n
+        return doc_ids
+
+    def to_bytes(self):
+        """ Skip entries (block_firsts, block_offsets), then the packed gaps."""
+        return self.block_firsts.tobytes() + self.block_offsets.tobytes() + bytes(self.data)
+
+    @property
+    def n_blocks(self):
+        return len(self.block_firsts)
+
+    def nbytes(self):
+        """ Bytes used by the packed gaps & the skip entries of the blocks."""
+        return len(self.data) + 4 * (len(self.block_firsts) + len(self.block_offsets))
+
+    def decode_block(self, block):
+        """ Returns the doc ids of a block, as a list."""
+        start = self.block_offsets[block - 1] if block else 0
+        end = self.block_offsets[block] if block + 1 < self.n_blocks else len(self.data)
+        if start == end:
+            return [self.block_firsts[block]]
+        gaps = array(_TYPECODES[self.data[start]])
+        gaps.frombytes(self.data[start + 1:end])
+        return list(accumulate(gaps, initial=self.block_firsts[block]))
+
+    def _decoded(self, block):
+        cached_block, decoded = self._cache
+        if cached_block != block:
+            decoded = self.decode_block(block)
+            self._cache = (block, decoded)
+        return decoded
+
+    def __getitem__(self, position):
+        cached_block, decoded = self._cache
+        offset = position - cached_block * self.block_size
+        if 0 <= offset < len(decoded):
+            return decoded[offset]
+        if position < 0:
+            position += self.n
+        if not 0 <= position < self.n:
+            raise IndexError('doc id index out of range')
+        block, offset = divmod(position, self.block_size)
+        return self._decoded(block)[offset]
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        for block in range(self.n_blocks):
+            yield from self.decode_block(block)
+
+    def tolist(self):
+        return list(self)
+
+    def search(self, doc_id, low=0):
+        """ Returns the first position >= low whose doc id is >= doc_id (n if there is none). The skip entries find
+            the block, so only that block is decoded."""
+        if low >= self.n:
+            return self.n
+        block = max(bisect_right(self.block_firsts, doc_id, low // self.block_size) - 1, low // self.block_size)
+        start = block * self.block_size
+        # If every doc id of the block is < doc_id, the first doc id of the next block is > doc_id, & it starts
+        # right where the block ends.
+        return start + bisect_left(self._decoded(block), doc_id, max(low - start, 0))
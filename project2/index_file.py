@@ -0,0 +1,140 @@
+'''
+Binary on-disk format for a finished index, and a read-only Mapping over a memory-mapped index file.
+
+Layout (native byte order, every section starts on an 8 byte boundary):
+    header          magic, version, byte order, flags, n_terms, n_postings, n_skips, term block size,
+                    vocabulary bytes, doc_id_data bytes
+    block_offsets   uint32[n_blocks + 1]  byte offsets of each block of terms in the vocabulary blob
+    vocabulary      utf-8 terms, sorted & front-coded, as laid out by TermDictionary
+    postings_starts uint64[n_terms + 1]   offsets of each postings list in doc_ids / tfidfs
+    skip_starts     uint64[n_terms + 1]   offsets of each postings list in skip_sources / skip_targets
+    idfs            float32[n_terms]
+    doc_ids         uint32[n_postings]
+    tfidfs          float32[n_postings]
+    skip_sources    uint32[n_skips]
+    skip_targets    uint32[n_skips]
+
+With the COMPRESSED flag, the doc_ids section is replaced by the doc ids of each list, as CompressedDocIds.to_bytes:
+    doc_id_starts   uint64[n_terms + 1]   byte offsets of each postings list in doc_id_data
+    doc_id_data     skip entries & packed gaps of each postings list
+
+The STOPWORDS_REMOVED & STEMMED flags record the preprocessing the terms were built with, which queries against the
+index must use too.
+'''
+
+import mmap
+import struct
+import sys
+from array import array
+from compressed_postings import CompressedDocIds
+from linkedlist import LinkedList
+from term_dictionary import TermDictionary, TermIndex
+
+MAGIC = b'P2IX'
+VERSION = 4
+COMPRESSED, STOPWORDS_REMOVED, STEMMED = 1, 2, 4
+_HEADER = struct.Struct('<4sIBBxxIQQIQQ')
+
+
+def _padding(size):
+    return b'\0' * (-size % 8)
+
+
+def write_index(path, inverted_index, compress=False, remove_stopwords=False, stem=False):
+    """ Serializes a finished inverted index (term -> LinkedList, sorted by term) to path. The front-coded
+        vocabulary of a TermIndex, & the doc ids of compressed postings lists, are written as is.
+        compress: write the doc ids compressed, see CompressedDocIds.
+        remove_stopwords, stem: the Preprocessor options the terms were built with, recorded in the header."""
+    if isinstance(inverted_index, TermIndex):
+        term_dictionary = inverted_index.term_dictionary
+    else:
+        term_dictionary = TermDictionary(inverted_index.keys())
+    postings_starts, skip_starts = array('Q', [0]), array('Q', [0])
+    idfs, doc_ids, tfidfs = array('f'), array('I'), array('f')
+    skip_sources, skip_targets = array('I'), array('I')
+    doc_id_starts, doc_id_data = array('Q', [0]), bytearray()
+
+    for llist in inverted_index.values():
+        if compress:
+            encoded = llist.doc_ids if llist.is_compressed else CompressedDocIds(llist.doc_ids)
+            doc_id_data += encoded.to_bytes()
+            doc_id_starts.append(len(doc_id_data))
+            postings_starts.append(postings_starts[-1] + llist.length)
+        else:
+            doc_ids.extend(llist.doc_ids)
+            postings_starts.append(len(doc_ids))
+        tfidfs.extend(llist.tfidfs)
+        skip_sources.extend(llist.skip_sources)
+        skip_targets.extend(llist.skip_targets)
+        skip_starts.append(len(skip_sources))
+        idfs.append(llist.idf)
+
+    byte_order = 0 if sys.byteorder == 'little' else 1
+    flags = (COMPRESSED if compress else 0) | (STOPWORDS_REMOVED if remove_stopwords else 0) | \
+        (STEMMED if stem else 0)
+    doc_id_sections = (doc_id_starts, doc_id_data) if compress else (doc_ids,)
+    with open(path, 'wb') as fp:
+        fp.write(_HEADER.pack(MAGIC, VERSION, byte_order, flags, len(idfs),
+                              postings_starts[-1], len(skip_sources), term_dictionary.block_size,
+                              len(term_dictionary.blob), len(doc_id_data)))
+        fp.write(_padding(_HEADER.size))
+        for section in (term_dictionary.block_offsets, term_dictionary.blob, postings_starts, skip_starts, idfs,
+                        *doc_id_sections, tfidfs, skip_sources, skip_targets):
+            size = len(section) * getattr(section, 'itemsize', 1)
+            fp.write(section)
+            fp.write(_padding(size))
+
+
+class MappedIndex(TermIndex):
+    """ Read-only term -> LinkedList mapping over a memory-mapped index file.
+        Nothing is decoded up front: terms are looked up in the front-coded vocabulary, and the returned
+        LinkedList reads its doc ids, scores & skips straight from the mapped pages, which are shared by all the
+        processes mapping the same file."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as fp:
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        buffer = memoryview(self._mmap)
+        (magic, version, byte_order, flags, n_terms, n_postings, n_skips, block_size, vocabulary_size,
+         doc_id_data_size) = _HEADER.unpack_from(buffer)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{path} is not a version {VERSION} index file')
+        if byte_order != (0 if sys.byteorder == 'little' else 1):
+            raise ValueError(f'{path} was written on a machine with a different byte order')
+
+        self._offset = _HEADER.size + len(_padding(_HEADER.size))
+        self._buffer = buffer
+        block_offsets = self._section(-(-n_terms // block_size) + 1, 'I')
+        vocabulary = self._section(vocabulary_size, 'B')
+        self.postings_starts = self._section(n_terms + 1, 'Q')
+        self.skip_starts = self._section(n_terms + 1, 'Q')
+        self.idfs = self._section(n_terms, 'f')
+        self.compressed = bool(flags & COMPRESSED)
+        self.remove_stopwords, self.stem = bool(flags & STOPWORDS_REMOVED), bool(flags & STEMMED)
+        if self.compressed:
+            self.doc_id_starts = self._section(n_terms + 1, 'Q')
+            self.doc_id_data = self._section(doc_id_data_size, 'B')
+        else:
+            self.doc_ids = self._section(n_postings, 'I')
+        self.tfidfs = self._section(n_postings, 'f')
+        self.skip_sources = self._section(n_skips, 'I')
+        self.skip_targets = self._section(n_skips, 'I')
+        super().__init__(TermDictionary.from_buffers(vocabulary, block_offsets, n_terms, block_size), None)
+
+    def _section(self, count, fmt):
+        size = count * struct.calcsize(fmt)
+        view = self._buffer[self._offset:self._offset + size].cast(fmt)
+        self._offset += size + len(_padding(size))
+        return view
+
+    def postings_at(self, term_id):
+        start, end = self.postings_starts[term_id], self.postings_starts[term_id + 1]
+        skip_start, skip_end = self.skip_starts[term_id], self.skip_starts[term_id + 1]
+        if self.compressed:
+            doc_ids = CompressedDocIds.from_bytes(
+                self.doc_id_data[self.doc_id_starts[term_id]:self.doc_id_starts[term_id + 1]], end - start)
+        else:
+            doc_ids = self.doc_ids[start:end]
+        return LinkedList.from_buffers(doc_ids, self.tfidfs[start:end],
+                                       self.skip_sources[skip_start:skip_end],
+                                       self.skip_targets[skip_start:skip_end], self.idfs[term_id])
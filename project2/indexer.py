@@ -4,13 +4,50 @@ Institute: University at Buffalo
 '''
 
 from linkedlist import LinkedList
-from collections import OrderedDict
+from index_file import MappedIndex, write_index
+from term_dictionary import TermDictionary, TermIndex
+from skip_policy import SqrtSkipPolicy
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict
+from heapq import merge
+from itertools import groupby, islice
+from operator import itemgetter
+from threading import RLock
+import copy
+import numpy as np
 
 
 class Indexer:
-    def __init__(self):
-        """ Add more attributes if needed"""
+    def __init__(self, append_only=False, positional=False):
+        """ Add more attributes if needed
+            append_only: add postings with the O(1) LinkedList.append instead of the sorted insert_at_end.
+            sort_postings must then be called once all the documents have been added.
+            positional: also record the token positions of each term in each document, in positions
+            (term -> {doc id: [positions]}) while indexing, & packed into the postings lists by pack_positions.
+            version is bumped whenever the index is (re-)built or loaded, so that caches built over it can tell when
+            they are stale.
+            compressed is set once the doc ids of the postings lists are compressed, see compress_postings.
+            Documents added to or deleted from the finished index go to a delta segment (delta: term -> {doc id: tf},
+            & the terms of each added document) & to tombstones, which hide the postings of the main index, until
+            merge_delta folds them into it. idf_n_docs is the N the idfs of the main index were computed with, &
+            doc_lengths_complete tells whether doc_lengths has every document of the main index, which is not the
+            case for a loaded index.
+            skip_policy places the skip pointers of each postings list (see skip_policy)."""
         self.inverted_index = OrderedDict({})
+        self.append_only = append_only
+        self.positional, self.positions = positional, {}
+        self.doc_lengths = {}
+        self.compressed = False
+        self.version = 0
+        self.idf_n_docs, self.doc_lengths_complete = 0, True
+        self.delta, self.delta_doc_terms, self.tombstones = {}, {}, set()
+        self.delta_positions = {}
+        self.live_postings, self.sorted_tombstones = {}, []
+        self.n_merges = 0
+        self.skip_policy = SqrtSkipPolicy()
+        self.all_documents = (None, None)
+        self.lock = RLock()
 
     def get_index(self):
         """ Function to get the index.
@@ -19,43 +56,347 @@ class Indexer:
 
     def generate_inverted_index(self, doc_id, tokenized_document):
         """ This function adds each tokenized document to the index. This in turn uses the function add_to_index
+            The term frequencies & the document length are recorded for calculate_tf_idf, & the token positions for
+            a positional index.
             Already implemented."""
-        for t in tokenized_document:
-            self.add_to_index(t, doc_id)
+        offset = self.doc_lengths.get(doc_id, 0)
+        self.doc_lengths[doc_id] = offset + len(tokenized_document)
+        if not self.positional:
+            for t, tf in Counter(tokenized_document).items():
+                self.add_to_index(t, doc_id, tf)
+            return
+        for t, positions in self._term_positions(tokenized_document, offset).items():
+            self.add_to_index(t, doc_id, len(positions))
+            self.positions.setdefault(t, {}).setdefault(doc_id, []).extend(positions)
+
+    @staticmethod
+    def _term_positions(tokenized_document, offset=0):
+        term_positions = {}
+        for position, t in enumerate(tokenized_document, offset):
+            term_positions.setdefault(t, []).append(position)
+        return term_positions
 
-    def add_to_index(self, term_, doc_id_):
+    def add_to_index(self, term_, doc_id_, tf_=1):
         if term_ not in self.inverted_index:
             llist = LinkedList()
-            llist.insert_at_end(doc_id_)
+            llist.insert_at_end(doc_id_, tf_)
             self.inverted_index[term_] = llist
             return
-        
-        self.inverted_index[term_].insert_at_end(doc_id_)
+
+        if self.append_only:
+            self.inverted_index[term_].append(doc_id_, tf_)
+        else:
+            self.inverted_index[term_].insert_at_end(doc_id_, tf_)
 
         return
 
+    def sort_postings(self):
+        """ Sorts & de-duplicates each postings list built in append_only mode. Lists whose doc ids were appended
+            in increasing order are left untouched."""
+        for llist in self.inverted_index.values():
+            llist.sort_and_dedupe()
+
+    def merge_partial_indexes(self, partial_indexes):
+        """ Merges partial indexes, built over separate chunks of the corpus, into this index.
+            Each partial index is a (postings, doc_lengths, positions) triple, as returned by get_partial_index. The
+            postings of a term are k-way merged across the partial indexes, so the result is the same as indexing the
+            chunks serially."""
+        partial_indexes = [self.get_partial_index()] + list(partial_indexes)
+        shards_by_term, self.doc_lengths, self.positions = {}, {}, {}
+        for postings, doc_lengths, positions in partial_indexes:
+            offsets = {doc_id: self.doc_lengths.get(doc_id, 0) for doc_id in doc_lengths}
+            for doc_id, doc_length in doc_lengths.items():
+                self.doc_lengths[doc_id] = self.doc_lengths.get(doc_id, 0) + doc_length
+            for term, doc_positions in positions.items():
+                term_positions = self.positions.setdefault(term, {})
+                for doc_id, token_positions in doc_positions.items():
+                    term_positions.setdefault(doc_id, []).extend(
+                        token_position + offsets[doc_id] for token_position in token_positions)
+            for term, shard in postings.items():
+                shards_by_term.setdefault(term, []).append(shard)
+
+        for term, shards in shards_by_term.items():
+            if len(shards) == 1:
+                doc_ids, tfs = shards[0]
+            else:
+                merged = [(doc_id, sum(tf for _, tf in group)) for doc_id, group in
+                          groupby(merge(*(zip(*shard) for shard in shards)), key=itemgetter(0))]
+                doc_ids, tfs = [doc_id for doc_id, _ in merged], [tf for _, tf in merged]
+            self.inverted_index[term] = LinkedList.from_doc_ids(doc_ids, tfs)
+
+    def get_partial_index(self):
+        """ Returns the index as plain data, e.g. to send a partial index across processes:
+            a dict of term -> (doc ids, term frequencies) arrays, the dict of document lengths, & the token positions."""
+        postings = {term: (llist.doc_ids, llist.tfs) for term, llist in self.inverted_index.items()}
+        return postings, self.doc_lengths, self.positions
+
+    def save_index(self, path, remove_stopwords=False, stem=False):
+        """ Writes the finished index (sorted terms, postings, skips & scores) to a binary index file. The doc ids
+            are written compressed if the postings lists are. remove_stopwords & stem are the preprocessing options
+            the terms were built with, recorded in the file."""
+        write_index(path, self.inverted_index, compress=self.compressed, remove_stopwords=remove_stopwords,
+                    stem=stem)
+
+    def load_index(self, path):
+        """ Memory-maps an index file written by save_index. The loaded index is read-only. Its remove_stopwords &
+            stem attributes are the preprocessing options recorded in the file."""
+        self.inverted_index = MappedIndex(path)
+        self.compressed = self.inverted_index.compressed
+        if len(self.inverted_index):
+            first = self.inverted_index.postings_at(0)
+            self.idf_n_docs = round(first.idf * first.length)
+        self.doc_lengths, self.doc_lengths_complete = {}, False
+        self.version += 1
 
     def sort_terms(self):
         """ Sorting the index by terms.
-            Already implemented."""
-        sorted_index = OrderedDict({})
-        for k in sorted(self.inverted_index.keys()):
-            sorted_index[k] = self.inverted_index[k]
-        self.inverted_index = sorted_index
+            The sorted vocabulary is front-coded into a TermDictionary, & the postings lists are addressed by term
+            id, through a read-only TermIndex: no terms can be added to the index afterwards."""
+        terms = sorted(self.inverted_index.keys())
+        postings = [self.inverted_index[term] for term in terms]
+        self.inverted_index = TermIndex(TermDictionary(terms), postings)
 
     def add_skip_connections(self):
-        """ For each postings list in the index, add skip pointers.
-            To be implemented."""
-        for t in self.inverted_index:
-            llist = LinkedList()
-            llist.insert_at_end(self.inverted_index.get(t))
-            llist.add_skip_connections()
-            self.inverted_index[t] = llist
+        """ For each postings list in the index, add skip pointers, placed by the skip policy.
+            Already implemented."""
+        for term, llist in self.inverted_index.items():
+            llist.add_skip_connections(self.skip_policy.skip_length(term, llist))
 
+    def replace_skips(self, skip_policy, terms):
+        """ Re-places the skip pointers of the postings lists of the terms with skip_policy, which also places those
+            of the lists re-built later on. The lists are re-placed on shallow copies, swapped into a new TermIndex
+            like merge_delta does, so queries running meanwhile keep consistent skips, & this works on a memory-mapped
+            index too. Returns the number of lists whose skips changed. The version is only bumped if there are any,
+            so that a call which changes nothing keeps the query cache & the query pool."""
+        with self.lock:
+            index, replaced = self.inverted_index, {}
+            for term in terms:
+                llist = index.get(term)
+                if llist is None:
+                    continue
+                placed = copy.copy(llist)
+                placed.add_skip_connections(skip_policy.skip_length(term, llist))
+                if (placed.skip_sources, placed.skip_targets) != (array('I', llist.skip_sources),
+                                                                  array('I', llist.skip_targets)):
+                    replaced[term] = placed
+            self.skip_policy = skip_policy
+            if replaced:
+                postings = [replaced.get(term) or index.postings_at(term_id) for term_id, term in enumerate(index)]
+                self.inverted_index = TermIndex(index.term_dictionary, postings)
+                self.live_postings = {}
+                self.version += 1
+            return len(replaced)
 
     def calculate_tf_idf(self):
         """ Calculate tf-idf score for each document in the postings lists of the index.
-            To be implemented."""
+            tf = term frequency / document length, idf = N / document frequency, with N the number of indexed
+            documents, as in data/sample_output.json. All the postings lists are concatenated & scored in a single
+            vectorized pass."""
+        postings_lists = list(self.inverted_index.values())
+        if not postings_lists:
+            return
+        lengths = np.fromiter((llist.length for llist in postings_lists), dtype=np.int64, count=len(postings_lists))
+        doc_ids = np.frombuffer(b''.join([llist.doc_ids for llist in postings_lists]), dtype=np.uint32)
+        tfs = np.frombuffer(b''.join([llist.tfs for llist in postings_lists]), dtype=np.uint32)
+
+        indexed_doc_ids = np.fromiter(self.doc_lengths.keys(), dtype=np.uint32, count=len(self.doc_lengths))
+        doc_lengths = np.fromiter(self.doc_lengths.values(), dtype=np.float64, count=len(self.doc_lengths))
+        order = np.argsort(indexed_doc_ids)
+        indexed_doc_ids, doc_lengths = indexed_doc_ids[order], doc_lengths[order]
+        posting_doc_lengths = doc_lengths[np.searchsorted(indexed_doc_ids, doc_ids)]
+
+        self.idf_n_docs = len(self.doc_lengths)
+        idfs = self.idf_n_docs / lengths
+        tfidfs = (tfs / posting_doc_lengths * np.repeat(idfs, lengths)).astype(np.float32)
+
+        scores, ends = memoryview(tfidfs.tobytes()).cast('f'), np.cumsum(lengths).tolist()
+        for llist, idf, start, end in zip(postings_lists, idfs.tolist(), [0] + ends, ends):
+            llist.idf = idf
+            llist.tfidfs = array('f', scores[start:end])
+        self.version += 1
+
+    def compress_postings(self):
+        """ Compresses the doc ids of every postings list of the finished index (see
+            LinkedList.compress). Call it last: the index can not be re-scored afterwards."""
+        for llist in self.inverted_index.values():
+            llist.compress()
+        self.compressed = True
+
+    def add_documents(self, tokenized_documents):
+        """ Adds (doc id, tokens) documents to the delta segment of the finished index. A document already in the
+            index is replaced: its postings in the main index are tombstoned, & those in the delta dropped."""
+        with self.lock:
+            for doc_id, tokenized_document in tokenized_documents:
+                self._drop_document(doc_id)
+                if self.positional:
+                    term_positions = self._term_positions(tokenized_document)
+                    for term, positions in term_positions.items():
+                        self.delta_positions.setdefault(term, {})[doc_id] = positions
+                    term_frequencies = {term: len(positions) for term, positions in term_positions.items()}
+                else:
+                    term_frequencies = Counter(tokenized_document)
+                for term, tf in term_frequencies.items():
+                    self.delta.setdefault(term, {})[doc_id] = tf
+                self.delta_doc_terms[doc_id] = list(term_frequencies)
+                self.doc_lengths[doc_id] = len(tokenized_document)
+            if not self.idf_n_docs:
+                self.idf_n_docs = len(self.doc_lengths)
+            self._delta_changed()
+
+    def delete_documents(self, doc_ids):
+        """ Deletes documents from the finished index: tombstones them in the main index & drops them from the
+            delta segment."""
+        with self.lock:
+            for doc_id in doc_ids:
+                self._drop_document(doc_id)
+                self.doc_lengths.pop(doc_id, None)
+            self._delta_changed()
+
+    def _drop_document(self, doc_id):
+        # A document of the delta segment was already tombstoned in the main index, when it was added.
+        if doc_id not in self.delta_doc_terms and (doc_id in self.doc_lengths or not self.doc_lengths_complete):
+            self.tombstones.add(doc_id)
+        for term in self.delta_doc_terms.pop(doc_id, ()):
+            del self.delta[term][doc_id]
+            if not self.delta[term]:
+                del self.delta[term]
+            if self.positional:
+                del self.delta_positions[term][doc_id]
+                if not self.delta_positions[term]:
+                    del self.delta_positions[term]
+
+    def _delta_changed(self):
+        self.live_postings, self.sorted_tombstones = {}, sorted(self.tombstones)
+        self.version += 1
+
+    def delta_stats(self):
+        return {"delta_documents": len(self.delta_doc_terms), "delta_terms": len(self.delta),
+                "tombstones": len(self.tombstones), "merges": self.n_merges, "index_version": self.version}
+
+    def get_postings(self, term):
+        """ Postings list of a term as queries should see it: the one of the main index, less the tombstoned
+            documents, merged with the delta segment. Returns None if the term has no postings."""
+        if not self.delta and not self.tombstones:
+            return self.inverted_index.get(term)
+        with self.lock:
+            if term not in self.live_postings:
+                self.live_postings[term] = self._merged_postings(term)
+            postings = self.live_postings[term]
+        return postings if postings.length else None
+
+    def get_all_documents(self):
+        """ Postings list of every live document, with 0 scores & skip pointers: what a NOT is taken from. It is
+            built from doc_lengths, or for a loaded index, from the union of the postings lists (which misses the
+            documents without any term), & cached until the index changes."""
+        with self.lock:
+            version, llist = self.all_documents
+            if version != self.version:
+                if self.doc_lengths_complete:
+                    doc_ids = self.doc_lengths.keys()
+                else:
+                    doc_ids = set()
+                    for postings in self.inverted_index.values():
+                        doc_ids.update(postings.doc_ids)
+                    doc_ids.difference_update(self.tombstones)
+                    doc_ids.update(self.delta_doc_terms)
+                llist = LinkedList.from_doc_ids(sorted(doc_ids))
+                llist.add_skip_connections()
+                self.all_documents = (self.version, llist)
+            return llist
+
+    def _tombstoned_positions(self, postings):
+        """ Positions of the tombstoned documents in a main postings list. The tombstones within the range of doc ids
+            of the list are binary searched in it, unless there are more of them than postings."""
+        doc_ids, positions = postings.doc_ids, set()
+        if not postings.length:
+            return positions
+        low = bisect_left(self.sorted_tombstones, doc_ids[0])
+        high = bisect_right(self.sorted_tombstones, doc_ids[-1], low)
+        if high - low > postings.length:
+            return {position for position, doc_id in enumerate(doc_ids) if doc_id in self.tombstones}
+        for doc_id in islice(self.sorted_tombstones, low, high):
+            position = bisect_left(doc_ids, doc_id)
+            if doc_ids[position] == doc_id:
+                positions.add(position)
+        return positions
+
+    def _merged_postings(self, term, tombstoned=None):
+        """ Merges the main postings list of a term, less its tombstoned positions, with the delta postings of the
+            term, & adds skip pointers, & the token positions of a positional index. With the new document
+            frequency df, idf = idf_n_docs / df: the scores are computed from the term frequencies, or for main
+            postings without them (e.g. from an index file), rescaled by the ratio of the idfs. As every idf keeps
+            the N of the last full scoring, scores stay comparable across terms, whether they were touched by a merge
+            or not."""
+        main = self.inverted_index.get(term) or LinkedList()
+        if tombstoned is None:
+            tombstoned = self._tombstoned_positions(main)
+        kept = [position for position in range(main.length) if position not in tombstoned]
+        delta = sorted(self.delta.get(term, {}).items())
+        df = len(kept) + len(delta)
+        merged = LinkedList()
+        if not df:
+            return merged
+        merged.idf = self.idf_n_docs / df
+        has_tfs = len(main.tfs) == main.length
+        if has_tfs and self.doc_lengths_complete:
+            main_postings = ((main.doc_ids[position], main.tfs[position] / self.doc_lengths[main.doc_ids[position]]
+                              * merged.idf, main.tfs[position]) for position in kept)
+        else:
+            scale = merged.idf / main.idf if main.idf else 0.0
+            main_postings = ((main.doc_ids[position], main.tfidfs[position] * scale, 0) for position in kept)
+        delta_postings = ((doc_id, tf / self.doc_lengths[doc_id] * merged.idf, tf) for doc_id, tf in delta)
+        for doc_id, score, tf in merge(main_postings, delta_postings, key=itemgetter(0)):
+            merged.doc_ids.append(doc_id)
+            merged.tfidfs.append(score)
+            merged.tfs.append(tf)
+        if not has_tfs and main.length:
+            merged.tfs = array('I')
+        if self.positional:
+            main_positions = {main.doc_ids[position]: main.get_positions(position) for position in kept} \
+                if main.has_positions else {}
+            delta_positions = self.delta_positions.get(term, {})
+            merged.set_positions(main_positions.get(doc_id) or delta_positions.get(doc_id, [])
+                                 for doc_id in merged.doc_ids)
+        merged.add_skip_connections(self.skip_policy.skip_length(term, merged))
+        if self.compressed:
+            merged.compress()
+        return merged
+
+    def merge_delta(self):
+        """ Folds the delta segment & the tombstones into the main index. Only the postings lists of the terms in
+            the delta, or holding a tombstoned document, are re-built, with their skip pointers & tf-idf scores.
+            The vocabulary is re-built if terms are added or removed."""
+        with self.lock:
+            if not self.delta and not self.tombstones:
+                return
+            rebuilt = {term: self._merged_postings(term) for term in self.delta}
+            if self.tombstones:
+                for term_id, term in enumerate(self.inverted_index):
+                    if term not in rebuilt:
+                        tombstoned = self._tombstoned_positions(self.inverted_index.postings_at(term_id))
+                        if tombstoned:
+                            rebuilt[term] = self._merged_postings(term, tombstoned)
+
+            index = self.inverted_index
+            if all(term in index for term in rebuilt) and all(llist.length for llist in rebuilt.values()):
+                postings = [rebuilt.get(term) or index.postings_at(term_id) for term_id, term in enumerate(index)]
+                self.inverted_index = TermIndex(index.term_dictionary, postings)
+            else:
+                postings_by_term = dict(index.items())
+                postings_by_term.update(rebuilt)
+                terms = sorted(postings_by_term)
+                postings = [postings_by_term[term] for term in terms]
+                kept = [position for position, llist in enumerate(postings) if llist.length]
+                self.inverted_index = TermIndex(TermDictionary(terms[position] for position in kept),
+                                                [postings[position] for position in kept])
+            self.delta, self.delta_doc_terms, self.tombstones = {}, {}, set()
+            self.n_merges += 1
+            self._delta_changed()
 
-        
-        raise NotImplementedError
+    def pack_positions(self):
+        """ Packs the token positions recorded while indexing into the postings lists (see LinkedList.set_positions),
+            in the order of their doc ids, & frees them."""
+        for term, llist in self.inverted_index.items():
+            doc_positions = self.positions.get(term, {})
+            llist.set_positions(doc_positions.get(doc_id, []) for doc_id in llist.doc_ids)
+        self.positions = {}
@@ -3,10 +3,16 @@
 Institute: University at Buffalo
 '''
 
-from locale import currency
 import math
-from turtle import position
-from unittest import skip
+from array import array
+from bisect import bisect_left
+from compressed_postings import CompressedDocIds, decode_varint, encode_varint
+
+
+POSITION_CHECKPOINT = 4
+# Skip arrays of the lists without skips, shared & read-only: most lists of a corpus are too short for skips
+NO_SKIPS = memoryview(b'').cast('I')
+
 
 class Node:
 
@@ -21,10 +27,243 @@ class Node:
         self.tfidf = 0.0
 
 
+class PostingNode:
+    """ Lightweight view of a single posting inside an array-backed LinkedList.
+        It exposes the same attributes as Node (value, next, skip, tfidf), but reads them from the
+        arrays of the parent list on access, so no object is kept alive per posting."""
+    __slots__ = ('postings', 'position')
+
+    def __init__(self, postings, position):
+        self.postings = postings
+        self.position = position
+
+    @property
+    def value(self):
+        return self.postings.doc_ids[self.position]
+
+    @property
+    def next(self):
+        return self.postings.node_at(self.position + 1)
+
+    @property
+    def skip(self):
+        target = self.postings.skip_target(self.position)
+        return None if target is None else self.postings.node_at(target)
+
+    @property
+    def tfidf(self):
+        return self.postings.tfidfs[self.position]
+
+    @tfidf.setter
+    def tfidf(self, score):
+        self.postings.tfidfs[self.position] = score
+
+
 class LinkedList:
-    """ Class to define a linked list (postings list). Each element in the linked list is of the type 'Node'
-        Each term in the inverted index has an associated linked list object.
-        Feel free to add additional functions to this class."""
+    """ Class to define a postings list. Doc ids are kept sorted in a compact array('I'), with parallel arrays of
+        term frequencies (array('I')) & tf-idf scores (array('f')). Skip pointers are stored as two parallel arrays of positions
+        (skip_sources[k] -> skip_targets[k]).
+        Node-style access (start_node, end_node, traverse_list) is still available through PostingNode views,
+        so code written against the Node based list keeps working.
+        A list of a positional index also has the token positions of the term in each document in position_data:
+        for each posting, the number of positions & their gaps, VByte encoded. position_checkpoints has the offset
+        of every POSITION_CHECKPOINT-th posting.
+        The optional parts cost nothing on the lists without them: a list without skips shares the empty NO_SKIPS,
+        & one without positions has None, while __slots__ saves a dict per list.
+        Each term in the inverted index has an associated linked list object."""
+    __slots__ = ('doc_ids', 'tfs', 'tfidfs', 'skip_sources', 'skip_targets', 'n_skips', 'idf', 'skip_length',
+                 'is_sorted', 'position_checkpoints', 'position_data')
+
+    def __init__(self):
+        self.doc_ids = array('I')
+        self.tfs = array('I')
+        self.tfidfs = array('f')
+        self.skip_sources = self.skip_targets = NO_SKIPS
+        self.n_skips, self.idf = 0, 0.0
+        self.skip_length = None
+        self.is_sorted = True
+        self.position_checkpoints, self.position_data = None, None
+
+    @classmethod
+    def from_doc_ids(cls, doc_ids, tfs=None):
+        """ Builds a postings list from doc ids that are already sorted & unique, & their term frequencies."""
+        llist = cls()
+        llist.doc_ids = array('I', doc_ids)
+        llist.tfs = array('I', [1] * llist.length if tfs is None else tfs)
+        llist.tfidfs = array('f', bytes(4 * llist.length))
+        return llist
+
+    @classmethod
+    def from_buffers(cls, doc_ids, tfidfs, skip_sources, skip_targets, idf):
+        """ Wraps existing buffers (e.g. memoryview slices of a memory-mapped index file) as a finished, read-only
+            postings list, without copying them. Term frequencies are not kept for such a list."""
+        llist = cls()
+        llist.doc_ids, llist.tfidfs = doc_ids, tfidfs
+        llist.skip_sources, llist.skip_targets = skip_sources, skip_targets
+        llist.n_skips, llist.idf = len(skip_sources), idf
+        if llist.n_skips:
+            llist.skip_length = skip_targets[0] - skip_sources[0]
+        return llist
+
+    @property
+    def length(self):
+        return len(self.doc_ids)
+
+    @property
+    def is_compressed(self):
+        return isinstance(self.doc_ids, CompressedDocIds)
+
+    def compress(self):
+        """ Gap encodes & packs the doc ids of the finished list (see CompressedDocIds); they are decoded lazily, a
+            block at a time, as the list is read. Term frequencies are dropped, as for a list read from an index file,
+            so the list can not be re-scored afterwards."""
+        if not self.is_compressed:
+            self.doc_ids, self.tfs = CompressedDocIds(self.doc_ids), array('I')
+
+    @property
+    def start_node(self):
+        return self.node_at(0)
+
+    @property
+    def end_node(self):
+        return self.node_at(self.length - 1)
+
+    @property
+    def has_positions(self):
+        return self.position_checkpoints is not None
+
+    def set_positions(self, position_lists):
+        """ Packs the token positions of each posting, given as increasing lists in the order of the postings."""
+        self.position_checkpoints, self.position_data = array('I'), bytearray()
+        for posting, positions in enumerate(position_lists):
+            if posting % POSITION_CHECKPOINT == 0:
+                self.position_checkpoints.append(len(self.position_data))
+            encode_varint(len(positions), self.position_data)
+            previous = 0
+            for token_position in positions:
+                encode_varint(token_position - previous, self.position_data)
+                previous = token_position
+
+    def get_positions(self, position):
+        """ Returns the token positions of the posting at the given position, as an increasing list. Decoding starts
+            from the closest checkpoint, & skips the positions of the postings in between."""
+        data = self.position_data
+        offset = self.position_checkpoints[position // POSITION_CHECKPOINT]
+        for _ in range(position % POSITION_CHECKPOINT):
+            count, offset = decode_varint(data, offset)
+            for _ in range(count):
+                while data[offset] >= 0x80:
+                    offset += 1
+                offset += 1
+        count, offset = decode_varint(data, offset)
+        positions, token_position = [], 0
+        for _ in range(count):
+            gap, offset = decode_varint(data, offset)
+            token_position += gap
+            positions.append(token_position)
+        return positions
+
+    def node_at(self, position):
+        """ Returns a PostingNode view for the posting at the given position, or None if out of range."""
+        if 0 <= position < self.length:
+            return PostingNode(self, position)
+        return None
+
+    def skip_target(self, position):
+        """ Returns the position the skip pointer of the given position points to, or None."""
+        k = bisect_left(self.skip_sources, position)
+        if k < len(self.skip_sources) and self.skip_sources[k] == position:
+            return self.skip_targets[k]
+        return None
+
+    def to_list(self):
+        """ Returns the doc ids of the postings list as a list of ints."""
+        return self.doc_ids.tolist()
+
+    def traverse_list(self):
+        if self.length == 0:
+            return
+        return [PostingNode(self, position) for position in range(self.length)]
+
+    def traverse_skips(self):
+        """ Returns the nodes visited by following skip pointers from the start node."""
+        if self.length == 0:
+            return
+        traversal = [PostingNode(self, 0)]
+        position = self.skip_target(0)
+        while position is not None:
+            traversal.append(PostingNode(self, position))
+            position = self.skip_target(position)
+        return traversal
+
+    def add_skip_connections(self, skip_length=None):
+        """ Adds floor(sqrt(n)) skip pointers (one less, if n is a perfect square), round(sqrt(n)) postings apart.
+            skip_length: place the skips this many postings apart instead (see skip_policy); 0 removes them.
+            This function does not return anything."""
+        self.skip_sources = self.skip_targets = NO_SKIPS
+        self.n_skips, self.skip_length = 0, None
+        if skip_length is None:
+            n_skips = math.floor(math.sqrt(self.length))
+            if n_skips * n_skips == self.length:
+                n_skips = n_skips - 1
+            if n_skips <= 0:
+                return
+            skip_length = round(math.sqrt(self.length))
+        elif skip_length < 2 or skip_length >= self.length:
+            return
+
+        self.skip_length = skip_length
+        self.skip_sources = array('I', range(0, self.length - skip_length, skip_length))
+        self.skip_targets = array('I', range(skip_length, self.length, skip_length))
+        self.n_skips = len(self.skip_sources)
+
+    def insert_at_end(self, value, tf=1):
+        """ Inserts the element at an appropriate position, such that elements to the left are lower than the
+            inserted element, and elements to the right are greater than the inserted element.
+            tf is the term frequency in the document; it is added to that of an element already in the list."""
+        position = bisect_left(self.doc_ids, value)
+        if position < self.length and self.doc_ids[position] == value:
+            self.tfs[position] += tf
+            return
+        self.doc_ids.insert(position, value)
+        self.tfs.insert(position, tf)
+        self.tfidfs.insert(position, 0.0)
+
+    def append(self, value, tf=1):
+        """ Appends the element in amortized O(1), without keeping the list sorted. Repeats of the last element
+            are merged right away; call sort_and_dedupe once all the elements have been appended."""
+        if self.length:
+            last = self.doc_ids[-1]
+            if last == value:
+                self.tfs[-1] += tf
+                return
+            if last > value:
+                self.is_sorted = False
+        self.doc_ids.append(value)
+        self.tfs.append(tf)
+        self.tfidfs.append(0.0)
+
+    def sort_and_dedupe(self):
+        """ Sorts the elements added through append, and merges duplicates, adding up their term frequencies.
+            A no-op if they came in order."""
+        if self.is_sorted:
+            return
+        tfs = {}
+        for doc_id, tf in zip(self.doc_ids, self.tfs):
+            tfs[doc_id] = tfs.get(doc_id, 0) + tf
+        self.doc_ids = array('I', sorted(tfs))
+        self.tfs = array('I', [tfs[doc_id] for doc_id in self.doc_ids])
+        self.tfidfs = array('f', bytes(4 * self.length))
+        self.is_sorted = True
+
+    def get_idf(self, n_docs):
+        """ Inverse document frequency of the term, given the number of documents in the index."""
+        self.idf = n_docs / self.length
+
+
+class NodeLinkedList:
+    """ Node-per-posting linked list. This was the original postings list implementation, and is kept as the
+        reference for benchmark.py."""
     def __init__(self):
         self.start_node = None
         self.end_node = None
@@ -48,48 +287,35 @@ class LinkedList:
         traversal = []
         if self.start_node is None:
             return
-        
+
         current_node:Node = self.start_node
 
         while (current_node):
             if current_node.skip not in traversal:
                 if current_node.skip:
                     traversal.append(current_node.skip)
-            current_node = current_node.next    
+            current_node = current_node.next
 
         return traversal
 
     def add_skip_connections(self):
-        traversal = self.traverse_list()
-        self.length = len(traversal)
+        """ Adds floor(sqrt(n)) skip pointers (one less, if n is a perfect square), round(sqrt(n)) postings apart,
+            as LinkedList does: every skip_length-th node skips to the node skip_length ahead.
+            This function does not return anything."""
+        traversal = self.traverse_list() or []
+        self.length, self.n_skips, self.skip_length = len(traversal), 0, None
+        for node in traversal:
+            node.skip = None
         n_skips = math.floor(math.sqrt(self.length))
         if n_skips * n_skips == self.length:
             n_skips = n_skips - 1
-        """ Write logic to add skip pointers to the linked list. 
-            This function does not return anything.
-            To be implemented."""
-
-        if n_skips <= 0: return
-        self.skip_length = math.floor((self.length) / (n_skips))
-        position = 0
-
-        while position < self.length:
-            skip_target = position + self.skip_length
-            while position < skip_target:
-                if skip_target >= self.length:
-                    traversal[position].skip = self.end_node
-                    position += 1
-                    return
-
-                traversal[position].skip = traversal[skip_target]
-                position += 1
-                if position == skip_target:
-                    skip_target = skip_target + self.skip_length
+        if n_skips <= 0:
             return
-            
-
-        
 
+        self.skip_length = round(math.sqrt(self.length))
+        for position in range(0, self.length - self.skip_length, self.skip_length):
+            traversal[position].skip = traversal[position + self.skip_length]
+            self.n_skips += 1
 
     def insert_at_end(self, value):
         """ Write logic to add new elements to the linked list.
@@ -97,11 +323,9 @@ class LinkedList:
             element, and elements to the right are greater than the inserted element.
             To be implemented. """
 
-        traversal = self.traverse_list()
-        
         #handle condition where empty
-        if not traversal:
-            self.start_node = Node(value)
+        if self.start_node is None:
+            self.start_node = self.end_node = Node(value)
             return
 
         temp_node = Node(value=value)
@@ -114,7 +338,7 @@ class LinkedList:
             return
 
         while (current_node):
-            if current_node.value == value: 
+            if current_node.value == value:
                 return
 
             if (current_node.value < value) and (current_node.next == None):
@@ -128,8 +352,22 @@ class LinkedList:
                 return
 
             current_node = current_node.next
-        
+
         raise ValueError('element was not inserted')
 
+    def append(self, value):
+        """ Links the element after end_node in O(1). Elements must be appended in increasing order."""
+        if self.end_node is not None and self.end_node.value >= value:
+            if self.end_node.value == value:
+                return
+            raise ValueError('elements must be appended in increasing order')
+        node = Node(value)
+        if self.start_node is None:
+            self.start_node = node
+        else:
+            self.end_node.next = node
+        self.end_node = node
+        self.length += 1
+
     def get_idf(self):
-        self.idf = math.log(5000 / (len(self.traverse_list())))
\ No newline at end of file
+        self.idf = math.log(5000 / (len(self.traverse_list())))
@@ -0,0 +1,193 @@
+'''
+Per-stage timing histograms & counters of the query server, exported in the Prometheus text format, & an optional
+sampling profiler. Everything is a no-op until enabled, so instrumented code only pays for a flag check.
+'''
+
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from functools import wraps
+
+# Upper bounds (in seconds) of the histogram buckets; a last +Inf bucket catches the rest.
+DEFAULT_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+PREFIX = 'project2'
+
+
+class Histogram:
+    """ Counts of the observed values in each bucket, with their sum, as a Prometheus histogram."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum, self.count = 0.0, 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class _Timer:
+    __slots__ = ('metrics', 'stage', 'start')
+
+    def __init__(self, metrics, stage):
+        self.metrics, self.stage = metrics, stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class SamplingProfiler:
+    """ Background thread which looks at the stack of every other thread each interval seconds, & counts the
+        innermost function of this package it is running, if any. Threads idling outside of the package (e.g. the
+        server waiting for a request) are not counted."""
+
+    def __init__(self, interval=0.005, root=os.path.dirname(os.path.abspath(__file__))):
+        self.interval, self.root = interval, root
+        self.samples, self.n_samples = Counter(), 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                while frame is not None and not frame.f_code.co_filename.startswith(self.root):
+                    frame = frame.f_back
+                if frame is not None:
+                    code = frame.f_code
+                    self.samples[f"{os.path.basename(code.co_filename)}:{code.co_name}"] += 1
+            self.n_samples += 1
+
+
+class Metrics:
+    """ Registry of the stage timings (one histogram per stage) & counters of the server.
+        timer(stage) is a context manager timing its block, & timed(stage) a decorator timing a function; both fall
+        through to the plain code when disabled. Counters take labels as keyword arguments."""
+
+    def __init__(self, enabled=False, buckets=DEFAULT_BUCKETS):
+        self.enabled, self.buckets = enabled, buckets
+        self.stages, self.counters = {}, Counter()
+        self.profiler = None
+        self.lock = threading.Lock()
+
+    def enable(self, profile_interval=None):
+        """ Starts recording, & the sampling profiler too if profile_interval (in seconds) is given."""
+        self.enabled = True
+        if profile_interval and self.profiler is None:
+            self.profiler = SamplingProfiler(profile_interval)
+            self.profiler.start()
+
+    def disable(self):
+        self.enabled = False
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+
+    def reset(self):
+        with self.lock:
+            self.stages, self.counters = {}, Counter()
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.stages.get(stage)
+            if histogram is None:
+                histogram = self.stages[stage] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def timer(self, stage):
+        return _Timer(self, stage) if self.enabled else _NULL_TIMER
+
+    def timed(self, stage):
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.observe(stage, time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def increment(self, name, value=1, **labels):
+        if self.enabled:
+            with self.lock:
+                self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def render(self, top_functions=50):
+        """ All the metrics, in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            stages, counters = {stage: (histogram.counts[:], histogram.sum, histogram.count)
+                                for stage, histogram in self.stages.items()}, dict(self.counters)
+        name = f'{PREFIX}_stage_seconds'
+        lines += [f'# HELP {name} Time spent in each stage of a request.', f'# TYPE {name} histogram']
+        for stage, (counts, total, count) in sorted(stages.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{_format_bound(bound)}"}} {cumulative}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {total}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {count}')
+        for counter in sorted({counter for counter, _ in counters}):
+            lines.append(f'# TYPE {PREFIX}_{counter} counter')
+            for (other, labels), value in sorted(counters.items()):
+                if other == counter:
+                    lines.append(f'{PREFIX}_{counter}{_format_labels(labels)} {value}')
+        lines.append(f'# TYPE {PREFIX}_metrics_enabled gauge')
+        lines.append(f'{PREFIX}_metrics_enabled {int(self.enabled)}')
+        profiler = self.profiler
+        if profiler is not None:
+            name = f'{PREFIX}_profile_samples'
+            lines += [f'# HELP {name} Samples of the innermost function of the package running in a thread.',
+                      f'# TYPE {name} counter']
+            for function, count in profiler.samples.most_common(top_functions):
+                lines.append(f'{name}{{function="{function}"}} {count}')
+            lines.append(f'{PREFIX}_profile_ticks {profiler.n_samples}')
+        return '\n'.join(lines) + '\n'
+
+
+def _format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+# Registry of the process, instrumented by run_project.
+METRICS = Metrics()
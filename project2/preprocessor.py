@@ -3,20 +3,46 @@
 Institute: University at Buffalo
 '''
 
-import collections
-from nltk.stem import PorterStemmer
 import re
-from nltk.corpus import stopwords
-import nltk
+from functools import lru_cache
 
-nltk.download('stopwords')
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+
+
+def load_stop_words():
+    """ Loads the NLTK english stopwords from the local nltk_data. Nothing is downloaded; install the corpus once with
+        `python3 -m nltk.downloader stopwords`."""
+    from nltk.corpus import stopwords
+    try:
+        return frozenset(stopwords.words('english'))
+    except LookupError:
+        raise LookupError("NLTK stopwords corpus not found. "
+                          "Install it once with: python3 -m nltk.downloader stopwords") from None
 
 
 class Preprocessor:
 
-    def __init__(self):
-        self.stop_words = set(stopwords.words('english'))
-        self.ps = PorterStemmer()
+    def __init__(self, remove_stopwords=False, stem=False, stem_cache_size=100000):
+        """ remove_stopwords: drop the NLTK english stopwords.
+            stem: Porter stem the tokens. Stems are memoized in an LRU cache of stem_cache_size terms, which catches
+            most tokens since term frequencies are Zipfian.
+            NLTK is only imported, & its resources only loaded, the first time they are needed."""
+        self.remove_stopwords, self.stem, self.stem_cache_size = remove_stopwords, stem, stem_cache_size
+        self._stop_words, self._stemmer = None, None
+
+    @property
+    def stop_words(self):
+        if self._stop_words is None:
+            self._stop_words = load_stop_words()
+        return self._stop_words
+
+    @property
+    def stemmer(self):
+        """ Memoized PorterStemmer().stem."""
+        if self._stemmer is None:
+            from nltk.stem import PorterStemmer
+            self._stemmer = lru_cache(maxsize=self.stem_cache_size)(PorterStemmer().stem)
+        return self._stemmer
 
     def get_doc_id(self, doc):
         """ Splits each line of the document, into doc_id & text.
@@ -25,14 +51,23 @@ class Preprocessor:
         return int(arr[0]), arr[1]
 
     def tokenizer(self, text):
-        """ Implement logic to pre-process & tokenize document text.
-            Write the code in such a way that it can be re-used for processing the user's query.
-            To be implemented."""
-        text = text.lower()
-        text = re.sub(r'[^a-z0-9]', ' ', text)
-        text = re.sub(r'^ ', '', text)
-        text = re.sub(r' $', '', text)
-        text = re.sub(r' +', ' ', text)
-        text = text.split()
-
-        return text
+        """ Pre-processes & tokenizes document text: lower cases it, & splits it on anything but [a-z0-9], in a
+            single pass of a precompiled regex. Then optionally removes stopwords & stems the tokens.
+            It is re-used for processing the user's query."""
+        return self.tokenize_many((text,))[0]
+
+    def tokenize_many(self, texts):
+        """ Tokenizes a batch of texts like tokenizer, returning a list of token lists. The regex, stopwords &
+            stemmer are looked up once for the whole batch."""
+        findall = TOKEN_PATTERN.findall
+        stop_words = self.stop_words if self.remove_stopwords else None
+        stemmer = self.stemmer if self.stem else None
+        batch = []
+        for text in texts:
+            tokens = findall(text.lower())
+            if stop_words is not None:
+                tokens = [token for token in tokens if token not in stop_words]
+            if stemmer is not None:
+                tokens = [stemmer(token) for token in tokens]
+            batch.append(tokens)
+        return batch
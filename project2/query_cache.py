@@ -0,0 +1,93 @@
+'''
+Size-bounded LRU caches for the query server.
+'''
+
+from collections import OrderedDict
+from threading import Lock
+
+
+class LRUCache:
+    """ Least recently used cache, bounded by a number of entries & optionally by a total weight (e.g. the number of
+        doc ids held by the cached postings). Keeps hit, miss & eviction counters. Thread safe."""
+
+    def __init__(self, max_entries, max_weight=None, weigh=None):
+        self.max_entries, self.max_weight = max_entries, max_weight
+        self.weigh = weigh if weigh is not None else (lambda value: 1)
+        self.entries = OrderedDict()
+        self.weight = 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self.lock = Lock()
+
+    def get(self, key):
+        """ Returns the cached value, or None on a miss."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        weight = self.weigh(value)
+        if self.max_entries <= 0 or (self.max_weight is not None and weight > self.max_weight):
+            return
+        with self.lock:
+            if key in self.entries:
+                self.weight -= self.entries.pop(key)[1]
+            self.entries[key] = (value, weight)
+            self.weight += weight
+            while len(self.entries) > self.max_entries or \
+                    (self.max_weight is not None and self.weight > self.max_weight):
+                self.weight -= self.entries.popitem(last=False)[1][1]
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.weight = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"entries": len(self.entries), "max_entries": self.max_entries,
+                "weight": self.weight, "max_weight": self.max_weight,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+class QueryCache:
+    """ The 2 cache levels of ProjectRunner: whole queries, keyed by their tokenized terms, & the intersections of
+        pairs of postings lists. Both are emptied whenever the version of the index they were filled from changes,
+        i.e. when the index is rebuilt or updated. Values are put with the version validated before computing them,
+        so that one computed from an older version is never cached after the caches were emptied."""
+
+    def __init__(self, max_queries=1024, max_pairs=4096, max_pair_postings=1000000):
+        self.queries = LRUCache(max_queries)
+        self.pairs = LRUCache(max_pairs, max_weight=max_pair_postings, weigh=lambda entry: entry[0].length)
+        self.index_version = None
+        self.invalidations = 0
+        self.lock = Lock()
+
+    def validate(self, index_version):
+        """ Empties both caches if they were filled from another version of the index. Returns index_version, to
+            put the values computed from it."""
+        with self.lock:
+            if index_version != self.index_version:
+                if self.index_version is not None:
+                    self.invalidations += 1
+                self.queries.clear()
+                self.pairs.clear()
+                self.index_version = index_version
+        return index_version
+
+    def put(self, level, key, value, index_version):
+        """ Puts the value in level (queries or pairs) if the caches still hold index_version, the version it was
+            computed from; drops it otherwise."""
+        with self.lock:
+            if index_version == self.index_version:
+                level.put(key, value)
+
+    def stats(self):
+        return {"queries": self.queries.stats(), "pairs": self.pairs.stats(),
+                "index_version": self.index_version, "invalidations": self.invalidations}
@@ -0,0 +1,136 @@
+'''
+Boolean query language (AND, OR, NOT & parentheses) & its cost-based planner.
+
+    query   := or_expr
+    or_expr := and_expr (OR and_expr)*
+    and_expr := not_expr ([AND] not_expr)*      adjacent operands are ANDed
+    not_expr := NOT not_expr | '(' query ')' | word
+
+Operators are only recognized in upper case, so that "and", "or" & "not" stay searchable words. Each word goes
+through the query tokenizer, & a word yielding several terms is the AND of them.
+Queries are parsed into nested tuples: ('TERM', term), ('AND', [operands]), ('OR', [operands]), ('NOT', operand),
+& ('ALL',), for the set of all the documents.
+'''
+
+import re
+
+QUERY_TOKEN_PATTERN = re.compile(r'\(|\)|[^\s()]+')
+OPERATORS = ('AND', 'OR', 'NOT')
+
+
+class QuerySyntaxError(ValueError):
+    pass
+
+
+def parse_query(query, tokenizer):
+    """ Parses a boolean query into its tree. tokenizer turns a word into its list of terms. Words without any term
+        (e.g. stopwords) are dropped; returns None if nothing is left."""
+    tokens = QUERY_TOKEN_PATTERN.findall(query)
+    if not tokens:
+        return None
+    node, position = _parse_or(tokens, 0, tokenizer)
+    if position < len(tokens):
+        raise QuerySyntaxError(f"unexpected {tokens[position]!r} at token {position}")
+    return node
+
+
+def _parse_or(tokens, position, tokenizer):
+    operands = []
+    node, position = _parse_and(tokens, position, tokenizer)
+    operands.append(node)
+    while position < len(tokens) and tokens[position] == 'OR':
+        node, position = _parse_and(tokens, position + 1, tokenizer)
+        operands.append(node)
+    return _combine('OR', operands), position
+
+
+def _parse_and(tokens, position, tokenizer):
+    operands = []
+    node, position = _parse_not(tokens, position, tokenizer)
+    operands.append(node)
+    while position < len(tokens) and tokens[position] not in ('OR', ')'):
+        if tokens[position] == 'AND':
+            position += 1
+        node, position = _parse_not(tokens, position, tokenizer)
+        operands.append(node)
+    return _combine('AND', operands), position
+
+
+def _parse_not(tokens, position, tokenizer):
+    if position >= len(tokens):
+        raise QuerySyntaxError("unexpected end of query")
+    token = tokens[position]
+    if token == 'NOT':
+        node, position = _parse_not(tokens, position + 1, tokenizer)
+        return (None if node is None else ('NOT', node)), position
+    if token == '(':
+        node, position = _parse_or(tokens, position + 1, tokenizer)
+        if position >= len(tokens) or tokens[position] != ')':
+            raise QuerySyntaxError("missing ')'")
+        return node, position + 1
+    if token in OPERATORS or token == ')':
+        raise QuerySyntaxError(f"unexpected {token!r} at token {position}")
+    return _combine('AND', [('TERM', term) for term in tokenizer(token)]), position + 1
+
+
+def _combine(operator, operands):
+    """ Builds an AND / OR node, dropping the empty operands, & unwrapping a single one."""
+    operands = [operand for operand in operands if operand is not None]
+    if not operands:
+        return None
+    if len(operands) == 1:
+        return operands[0]
+    return (operator, operands)
+
+
+def plan_query(node, postings_length, n_docs):
+    """ Rewrites a query tree into the plan to run, with its estimated cost (an upper bound of its number of
+        results): nested ANDs & ORs are flattened, double negations removed, & duplicate operands dropped.
+        The positive operands of an AND are ordered by increasing cost, so the intermediate results stay small, &
+        its negated operands become differences applied last, smallest first. An AND of negations only is taken
+        from ('ALL',). The operands of an OR are ordered by increasing cost too.
+        postings_length gives the length of the postings list of a term, & n_docs the number of documents."""
+    kind = node[0]
+    if kind == 'TERM':
+        return node, postings_length(node[1])
+    if kind == 'ALL':
+        return node, n_docs
+    if kind == 'NOT':
+        operand = node[1]
+        if operand[0] == 'NOT':
+            return plan_query(operand[1], postings_length, n_docs)
+        planned, cost = plan_query(operand, postings_length, n_docs)
+        return ('NOT', planned), max(n_docs - cost, 0)
+
+    operands = []
+    for operand in node[1]:
+        operands.extend(operand[1] if operand[0] == kind else [operand])
+    planned = {}
+    for operand in operands:
+        operand_plan, cost = plan_query(operand, postings_length, n_docs)
+        planned.setdefault(repr(operand_plan), (operand_plan, cost))
+    if kind == 'OR':
+        ordered = sorted(planned.values(), key=lambda entry: entry[1])
+        return ('OR', [plan for plan, _ in ordered]), min(sum(cost for _, cost in ordered), n_docs)
+
+    positives = sorted((entry for entry in planned.values() if entry[0][0] != 'NOT'), key=lambda entry: entry[1])
+    negatives = sorted(((plan[1], n_docs - cost) for plan, cost in planned.values() if plan[0] == 'NOT'),
+                       key=lambda entry: entry[1])
+    if not positives:
+        positives = [(('ALL',), n_docs)]
+    plan = ('AND', [plan for plan, _ in positives] + [('NOT', plan) for plan, _ in negatives])
+    if len(plan[1]) == 1:
+        return positives[0]
+    return plan, positives[0][1]
+
+
+def explain(plan):
+    """ Plan tree as a string, e.g. (AND covid (OR vaccin mask) (NOT hoax))."""
+    kind = plan[0]
+    if kind == 'TERM':
+        return plan[1]
+    if kind == 'ALL':
+        return '*'
+    if kind == 'NOT':
+        return f"(NOT {explain(plan[1])})"
+    return f"({kind} {' '.join(explain(operand) for operand in plan[1])})"
@@ -7,9 +7,16 @@ from typing import Dict, List, Tuple
 from tqdm import tqdm
 from preprocessor import Preprocessor
 from indexer import Indexer
-from collections import OrderedDict
+from collections import OrderedDict, deque
 from linkedlist import LinkedList
+from compressed_postings import CompressedDocIds
+from index_file import MappedIndex
+from query_cache import QueryCache
+from metrics import METRICS
+from query_planner import QuerySyntaxError, explain, parse_query, plan_query
+from skip_policy import AdaptiveSkipPolicy
 import inspect as inspector
+import os
 import sys
 import argparse
 import json
@@ -19,35 +26,485 @@ import flask
 from flask import Flask
 from flask import request
 import hashlib
+from bisect import bisect_left
+from heapq import heapify, heappop, heapreplace, nsmallest
+from concurrent.futures import ThreadPoolExecutor, wait
+from itertools import islice
+from multiprocessing import Pool, get_context
+from threading import Lock, RLock
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 app = Flask(__name__)
+output_writer = ThreadPoolExecutor(max_workers=1)
+_pooled_runner = None
+# Responses of batches of at least this many queries are streamed, one section of output_dict at a time.
+STREAM_THRESHOLD = 100
+
+
+def _index_chunk(lines, remove_stopwords=False, stem=False, positional=False):
+    """ Worker of the parallel run_indexer. Tokenizes & indexes a chunk of corpus lines into a partial index."""
+    preprocessor = Preprocessor(remove_stopwords=remove_stopwords, stem=stem)
+    indexer = Indexer(append_only=True, positional=positional)
+    doc_ids, documents = zip(*map(preprocessor.get_doc_id, lines))
+    for doc_id, tokenized_document in zip(doc_ids, preprocessor.tokenize_many(documents)):
+        indexer.generate_inverted_index(doc_id, tokenized_document)
+    indexer.sort_postings()
+    return indexer.get_partial_index()
+
+
+def _init_query_worker():
+    """ Initializer of the query pool workers. A lock held by another thread of the parent when it forked stays held
+        in the child, where that thread does not exist: the worker starts with fresh ones."""
+    _pooled_runner.indexer.lock = RLock()
+    cache = _pooled_runner.cache
+    cache.lock, cache.queries.lock, cache.pairs.lock = Lock(), Lock(), Lock()
+    METRICS.lock = Lock()
+
+
+def _run_pooled_query(key):
+    """ Worker of the query pool. Runs a (terms, top_k) query against the index inherited from the parent process."""
+    input_term_arr, top_k = key
+    return _pooled_runner._run_query(input_term_arr, top_k)
+
+
+def _write_output(data, location):
+    """ Writes the already serialized output_dict to the output file."""
+    with METRICS.timer('write_output'), open(location, 'wb') as fp:
+        fp.write(data)
+
+
+def _dumps(obj) -> bytes:
+    """ Compact JSON encoding, with orjson if it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def _response_chunks(output_dict, start_time, location=None):
+    """ Yields the execute_query response as JSON chunks: output_dict under "Response", one section at a time, then
+        time_taken & username_hash. Each section is serialized once, & the same bytes are written to the output file
+        at location (if any) in the background, once all of them are out."""
+    sections, serialize_time = [], 0.0
+    yield b'{"Response":{'
+    for position, (section, results) in enumerate(output_dict.items()):
+        start = time.perf_counter()
+        chunk = _dumps(section) + b':' + _dumps(results)
+        serialize_time += time.perf_counter() - start
+        sections.append(chunk)
+        yield b',' + chunk if position else chunk
+    if METRICS.enabled:
+        METRICS.observe('serialize', serialize_time)
+    if location:
+        output_writer.submit(_write_output, b'{' + b','.join(sections) + b'}', location)
+    yield b'},"time_taken":' + _dumps(str(time.time() - start_time)) + \
+        b',"username_hash":' + _dumps(username_hash) + b'}'
+
+
+def _observed_request(chunks, start_time):
+    """ Yields the chunks of a streamed response, & records the request latency once they are all out (or the
+        client went away), as the request is only over then."""
+    try:
+        yield from chunks
+    finally:
+        if METRICS.enabled:
+            METRICS.observe('request', time.time() - start_time)
 
 
 class ProjectRunner:
-    def __init__(self):
-        self.preprocessor = Preprocessor()
-        self.indexer = Indexer()
-
-    def _merge(self, query_terms: List[str]) -> Dict[str, List[int]]:
-        """ Implement the merge algorithm to merge 2 postings list at a time.
-            Use appropriate parameters & return types.
-            While merging 2 postings list, preserve the maximum tf-idf value of a document.
-            To be implemented."""
-        raise NotImplementedError
-
-    def _daat_and(self):
-        """ Implement the DAAT AND algorithm, which merges the postings list of N query terms.
-            Use appropriate parameters & return types.
-            To be implemented."""
-        raise NotImplementedError
-
+    def __init__(self, cache=None, preprocessor=None, merge_threshold=1000, positional=False):
+        """ merge_threshold: number of added or deleted documents, after which the delta segment of the index is
+            merged into the main index, in the background.
+            positional: build a positional index, which phrase queries need."""
+        self.preprocessor = Preprocessor() if preprocessor is None else preprocessor
+        self.indexer = Indexer(append_only=True, positional=positional)
+        self.cache = QueryCache() if cache is None else cache
+        self.query_pool, self.query_workers, self.query_pool_version = None, 1, None
+        self.pool_lock = Lock()
+        self.merge_threshold = merge_threshold
+        self.merger, self.pending_merge = ThreadPoolExecutor(max_workers=1), None
+        self.query_log = None
+
+    def start_query_pool(self, workers):
+        """ Forks a pool of worker processes, which run the queries of a batch in parallel. The index is read-only
+            once built, so the workers share it with this process copy-on-write; the doc ids & scores live in array
+            buffers, whose pages reference counting does not touch. The pool is re-forked if the index changes.
+            The fork waits for a pending merge & holds the index lock, so that the workers never see a half-updated
+            index, & pool_lock, so that no batch is running on the pool it replaces."""
+        with self.pool_lock:
+            self._fork_query_pool(workers)
+
+    def _fork_query_pool(self, workers):
+        # Called with pool_lock held
+        global _pooled_runner
+        self._stop_query_pool()
+        if self.pending_merge is not None:
+            wait([self.pending_merge])
+        with self.indexer.lock:
+            _pooled_runner = self
+            self.query_pool = get_context('fork').Pool(workers, initializer=_init_query_worker)
+            self.query_workers, self.query_pool_version = workers, self.indexer.version
+
+    def stop_query_pool(self):
+        with self.pool_lock:
+            self._stop_query_pool()
+
+    def _stop_query_pool(self):
+        if self.query_pool is not None:
+            self.query_pool.terminate()
+            self.query_pool = None
+
+    @METRICS.timed('merge')
+    def _merge(self, postings1: LinkedList, postings2: LinkedList, use_skips=False,
+               galloping=False, skip_counts=None) -> Tuple[LinkedList, int]:
+        """ Merges (intersects) 2 postings lists, & returns the intersection with the number of doc id comparisons.
+            use_skips: follow the skip pointers of a list, as long as they do not jump past the other list's doc id.
+            galloping: advance a list with an exponential + binary search instead. This needs random access to the
+            doc ids, so it is only meant for the array-backed postings, & pays off when the list lengths are skewed.
+            Comparisons count the doc id comparisons between the 2 lists, as expected for num_comparisons. Looking at
+            a skip target is not counted; the probes of a galloping search are.
+            skip_counts: a list to which the number of skip checks & of skips taken on each list are added, as
+            [checks1, taken1, checks2, taken2].
+            While merging 2 postings list, the maximum tf-idf value of a document is preserved."""
+        ids1, ids2 = postings1.doc_ids, postings2.doc_ids
+        scores1, scores2 = postings1.tfidfs, postings2.tfidfs
+        len1, len2 = len(ids1), len(ids2)
+        merged = LinkedList()
+        i = j = comparisons = 0
+        checks1 = taken1 = checks2 = taken2 = 0
+        # Index of the next skip pointer of each list, & the position it starts from.
+        cursor1 = cursor2 = 0
+        next_skip1 = postings1.skip_sources[0] if use_skips and postings1.n_skips else len1
+        next_skip2 = postings2.skip_sources[0] if use_skips and postings2.n_skips else len2
+        while i < len1 and j < len2:
+            id1, id2 = ids1[i], ids2[j]
+            comparisons += 1
+            if id1 == id2:
+                merged.doc_ids.append(id1)
+                merged.tfidfs.append(max(scores1[i], scores2[j]))
+                i, j = i + 1, j + 1
+            elif id1 < id2:
+                if galloping:
+                    i, probes = self._gallop(ids1, i, id2)
+                    comparisons += probes
+                elif i >= next_skip1:
+                    position, checks1 = i, checks1 + 1
+                    i, cursor1 = self._skip_forward(postings1, i, id2, cursor1)
+                    taken1 += i > position + 1
+                    next_skip1 = postings1.skip_sources[cursor1] if cursor1 < postings1.n_skips else len1
+                else:
+                    i += 1
+            else:
+                if galloping:
+                    j, probes = self._gallop(ids2, j, id1)
+                    comparisons += probes
+                elif j >= next_skip2:
+                    position, checks2 = j, checks2 + 1
+                    j, cursor2 = self._skip_forward(postings2, j, id1, cursor2)
+                    taken2 += j > position + 1
+                    next_skip2 = postings2.skip_sources[cursor2] if cursor2 < postings2.n_skips else len2
+                else:
+                    j += 1
+        if skip_counts is not None:
+            for k, count in enumerate((checks1, taken1, checks2, taken2)):
+                skip_counts[k] += count
+        return merged, comparisons
+
+    @METRICS.timed('merge')
+    def _merge_difference(self, postings1: LinkedList, postings2: LinkedList,
+                          use_skips=False) -> Tuple[LinkedList, int]:
+        """ Difference merge: the documents of postings1 which are not in postings2, with their postings1 tf-idf, &
+            the number of doc id comparisons. Every document of postings1 is kept or dropped on its own, so only
+            postings2 follows its skip pointers."""
+        ids1, ids2, scores1 = postings1.doc_ids, postings2.doc_ids, postings1.tfidfs
+        len1, len2 = len(ids1), len(ids2)
+        merged = LinkedList()
+        i = j = comparisons = cursor = 0
+        next_skip = postings2.skip_sources[0] if use_skips and postings2.n_skips else len2
+        while i < len1 and j < len2:
+            id1, id2 = ids1[i], ids2[j]
+            comparisons += 1
+            if id1 == id2:
+                i, j = i + 1, j + 1
+            elif id1 < id2:
+                merged.doc_ids.append(id1)
+                merged.tfidfs.append(scores1[i])
+                i += 1
+            elif j >= next_skip:
+                j, cursor = self._skip_forward(postings2, j, id1, cursor)
+                next_skip = postings2.skip_sources[cursor] if cursor < postings2.n_skips else len2
+            else:
+                j += 1
+        for position in range(i, len1):
+            merged.doc_ids.append(ids1[position])
+            merged.tfidfs.append(scores1[position])
+        return merged, comparisons
+
+    @staticmethod
+    @METRICS.timed('merge')
+    def _merge_union(postings_lists: List[LinkedList]) -> Tuple[LinkedList, int]:
+        """ k-way union of postings lists, through a min-heap holding the current doc id of each list. A document in
+            several lists keeps its max tf-idf. Returns the union & the (estimated) number of doc id comparisons:
+            log2 of the heap size per heap operation."""
+        postings_lists = [llist for llist in postings_lists if llist.length]
+        heap = [(llist.doc_ids[0], k) for k, llist in enumerate(postings_lists)]
+        heapify(heap)
+        positions = [0] * len(postings_lists)
+        merged, comparisons = LinkedList(), len(heap)
+        while heap:
+            doc_id, k = heap[0]
+            llist, position = postings_lists[k], positions[k]
+            score = llist.tfidfs[position]
+            if merged.doc_ids and merged.doc_ids[-1] == doc_id:
+                merged.tfidfs[-1] = max(merged.tfidfs[-1], score)
+            else:
+                merged.doc_ids.append(doc_id)
+                merged.tfidfs.append(score)
+            comparisons += len(heap).bit_length() - 1
+            positions[k] = position = position + 1
+            if position < llist.length:
+                heapreplace(heap, (llist.doc_ids[position], k))
+            else:
+                heappop(heap)
+        return merged, comparisons
+
+    @staticmethod
+    def _skip_forward(postings: LinkedList, position: int, doc_id: int, cursor: int) -> Tuple[int, int]:
+        """ Follows the skip pointers from position, while they do not jump past doc_id. Moves to the next posting if
+            no skip was taken. cursor is the index of the first skip pointer whose source is >= position, which
+            saves searching the skip pointers on every call. Returns the new position & cursor."""
+        sources, targets, doc_ids = postings.skip_sources, postings.skip_targets, postings.doc_ids
+        n_skips, skipped = len(sources), False
+        while cursor < n_skips and sources[cursor] < position:
+            cursor += 1
+        while cursor < n_skips and sources[cursor] == position and doc_ids[targets[cursor]] <= doc_id:
+            position, skipped = targets[cursor], True
+            while cursor < n_skips and sources[cursor] < position:
+                cursor += 1
+        if not skipped:
+            position += 1
+            while cursor < n_skips and sources[cursor] < position:
+                cursor += 1
+        return position, cursor
+
+    @staticmethod
+    def _gallop(doc_ids, position: int, doc_id: int) -> Tuple[int, int]:
+        """ Finds the first position after position whose doc id is >= doc_id, probing 1, 2, 4, ... postings ahead &
+            binary searching the last range. Returns the new position & the (estimated) number of comparisons."""
+        n, bound, comparisons = len(doc_ids), 1, 0
+        while position + bound < n:
+            comparisons += 1
+            if doc_ids[position + bound] >= doc_id:
+                break
+            bound *= 2
+        low, high = position + bound // 2 + 1, min(position + bound, n)
+        comparisons += max(high - low, 0).bit_length()
+        if isinstance(doc_ids, CompressedDocIds):
+            return doc_ids.search(doc_id, low), comparisons
+        return bisect_left(doc_ids, doc_id, low, high), comparisons
+
+    def _daat_and(self, query_terms: List[str], use_skips=False, galloping=False) -> Tuple[LinkedList, int]:
+        """ Implements the DAAT AND algorithm, which merges the postings list of N query terms, 2 at a time.
+            The postings lists are merged in increasing order of length, so the intermediate result stays as small
+            as possible. Returns the resulting postings list (with the max tf-idf of each document) & the total
+            number of comparisons."""
+        terms = sorted(dict.fromkeys(query_terms), key=lambda term: self._get_postings(term).length)
+        if not terms:
+            return LinkedList(), 0
+        if len(terms) == 1:
+            return self._get_postings(terms[0]), 0
+        result, comparisons = self._merge_pair(terms[0], terms[1], use_skips=use_skips, galloping=galloping)
+        for term in terms[2:]:
+            if result.length == 0:
+                break
+            result, merge_comparisons = self._merge(result, self._get_postings(term), use_skips=use_skips,
+                                                    galloping=galloping)
+            comparisons += merge_comparisons
+        return result, comparisons
+
+    def _log_skip_usage(self, query_terms: List[str], skip_policy):
+        """ Runs the skip-aware DAAT AND of a query like _daat_and, without the pair cache, & records in skip_policy
+            (see AdaptiveSkipPolicy.record), for each postings list merged, the length of the list it was merged with,
+            & the number of skip checks & skips taken on it."""
+        terms = sorted(dict.fromkeys(query_terms), key=lambda term: self._get_postings(term).length)
+        if len(terms) < 2:
+            return
+        result, first_term = self._get_postings(terms[0]), terms[0]
+        for term in terms[1:]:
+            if result.length == 0:
+                break
+            postings, skip_counts = self._get_postings(term), [0, 0, 0, 0]
+            merged, _ = self._merge(result, postings, use_skips=True, skip_counts=skip_counts)
+            if first_term is not None:
+                skip_policy.record(first_term, postings.length, skip_counts[0], skip_counts[1])
+                first_term = None
+            skip_policy.record(term, result.length, skip_counts[2], skip_counts[3])
+            result = merged
+
+    def adapt_skips(self, skip_policy=None, queries=None):
+        """ Re-places the skip pointers of the hot postings lists from the merges of queries (lists of terms), by
+            default the logged ones (see log_queries), with skip_policy (a new AdaptiveSkipPolicy by default).
+            Returns the number of lists whose skips changed."""
+        skip_policy = AdaptiveSkipPolicy() if skip_policy is None else skip_policy
+        for query_terms in (self.query_log or ()) if queries is None else queries:
+            self._log_skip_usage(query_terms, skip_policy)
+        return self.indexer.replace_skips(skip_policy, skip_policy.hot_terms())
+
+    def log_queries(self, max_queries):
+        """ Keeps the terms of the last max_queries queries of run_queries, for adapt_skips. 0 stops logging."""
+        self.query_log = deque(self.query_log or (), maxlen=max_queries) if max_queries > 0 else None
+
+    def _merge_pair(self, term1: str, term2: str, use_skips=False, galloping=False) -> Tuple[LinkedList, int]:
+        """ _merge of the postings lists of 2 terms, cached in the pair level of self.cache."""
+        index_version = self.cache.validate(self.indexer.version)
+        key = (min(term1, term2), max(term1, term2), use_skips, galloping)
+        cached = self.cache.pairs.get(key)
+        if cached is None:
+            cached = self._merge(self._get_postings(term1), self._get_postings(term2), use_skips=use_skips,
+                                 galloping=galloping)
+            self.cache.put(self.cache.pairs, key, cached, index_version)
+        return cached
+
+    @METRICS.timed('lookup')
     def _get_postings(self, term: str) -> LinkedList:
         """ Function to get the postings list of a term from the index.
-            Use appropriate parameters & return types.
-            To be implemented."""
-        return self.indexer.inverted_index[term]
- 
+            Returns an empty postings list for terms which are not in the index."""
+        postings = self.indexer.get_postings(term)
+        return LinkedList() if postings is None else postings
+
+    def _phrase_query(self, query_terms: List[str], slop=0) -> Tuple[List[int], int, int, int]:
+        """ Phrase query: the documents where the query terms occur in order, each within slop extra tokens of the
+            previous one (slop=0 matches the exact phrase). A skip-aware DAAT AND finds the candidate documents
+            first, & positions are only decoded & checked for those.
+            Returns the matching doc ids, the number of candidates, & the doc id & position comparisons."""
+        candidates, comparisons = self._daat_and(query_terms, use_skips=True)
+        postings = {term: self._get_postings(term) for term in dict.fromkeys(query_terms)}
+        if any(llist.length and not llist.has_positions for llist in postings.values()):
+            raise ValueError("the index has no token positions; build it with --positional")
+        cursors = dict.fromkeys(postings, 0)
+        matches, position_comparisons = [], 0
+        for doc_id in candidates.to_list():
+            for term, llist in postings.items():
+                cursors[term] = bisect_left(llist.doc_ids, doc_id, cursors[term])
+            matched, probes = self._phrase_match(
+                [postings[term].get_positions(cursors[term]) for term in query_terms], slop)
+            position_comparisons += probes
+            if matched:
+                matches.append(doc_id)
+        return matches, candidates.length, comparisons, position_comparisons
+
+    @staticmethod
+    def _phrase_match(position_lists: List[List[int]], slop: int) -> Tuple[bool, int]:
+        """ Whether some position of each list follows a reachable position of the previous list by 1 to slop + 1
+            tokens. The positions reachable through each list are found in a single 2 pointer pass.
+            Returns the result & the number of position comparisons."""
+        reachable, comparisons = position_lists[0], 0
+        for positions in position_lists[1:]:
+            following, k = [], 0
+            for position in positions:
+                while k < len(reachable) and reachable[k] < position - 1 - slop:
+                    k += 1
+                    comparisons += 1
+                comparisons += 1
+                if k < len(reachable) and reachable[k] < position:
+                    following.append(position)
+            if not following:
+                return False, comparisons
+            reachable = following
+        return bool(reachable), comparisons
+
+    def run_phrase_queries(self, query_list, slop=0):
+        """ Runs phrase queries (see _phrase_query), & returns their {results, num_docs, num_candidates,
+            num_comparisons, num_position_comparisons}, by query."""
+        output = {}
+        for query, query_terms in zip(query_list, self.preprocessor.tokenize_many(query_list)):
+            if not query_terms:
+                matches, n_candidates, comparisons, position_comparisons = [], 0, 0, 0
+            else:
+                matches, n_candidates, comparisons, position_comparisons = self._phrase_query(query_terms, slop)
+            output[query.strip()] = {'results': matches, 'num_docs': len(matches), 'num_candidates': n_candidates,
+                                     'num_comparisons': comparisons,
+                                     'num_position_comparisons': position_comparisons}
+        return output
+
+    def _plan_boolean_query(self, query: str):
+        """ Parses a boolean query (see query_planner) with the query tokenizer, & plans it with the postings list
+            lengths as costs. Returns the plan & its estimated number of results, or (None, 0) for an empty query."""
+        node = parse_query(query, self.preprocessor.tokenizer)
+        if node is None:
+            return None, 0
+        n_docs = max(self.indexer.idf_n_docs, len(self.indexer.doc_lengths))
+        return plan_query(node, lambda term: self._get_postings(term).length, n_docs)
+
+    def _execute_plan(self, plan, comparisons: Dict[str, int], use_skips=True) -> LinkedList:
+        """ Runs a boolean query plan, adding the doc id comparisons of each operator to comparisons. The operands
+            of an AND are intersected 2 at a time in the planned order, then its negated operands are removed with
+            difference merges, stopping as soon as the result is empty. A NOT on its own is the difference with all
+            the documents, & an OR the k-way union of its operands."""
+        kind = plan[0]
+        if kind == 'TERM':
+            return self._get_postings(plan[1])
+        if kind == 'ALL':
+            return self.indexer.get_all_documents()
+        if kind == 'NOT':
+            operand = self._execute_plan(plan[1], comparisons, use_skips)
+            result, merge_comparisons = self._merge_difference(self.indexer.get_all_documents(), operand, use_skips)
+            comparisons['NOT'] += merge_comparisons
+            return result
+        if kind == 'OR':
+            result, merge_comparisons = self._merge_union([self._execute_plan(operand, comparisons, use_skips)
+                                                           for operand in plan[1]])
+            comparisons['OR'] += merge_comparisons
+            return result
+        result = self._execute_plan(plan[1][0], comparisons, use_skips)
+        for operand in plan[1][1:]:
+            if result.length == 0:
+                break
+            if operand[0] == 'NOT':
+                result, merge_comparisons = self._merge_difference(
+                    result, self._execute_plan(operand[1], comparisons, use_skips), use_skips)
+                comparisons['NOT'] += merge_comparisons
+            else:
+                result, merge_comparisons = self._merge(
+                    result, self._execute_plan(operand, comparisons, use_skips), use_skips=use_skips)
+                comparisons['AND'] += merge_comparisons
+        return result
+
+    def run_boolean_queries(self, query_list, use_skips=True):
+        """ Runs boolean queries (AND, OR, NOT & parentheses, see query_planner), & returns their {results, num_docs,
+            num_comparisons, comparisons (by operator), plan, estimated_docs}, by query. Results are in increasing
+            doc id order. Raises QuerySyntaxError for a malformed query."""
+        output = {}
+        for query in query_list:
+            plan, estimated_docs = self._plan_boolean_query(query)
+            comparisons = dict.fromkeys(('AND', 'OR', 'NOT'), 0)
+            result = LinkedList() if plan is None else self._execute_plan(plan, comparisons, use_skips)
+            op_no_score, results_cnt = self._output_formatter(result.to_list())
+            output[query.strip()] = {'results': op_no_score, 'num_docs': results_cnt,
+                                     'num_comparisons': sum(comparisons.values()), 'comparisons': comparisons,
+                                     'plan': None if plan is None else explain(plan),
+                                     'estimated_docs': estimated_docs}
+        return output
+
+    @staticmethod
+    @METRICS.timed('sort')
+    def _sort_by_tf_idf(postings: LinkedList) -> List[int]:
+        """ Doc ids of the postings list, by decreasing tf-idf. Ties keep the increasing doc id order."""
+        order = sorted(range(postings.length), key=lambda position: -postings.tfidfs[position])
+        return [postings.doc_ids[position] for position in order]
+
+    @staticmethod
+    @METRICS.timed('sort')
+    def _top_k_by_tf_idf(postings: LinkedList, top_k: int) -> List[int]:
+        """ The first top_k doc ids of _sort_by_tf_idf, with a bounded heap instead of a full sort."""
+        tfidfs = postings.tfidfs
+        # nsmallest is stable like sorted, so ties keep the increasing doc id order
+        order = nsmallest(max(top_k, 0), range(postings.length), key=lambda position: -tfidfs[position])
+        return [postings.doc_ids[position] for position in order]
 
     def _output_formatter(self, op):
         """ This formats the result in the required format.
@@ -58,18 +515,98 @@ class ProjectRunner:
         results_cnt = len(op_no_score)
         return op_no_score, results_cnt
 
-    def run_indexer(self, corpus):
+    def run_indexer(self, corpus, workers=1, chunk_size=1000, compress=False):
         """ This function reads & indexes the corpus. After creating the inverted index,
             it sorts the index by the terms, add skip pointers, and calculates the tf-idf scores.
+            The corpus is streamed through read -> get_doc_id -> tokenizer -> generate_inverted_index, so it is never
+            loaded in memory as a whole.
+            With workers > 1, chunks of chunk_size lines are indexed in parallel processes, and the partial indexes
+            are merged into the same index a serial run would build.
+            compress: compress the doc ids of the finished postings lists.
             Already implemented, but you can modify the orchestration, as you seem fit."""
-        with open(corpus, 'r') as fp:
-            for line in tqdm(fp.readlines()):
-                doc_id, document = self.preprocessor.get_doc_id(line)
-                tokenized_document = self.preprocessor.tokenizer(document)
+        if workers > 1:
+            self._run_parallel_indexer(corpus, workers, chunk_size)
+        else:
+            documents = map(self.preprocessor.get_doc_id, self._read_corpus(corpus))
+            tokenized_documents = ((doc_id, self.preprocessor.tokenizer(document)) for doc_id, document in documents)
+            for doc_id, tokenized_document in tokenized_documents:
                 self.indexer.generate_inverted_index(doc_id, tokenized_document)
+        self.indexer.sort_postings()
         self.indexer.sort_terms()
+        if self.indexer.positional:
+            self.indexer.pack_positions()
         self.indexer.add_skip_connections()
         self.indexer.calculate_tf_idf()
+        if compress:
+            self.indexer.compress_postings()
+
+    def save_index(self, path):
+        """ Writes the index to a binary index file, with the preprocessing options its terms were built with."""
+        self.indexer.save_index(path, remove_stopwords=self.preprocessor.remove_stopwords,
+                                stem=self.preprocessor.stem)
+
+    def load_index(self, path, compress=False):
+        """ Memory-maps an index file written by save_index. Raises a ValueError, before loading it, if the file
+            does not match the options of this runner: its terms were built with other preprocessing options, which
+            would tokenize the queries into other terms, its doc ids are (not) compressed while compress is (not)
+            set, or this runner is positional, as the file has no token positions."""
+        index = MappedIndex(path)
+        mismatches = [f'{option}={recorded} in the file' for option, recorded, expected in (
+            ('remove_stopwords', index.remove_stopwords, self.preprocessor.remove_stopwords),
+            ('stem', index.stem, self.preprocessor.stem),
+            ('compress', index.compressed, compress)) if recorded != expected]
+        if self.indexer.positional:
+            mismatches.append('no token positions in the file, which a positional index needs')
+        if mismatches:
+            raise ValueError(f'{path} does not match the index options: {", ".join(mismatches)}')
+        self.indexer.load_index(path)
+
+    @staticmethod
+    def _read_corpus(corpus, chunk_bytes=1 << 20):
+        """ Yields the lines of the corpus, reading roughly chunk_bytes at a time. Progress is reported in bytes."""
+        with open(corpus, 'rb') as fp, tqdm(total=os.path.getsize(corpus), unit='B', unit_scale=True) as progress:
+            lines = fp.readlines(chunk_bytes)
+            while lines:
+                progress.update(sum(map(len, lines)))
+                for line in lines:
+                    yield line.decode('utf-8')
+                lines = fp.readlines(chunk_bytes)
+
+    def _run_parallel_indexer(self, corpus, workers, chunk_size):
+        """ Shards the corpus into chunks of lines, builds a partial index per chunk in a pool of worker processes,
+            and k-way merges the partial indexes into self.indexer.
+            At most 2 chunks per worker are in flight, so the corpus is not read ahead of the workers."""
+        lines = self._read_corpus(corpus)
+        chunks = iter(lambda: list(islice(lines, chunk_size)), [])
+        partial_indexes, pending = [], deque()
+        with Pool(workers) as pool:
+            for chunk in chunks:
+                pending.append(pool.apply_async(_index_chunk, (chunk, self.preprocessor.remove_stopwords,
+                                                                self.preprocessor.stem, self.indexer.positional)))
+                if len(pending) >= 2 * workers:
+                    partial_indexes.append(pending.popleft().get())
+            while pending:
+                partial_indexes.append(pending.popleft().get())
+        self.indexer.merge_partial_indexes(partial_indexes)
+
+    def add_documents(self, documents):
+        """ Adds (or replaces) documents, given as corpus lines, to the live index. They are searchable right away,
+            from the delta segment of the index."""
+        doc_ids, texts = zip(*map(self.preprocessor.get_doc_id, documents)) if documents else ((), ())
+        self.indexer.add_documents(zip(doc_ids, self.preprocessor.tokenize_many(texts)))
+        self._schedule_merge()
+
+    def delete_documents(self, doc_ids):
+        """ Deletes documents from the live index. They are hidden by tombstones right away."""
+        self.indexer.delete_documents(doc_ids)
+        self._schedule_merge()
+
+    def _schedule_merge(self):
+        """ Merges the delta segment into the main index in the background, once it holds merge_threshold
+            documents or tombstones, unless a merge is already pending."""
+        delta_size = len(self.indexer.delta_doc_terms) + len(self.indexer.tombstones)
+        if delta_size >= self.merge_threshold and (self.pending_merge is None or self.pending_merge.done()):
+            self.pending_merge = self.merger.submit(self.indexer.merge_delta)
 
     def sanity_checker(self, command):
         """ DO NOT MODIFY THIS. THIS IS USED BY THE GRADER. """
@@ -85,67 +622,90 @@ class ProjectRunner:
                 "node_value": str(index[kw].start_node.value),
                 "command_result": eval(command) if "." in command else ""}
 
-    def run_queries(self, query_list, random_command):
-        """ DO NOT CHANGE THE output_dict definition"""
+    def _run_query(self, input_term_arr, top_k=None):
+        """ Runs a single tokenized query, & returns its entries for each section of the run_queries output_dict:
+            the postings lists of its terms for postingsList & postingsListSkip, & a {results, num_docs,
+            num_comparisons} dict for each of the DAAT AND sections."""
+        query_output = {'postingsList': {}, 'postingsListSkip': {}}
+        for term in input_term_arr:
+            postings = self._get_postings(term)
+            skip_postings = postings.traverse_skips() or []
+            query_output['postingsList'][term] = postings.to_list()
+            query_output['postingsListSkip'][term] = [node.value for node in skip_postings]
+
+        and_no_skip, and_comparisons_no_skip = self._daat_and(input_term_arr)
+        and_skip, and_comparisons_skip = self._daat_and(input_term_arr, use_skips=True)
+        and_op_no_skip, and_op_skip = and_no_skip.to_list(), and_skip.to_list()
+        if top_k is None:
+            and_op_no_skip_sorted, and_op_skip_sorted = self._sort_by_tf_idf(and_no_skip), \
+                self._sort_by_tf_idf(and_skip)
+        else:
+            # The AND results are already there: only ranking them depends on top_k
+            and_op_no_skip_sorted, and_op_skip_sorted = self._top_k_by_tf_idf(and_no_skip, top_k), \
+                self._top_k_by_tf_idf(and_skip, top_k)
+
+        for section, op, comparisons in (('daatAnd', and_op_no_skip, and_comparisons_no_skip),
+                                         ('daatAndSkip', and_op_skip, and_comparisons_skip),
+                                         ('daatAndTfIdf', and_op_no_skip_sorted, and_comparisons_no_skip),
+                                         ('daatAndSkipTfIdf', and_op_skip_sorted, and_comparisons_skip)):
+            op_no_score, results_cnt = self._output_formatter(op)
+            query_output[section] = {'results': op_no_score, 'num_docs': results_cnt,
+                                     'num_comparisons': comparisons}
+        return query_output
+
+    def _run_batch(self, keys):
+        """ Runs the (terms, top_k) queries, on the query pool if one was started & there is more than 1 query.
+            Batches take turns on the pool, which is re-forked first if the index changed since."""
+        if self.query_pool is None or len(keys) < 2:
+            return [self._run_query(input_term_arr, top_k) for input_term_arr, top_k in tqdm(keys)]
+        with self.pool_lock:
+            if self.query_pool is None:
+                return [self._run_query(input_term_arr, top_k) for input_term_arr, top_k in keys]
+            if self.query_pool_version != self.indexer.version:
+                self._fork_query_pool(self.query_workers)
+            return self.query_pool.map(_run_pooled_query, keys)
+
+    def run_queries(self, query_list, random_command, top_k=None):
+        """ DO NOT CHANGE THE output_dict definition
+            top_k: only rank the top_k documents by tf-idf in daatAndTfIdf & daatAndSkipTfIdf, with a bounded heap
+            over the DAAT AND results instead of a full sort. Their num_comparisons stay those of the AND.
+            The output of each query is cached by its tokenized terms (see QueryCache), & the queries missing from the
+            cache are run in parallel if a query pool was started."""
+        with METRICS.timer('sanity'):
+            sanity = self.sanity_checker(random_command)
         output_dict = {'postingsList': {},
                        'postingsListSkip': {},
                        'daatAnd': {},
                        'daatAndSkip': {},
                        'daatAndTfIdf': {},
                        'daatAndSkipTfIdf': {},
-                       'sanity': self.sanity_checker(random_command)}
-
-        for query in tqdm(query_list):
+                       'sanity': sanity}
+
+        index_version = self.cache.validate(self.indexer.version)
+        with METRICS.timer('tokenize'):
+            tokenized_queries = self.preprocessor.tokenize_many(query_list)
+        METRICS.increment('queries_total', len(query_list))
+        if self.query_log is not None:
+            self.query_log.extend(tokenized_queries)
+        keys = [(tuple(input_term_arr), top_k) for input_term_arr in tokenized_queries]
+        query_outputs = {key: self.cache.queries.get(key) for key in dict.fromkeys(keys)}
+        misses = [key for key, query_output in query_outputs.items() if query_output is None]
+        for key, query_output in zip(misses, self._run_batch(misses)):
+            query_outputs[key] = query_output
+            self.cache.put(self.cache.queries, key, query_output, index_version)
+
+        for query, key in zip(query_list, keys):
             """ Run each query against the index. You should do the following for each query:
                 1. Pre-process & tokenize the query.
                 2. For each query token, get the postings list & postings list with skip pointers.
                 3. Get the DAAT AND query results & number of comparisons with & without skip pointers.
                 4. Get the DAAT AND query results & number of comparisons with & without skip pointers, 
                     along with sorting by tf-idf scores."""
-            raise NotImplementedError
-
-            input_term_arr = []  # Tokenized query. To be implemented.
-
-            for term in input_term_arr:
-                postings, skip_postings = None, None
-
-                """ Implement logic to populate initialize the above variables.
-                    The below code formats your result to the required format.
-                    To be implemented."""
-
-                output_dict['postingsList'][term] = postings
-                output_dict['postingsListSkip'][term] = skip_postings
-
-            and_op_no_skip, and_op_skip, and_op_no_skip_sorted, and_op_skip_sorted = None, None, None, None
-            and_comparisons_no_skip, and_comparisons_skip, \
-                and_comparisons_no_skip_sorted, and_comparisons_skip_sorted = None, None, None, None
-            """ Implement logic to populate initialize the above variables.
-                The below code formats your result to the required format.
-                To be implemented."""
-            and_op_no_score_no_skip, and_results_cnt_no_skip = self._output_formatter(and_op_no_skip)
-            and_op_no_score_skip, and_results_cnt_skip = self._output_formatter(and_op_skip)
-            and_op_no_score_no_skip_sorted, and_results_cnt_no_skip_sorted = self._output_formatter(and_op_no_skip_sorted)
-            and_op_no_score_skip_sorted, and_results_cnt_skip_sorted = self._output_formatter(and_op_skip_sorted)
-
-            output_dict['daatAnd'][query.strip()] = {}
-            output_dict['daatAnd'][query.strip()]['results'] = and_op_no_score_no_skip
-            output_dict['daatAnd'][query.strip()]['num_docs'] = and_results_cnt_no_skip
-            output_dict['daatAnd'][query.strip()]['num_comparisons'] = and_comparisons_no_skip
-
-            output_dict['daatAndSkip'][query.strip()] = {}
-            output_dict['daatAndSkip'][query.strip()]['results'] = and_op_no_score_skip
-            output_dict['daatAndSkip'][query.strip()]['num_docs'] = and_results_cnt_skip
-            output_dict['daatAndSkip'][query.strip()]['num_comparisons'] = and_comparisons_skip
-
-            output_dict['daatAndTfIdf'][query.strip()] = {}
-            output_dict['daatAndTfIdf'][query.strip()]['results'] = and_op_no_score_no_skip_sorted
-            output_dict['daatAndTfIdf'][query.strip()]['num_docs'] = and_results_cnt_no_skip_sorted
-            output_dict['daatAndTfIdf'][query.strip()]['num_comparisons'] = and_comparisons_no_skip_sorted
-
-            output_dict['daatAndSkipTfIdf'][query.strip()] = {}
-            output_dict['daatAndSkipTfIdf'][query.strip()]['results'] = and_op_no_score_skip_sorted
-            output_dict['daatAndSkipTfIdf'][query.strip()]['num_docs'] = and_results_cnt_skip_sorted
-            output_dict['daatAndSkipTfIdf'][query.strip()]['num_comparisons'] = and_comparisons_skip_sorted
+            for section, results in query_outputs[key].items():
+                if section in ('postingsList', 'postingsListSkip'):
+                    output_dict[section].update(results)
+                else:
+                    output_dict[section][query.strip()] = results
 
         return output_dict
 
@@ -158,20 +718,86 @@ def execute_query():
 
     queries = request.json["queries"]
     random_command = request.json["random_command"]
+    top_k = request.json.get("top_k")
 
     """ Running the queries against the pre-loaded index. """
-    output_dict = runner.run_queries(queries, random_command)
+    output_dict = runner.run_queries(queries, random_command, top_k=top_k)
+
+    """ Serializing output_dict once, for both the response & the JSON output file, which is written in the
+        background so that the response does not wait for the disk. Large batches are streamed. """
+    chunks = _response_chunks(output_dict, start_time, output_location if write_output_file else None)
+    METRICS.increment('requests_total', endpoint='execute_query')
+    if len(queries) >= stream_threshold:
+        return flask.Response(_observed_request(chunks, start_time), mimetype='application/json')
+    response = flask.Response(b''.join(chunks), mimetype='application/json')
+    if METRICS.enabled:
+        METRICS.observe('request', time.time() - start_time)
+    return response
+
+
+@app.route("/execute_phrase_query", methods=['POST'])
+def execute_phrase_query():
+    """ Runs phrase queries. The body is {"queries": [...], "slop": 0}; slop > 0 allows that many extra tokens
+        between consecutive query terms. Needs an index built with --positional."""
+    start_time = time.time()
+    try:
+        output = runner.run_phrase_queries(request.json["queries"], slop=int(request.json.get("slop", 0)))
+    except ValueError as error:
+        return flask.jsonify({"error": str(error)}), 400
+    return flask.jsonify({"Response": output, "time_taken": str(time.time() - start_time),
+                          "username_hash": username_hash})
+
+
+@app.route("/execute_boolean_query", methods=['POST'])
+def execute_boolean_query():
+    """ Runs boolean queries, e.g. "covid AND (vaccine OR mask) AND NOT hoax". The body is {"queries": [...],
+        "use_skips": true}. Operators are upper case; adjacent words are ANDed."""
+    start_time = time.time()
+    try:
+        output = runner.run_boolean_queries(request.json["queries"],
+                                            use_skips=bool(request.json.get("use_skips", True)))
+    except QuerySyntaxError as error:
+        return flask.jsonify({"error": str(error)}), 400
+    return flask.jsonify({"Response": output, "time_taken": str(time.time() - start_time),
+                          "username_hash": username_hash})
+
+
+@app.route("/add_documents", methods=['POST'])
+def add_documents():
+    """ Adds documents to the live index. The body is {"documents": ["<doc id>\\t<text>", ...]}, as corpus lines.
+        A document whose id is already indexed is replaced."""
+    runner.add_documents(request.json["documents"])
+    return flask.jsonify(runner.indexer.delta_stats())
 
-    """ Dumping the results to a JSON file. """
-    with open(output_location, 'w') as fp:
-        json.dump(output_dict, fp)
 
-    response = {
-        "Response": output_dict,
-        "time_taken": str(time.time() - start_time),
-        "username_hash": username_hash
-    }
-    return flask.jsonify(response)
+@app.route("/delete_documents", methods=['POST'])
+def delete_documents():
+    """ Deletes documents from the live index. The body is {"doc_ids": [<doc id>, ...]}."""
+    runner.delete_documents([int(doc_id) for doc_id in request.json["doc_ids"]])
+    return flask.jsonify(runner.indexer.delta_stats())
+
+
+@app.route("/adapt_skips", methods=['POST'])
+def adapt_skips():
+    """ Re-places the skip pointers of the hot postings lists from the logged queries (see --skip_log_size). The
+        optional body {"min_merges": 3} sets how many logged merges make a list hot."""
+    skip_policy = AdaptiveSkipPolicy(min_merges=int((request.get_json(silent=True) or {}).get("min_merges", 3)))
+    n_changed = runner.adapt_skips(skip_policy)
+    return flask.jsonify({"logged_queries": len(runner.query_log or ()), "hot_lists": len(skip_policy.hot_terms()),
+                          "replaced_lists": n_changed, "index_version": runner.indexer.version})
+
+
+@app.route("/metrics", methods=['GET'])
+def export_metrics():
+    """ Stage timing histograms, counters & profiler samples, in the Prometheus text format. Start the server with
+        --metrics to record them. Stages run in query pool workers (--query_workers > 1) are not seen here."""
+    return flask.Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route("/cache_stats", methods=['GET'])
+def cache_stats():
+    """ Hit / miss counters & sizes of the query & postings pair caches."""
+    return flask.jsonify(runner.cache.stats())
 
 
 if __name__ == "__main__":
@@ -185,18 +811,73 @@ if __name__ == "__main__":
     parser.add_argument("--username", type=str,
                         help="Your UB username. It's the part of your UB email id before the @buffalo.edu. "
                              "DO NOT pass incorrect value here")
-
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of processes used to index the corpus. 1 indexes it serially.")
+    parser.add_argument("--index_file", "--index-file", type=str, default=None,
+                        help="Binary index file. Built from the corpus & saved here if missing, "
+                             "memory-mapped instead of re-indexing the corpus if present. It must have been built "
+                             "with the same --remove_stopwords, --stem & --compress_postings, & without "
+                             "--positional.")
+    parser.add_argument("--query_cache_size", type=int, default=1024,
+                        help="Max number of cached query outputs. 0 disables the query cache.")
+    parser.add_argument("--pair_cache_size", type=int, default=4096,
+                        help="Max number of cached intersections of 2 postings lists. 0 disables the pair cache.")
+    parser.add_argument("--query_workers", type=int, default=1,
+                        help="Number of processes running the queries of a batch in parallel. 1 runs them serially.")
+    parser.add_argument("--remove_stopwords", action="store_true",
+                        help="Remove the NLTK english stopwords from documents & queries.")
+    parser.add_argument("--stem", action="store_true", help="Porter stem the terms of documents & queries.")
+    parser.add_argument("--positional", action="store_true",
+                        help="Also index the token positions of the terms, for /execute_phrase_query. Positions are "
+                             "kept in memory only, & not written to --index_file.")
+    parser.add_argument("--merge_threshold", type=int, default=1000,
+                        help="Number of documents added or deleted through the API, after which they are merged "
+                             "into the main index in the background.")
+    parser.add_argument("--compress_postings", action="store_true",
+                        help="Keep the doc ids of the postings lists gap encoded & packed, in memory & in the index "
+                             "file, & decode them lazily while merging.")
+    parser.add_argument("--skip_log_size", type=int, default=0,
+                        help="Log the terms of the last N queries, from which /adapt_skips re-places the skip "
+                             "pointers of the hot postings lists. 0 disables the log.")
+    parser.add_argument("--no_output_file", action="store_true",
+                        help="Do not write the output of each /execute_query request to --output_location.")
+    parser.add_argument("--stream_threshold", type=int, default=STREAM_THRESHOLD,
+                        help="Stream the responses of batches of at least this many queries, section by section.")
+    parser.add_argument("--metrics", action="store_true",
+                        help="Record per-stage timings & counters, exported on /metrics.")
+    parser.add_argument("--profile_interval", type=float, default=0.0,
+                        help="With --metrics, also sample the running functions every this many seconds. "
+                             "0 disables the sampling profiler.")
     argv = parser.parse_args()
 
     corpus = argv.corpus
     output_location = argv.output_location
+    write_output_file, stream_threshold = not argv.no_output_file, argv.stream_threshold
     username_hash = hashlib.md5(argv.username.encode()).hexdigest()
 
     """ Initialize the project runner"""
-    runner = ProjectRunner()
+    runner = ProjectRunner(cache=QueryCache(max_queries=argv.query_cache_size, max_pairs=argv.pair_cache_size),
+                           preprocessor=Preprocessor(remove_stopwords=argv.remove_stopwords, stem=argv.stem),
+                           merge_threshold=argv.merge_threshold, positional=argv.positional)
 
     """ Index the documents from beforehand. When the API endpoint is hit, queries are run against 
         this pre-loaded in memory index. """
-    runner.run_indexer(corpus)
+    if argv.index_file and os.path.exists(argv.index_file):
+        try:
+            runner.load_index(argv.index_file, compress=argv.compress_postings)
+        except ValueError as error:
+            parser.error(f'{error}. Delete it to rebuild it from the corpus with these options.')
+    else:
+        runner.run_indexer(corpus, workers=argv.workers, compress=argv.compress_postings)
+        if argv.index_file:
+            runner.save_index(argv.index_file)
+
+    if argv.query_workers > 1:
+        runner.start_query_pool(argv.query_workers)
+
+    runner.log_queries(argv.skip_log_size)
+
+    if argv.metrics:
+        METRICS.enable(profile_interval=argv.profile_interval)
 
     app.run(host="0.0.0.0", port=9999)
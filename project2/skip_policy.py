@@ -0,0 +1,72 @@
+'''
+Skip pointer placement policies. A policy gives the skip length of the postings list of each term (see
+LinkedList.add_skip_connections): None for the default round(sqrt(n)) spacing, 0 for no skips.
+'''
+
+import math
+
+
+class SqrtSkipPolicy:
+    """ The default placement: floor(sqrt(n)) skips, round(sqrt(n)) postings apart, whatever the queries."""
+
+    def skip_length(self, term, llist):
+        return None
+
+
+class FixedSkipPolicy:
+    """ The same skip length for every postings list."""
+
+    def __init__(self, skip_length):
+        self.length = skip_length
+
+    def skip_length(self, term, llist):
+        return self.length
+
+
+class AdaptiveSkipPolicy:
+    """ Places the skips of the hot postings lists from logged merges: for each term, the number of merges of its
+        list, the total length of the lists it was merged with, & how often the merges checked & took its skips.
+        A merge probes the list about every d postings. Reaching a probe costs d / L skip checks & about L / 2
+        linear steps with skips L postings apart. With a skip check costing skip_check_cost linear steps, the skips
+        of a hot list are placed sqrt(2 skip_check_cost d) postings apart, & removed when that is less than 2.
+        d is estimated from the skip hit rate h of the logged merges when there are min_skip_checks of them: with
+        probes spread d postings apart on average, a skip of L postings is taken with probability h = exp(-L / d),
+        so d = -L / ln(h). This accounts for documents the terms tend to share. Otherwise, merges with lists of m
+        postings probe a list of n postings about min(m, n) times, so d = n / min(m, n).
+        Lists merged less than min_merges times keep the default placement. Stats must be logged under the current
+        placement: use a new policy for each round of adaptation."""
+
+    def __init__(self, min_merges=3, min_skip_checks=20, skip_check_cost=1.0):
+        self.min_merges, self.min_skip_checks = min_merges, min_skip_checks
+        self.skip_check_cost = skip_check_cost
+        # term -> [merges, total partner length, skip checks, skips taken]
+        self.stats = {}
+
+    def record(self, term, partner_length, skip_checks=0, skip_hits=0):
+        stats = self.stats.setdefault(term, [0, 0, 0, 0])
+        stats[0] += 1
+        stats[1] += partner_length
+        stats[2] += skip_checks
+        stats[3] += skip_hits
+
+    def hot_terms(self):
+        return [term for term, stats in self.stats.items() if stats[0] >= self.min_merges]
+
+    def hit_rate(self, term):
+        """ Fraction of the skip checks on the list of the term which took the skip, or None if none were logged."""
+        _, _, skip_checks, skip_hits = self.stats.get(term, (0, 0, 0, 0))
+        return skip_hits / skip_checks if skip_checks else None
+
+    def probe_gap(self, term, llist):
+        """ Estimated number of postings between 2 probes of a merge into the list of the term."""
+        merges, partner_length, skip_checks, skip_hits = self.stats[term]
+        if llist.skip_length and skip_checks >= self.min_skip_checks and skip_hits < skip_checks:
+            return -llist.skip_length / math.log(skip_hits / skip_checks) if skip_hits else 0.0
+        return llist.length / max(min(partner_length / merges, llist.length), 1)
+
+    def skip_length(self, term, llist):
+        stats = self.stats.get(term)
+        if stats is None or stats[0] < self.min_merges or not llist.length:
+            return None
+        skip_length = round(math.sqrt(2 * self.skip_check_cost * self.probe_gap(term, llist)))
+        return skip_length if skip_length >= 2 else 0
@@ -0,0 +1,186 @@
+'''
+Front-coded sorted vocabulary, mapping terms to dense integer ids, & a read-only term -> postings mapping over it.
+'''
+
+from array import array
+from bisect import bisect_right
+from collections.abc import KeysView, Mapping
+from compressed_postings import decode_varint, encode_varint
+
+
+class TermDictionary:
+    """ Sorted vocabulary, where the id of a term is its rank. Terms are utf-8 encoded & front-coded in blocks of
+        block_size terms: the first term of a block is stored whole, the others as the length of the prefix they
+        share with the previous term, followed by the rest of the term.
+        Looking a term up binary searches the first terms of the blocks, then scans a single block: O(log V)."""
+
+    def __init__(self, sorted_terms=(), block_size=16):
+        self.block_size = block_size
+        self.blob, self.block_offsets = bytearray(), array('I')
+        self.n_terms = 0
+        self._first_terms = None
+        previous = b''
+        for term in sorted_terms:
+            encoded = term.encode('utf-8')
+            if self.n_terms % block_size == 0:
+                self.block_offsets.append(len(self.blob))
+                encode_varint(len(encoded), self.blob)
+                self.blob += encoded
+            else:
+                shared = 0
+                for a, b in zip(previous, encoded):
+                    if a != b:
+                        break
+                    shared += 1
+                encode_varint(shared, self.blob)
+                encode_varint(len(encoded) - shared, self.blob)
+                self.blob += encoded[shared:]
+            previous = encoded
+            self.n_terms += 1
+        self.block_offsets.append(len(self.blob))
+
+    @classmethod
+    def from_buffers(cls, blob, block_offsets, n_terms, block_size):
+        """ Wraps an already front-coded vocabulary (e.g. memoryview slices of an index file) without copying it."""
+        term_dictionary = cls(block_size=block_size)
+        term_dictionary.blob, term_dictionary.block_offsets = blob, block_offsets
+        term_dictionary.n_terms = n_terms
+        return term_dictionary
+
+    @property
+    def n_blocks(self):
+        return len(self.block_offsets) - 1
+
+    def nbytes(self):
+        """ Bytes used by the front-coded vocabulary & its block offsets."""
+        return len(self.blob) + len(self.block_offsets) * self.block_offsets.itemsize
+
+    @property
+    def first_terms(self):
+        """ The first term of each block, decoded once on first use: the binary search of a lookup runs over them."""
+        if self._first_terms is None:
+            self._first_terms = []
+            for block in range(self.n_blocks):
+                length, position = decode_varint(self.blob, self.block_offsets[block])
+                self._first_terms.append(bytes(self.blob[position:position + length]))
+        return self._first_terms
+
+    def _block_terms(self, block):
+        """ Yields the (utf-8 encoded) terms of a block, in order."""
+        position, end = self.block_offsets[block], self.block_offsets[block + 1]
+        length, position = decode_varint(self.blob, position)
+        term = bytes(self.blob[position:position + length])
+        position += length
+        yield term
+        while position < end:
+            shared, position = decode_varint(self.blob, position)
+            length, position = decode_varint(self.blob, position)
+            term = term[:shared] + bytes(self.blob[position:position + length])
+            position += length
+            yield term
+
+    def _seek(self, key):
+        """ Returns (id, term) of the first term >= key, or (n_terms, None) if there is none."""
+        if self.n_terms == 0:
+            return 0, None
+        block = max(bisect_right(self.first_terms, key) - 1, 0)
+        term_id = block * self.block_size
+        for term in self._block_terms(block):
+            if term >= key:
+                return term_id, term
+            term_id += 1
+        return term_id, None
+
+    def term_id(self, term):
+        """ Returns the id of the term, or None if it is not in the vocabulary."""
+        key = term.encode('utf-8')
+        term_id, found = self._seek(key)
+        return term_id if found == key else None
+
+    def term_at(self, term_id):
+        if not 0 <= term_id < self.n_terms:
+            raise IndexError(term_id)
+        block, offset = divmod(term_id, self.block_size)
+        for position, term in enumerate(self._block_terms(block)):
+            if position == offset:
+                return term.decode('utf-8')
+
+    def _scan(self, term_id):
+        """ Yields (term id, utf-8 encoded term), from term_id to the end of the vocabulary."""
+        block, offset = divmod(term_id, self.block_size)
+        for block in range(block, self.n_blocks):
+            for position, term in enumerate(self._block_terms(block)):
+                if position >= offset:
+                    yield block * self.block_size + position, term
+            offset = 0
+
+    def prefix_scan(self, prefix):
+        """ Yields (term id, term) for every term starting with prefix, in order."""
+        key = prefix.encode('utf-8')
+        for term_id, term in self._scan(self._seek(key)[0]):
+            if not term.startswith(key):
+                return
+            yield term_id, term.decode('utf-8')
+
+    def range_scan(self, low, high=None):
+        """ Yields (term id, term) for every term in [low, high), in order. high=None scans to the end."""
+        high_key = None if high is None else high.encode('utf-8')
+        for term_id, term in self._scan(self._seek(low.encode('utf-8'))[0]):
+            if high_key is not None and term >= high_key:
+                return
+            yield term_id, term.decode('utf-8')
+
+    def __iter__(self):
+        for block in range(self.n_blocks):
+            for term in self._block_terms(block):
+                yield term.decode('utf-8')
+
+    def __len__(self):
+        return self.n_terms
+
+    def __contains__(self, term):
+        return self.term_id(term) is not None
+
+
+class TermIndex(Mapping):
+    """ Read-only term -> postings list mapping, over a TermDictionary & a sequence of postings lists addressed by
+        term id. Iterating keys, values or items walks the vocabulary in order, without any lookup. keys() is a
+        lazy view of the terms (see TermKeys): nothing is decoded ahead of use, or kept."""
+
+    def __init__(self, term_dictionary, postings):
+        self.term_dictionary, self.postings = term_dictionary, postings
+
+    def postings_at(self, term_id):
+        return self.postings[term_id]
+
+    def __getitem__(self, term):
+        term_id = self.term_dictionary.term_id(term)
+        if term_id is None:
+            raise KeyError(term)
+        return self.postings_at(term_id)
+
+    def __contains__(self, term):
+        return self.term_dictionary.term_id(term) is not None
+
+    def __iter__(self):
+        return iter(self.term_dictionary)
+
+    def __len__(self):
+        return len(self.term_dictionary)
+
+    def keys(self):
+        return TermKeys(self)
+
+    def values(self):
+        return [self.postings_at(term_id) for term_id in range(len(self))]
+
+    def items(self):
+        return zip(self.term_dictionary, self.values())
+
+
+class TermKeys(KeysView):
+    """ Keys view of a TermIndex, which also indexes the terms by id like a sequence: term_at decodes a single block,
+        & iterating decodes a block at a time."""
+
+    def __getitem__(self, term_id):
+        return self._mapping.term_dictionary.term_at(term_id if term_id >= 0 else term_id + len(self))